@@ -0,0 +1,233 @@
+"""
+Incremental, parallel index of the BigEarthNet tree.
+
+The tree holds one folder per patch (<root>/<patch name>/) with the band .tif files and a *_labels_metadata.json.
+build_index scans it with os.scandir and keeps one row per patch metadata file in a Parquet index, together with
+the mtime of the patch folder:
+    patch_name, dir_mtime_ns, json_name, labels (original CORINE labels), acquisition_date, tif_files
+On a rerun only the folders that are new or whose mtime changed (files added, removed or renamed) are read again,
+in several processes; the rows of removed folders are dropped. Files rewritten in place keep the folder mtime,
+rebuild the index with --rebuild after such edits.
+
+generate_csv_multi_band.py and generate_csv_single_band.py write the split csvs from the index, mapping the
+labels to the BigEarthNet-19 classes with label_mapping below.
+"""
+import json
+import os
+from multiprocessing import Pool
+
+import pandas as pd
+
+
+label_mapping = {
+    "original_labels":{
+        "Continuous urban fabric": 0,
+        "Discontinuous urban fabric": 1,
+        "Industrial or commercial units": 2,
+        "Road and rail networks and associated land": 3,
+        "Port areas": 4,
+        "Airports": 5,
+        "Mineral extraction sites": 6,
+        "Dump sites": 7,
+        "Construction sites": 8,
+        "Green urban areas": 9,
+        "Sport and leisure facilities": 10,
+        "Non-irrigated arable land": 11,
+        "Permanently irrigated land": 12,
+        "Rice fields": 13,
+        "Vineyards": 14,
+        "Fruit trees and berry plantations": 15,
+        "Olive groves": 16,
+        "Pastures": 17,
+        "Annual crops associated with permanent crops": 18,
+        "Complex cultivation patterns": 19,
+        "Land principally occupied by agriculture, with significant areas of natural vegetation": 20,
+        "Agro-forestry areas": 21,
+        "Broad-leaved forest": 22,
+        "Coniferous forest": 23,
+        "Mixed forest": 24,
+        "Natural grassland": 25,
+        "Moors and heathland": 26,
+        "Sclerophyllous vegetation": 27,
+        "Transitional woodland/shrub": 28,
+        "Beaches, dunes, sands": 29,
+        "Bare rock": 30,
+        "Sparsely vegetated areas": 31,
+        "Burnt areas": 32,
+        "Inland marshes": 33,
+        "Peatbogs": 34,
+        "Salt marshes": 35,
+        "Salines": 36,
+        "Intertidal flats": 37,
+        "Water courses": 38,
+        "Water bodies": 39,
+        "Coastal lagoons": 40,
+        "Estuaries": 41,
+        "Sea and ocean": 42
+    },
+    "label_conversion": [
+        [0, 1], 
+        [2], 
+        [11, 12, 13], 
+        [14, 15, 16, 18], 
+        [17],
+        [19], 
+        [20], 
+        [21], 
+        [22], 
+        [23], 
+        [24],
+        [25, 31],
+        [26, 27], 
+        [28], 
+        [29], 
+        [33, 34], 
+        [35, 36], 
+        [38, 39], 
+        [40, 41, 42]
+    ],
+    "BigEarthNet-19_labels":{
+        "Urban fabric": 0,
+        "Industrial or commercial units": 1,
+        "Arable land": 2,
+        "Permanent crops": 3,
+        "Pastures": 4,
+        "Complex cultivation patterns": 5,
+        "Land principally occupied by agriculture, with significant areas of natural vegetation": 6,
+        "Agro-forestry areas": 7,
+        "Broad-leaved forest": 8,
+        "Coniferous forest": 9,
+        "Mixed forest": 10,
+        "Natural grassland and sparsely vegetated areas": 11,
+        "Moors, heathland and sclerophyllous vegetation": 12,
+        "Transitional woodland, shrub": 13,
+        "Beaches, dunes, sands": 14,
+        "Inland wetlands": 15,
+        "Coastal wetlands": 16,
+        "Inland waters": 17,
+        "Marine waters": 18
+    }
+}
+
+
+# Function to extract information from JSON files
+def extract_info_from_json(json_path):
+    with open(json_path, 'r') as file:
+        data = json.load(file)
+        labels = data.get('labels')
+        acquisition_date = data.get('acquisition_date')
+    return labels, acquisition_date
+
+
+def map_labels(labels, label_mapping):
+    # Flatten label conversion mapping
+    flat_conversion = [item for sublist in label_mapping['label_conversion'] for item in sublist]
+    
+    # Map original labels to BigEarthNet-19 labels
+    mapped_labels = []
+    for orig_label in labels:
+        for idx, conv_labels in enumerate(label_mapping['label_conversion']):
+            if label_mapping['original_labels'][orig_label] in conv_labels:
+                mapped_labels.append(list(label_mapping['BigEarthNet-19_labels'].keys())[idx])
+                break
+    
+    return mapped_labels
+
+
+INDEX_COLUMNS = ['patch_name', 'dir_mtime_ns', 'json_name', 'labels', 'acquisition_date', 'tif_files']
+
+
+def scan_patch(item):
+    """
+    :param item: (patch folder, patch name, folder mtime in ns)
+    :return: Index rows of the folder, one per .json file. A folder without one gets a row with json_name None,
+        so its mtime is still recorded.
+    """
+    patch_dir, patch_name, mtime_ns = item
+    names = sorted(entry.name for entry in os.scandir(patch_dir) if entry.is_file())
+    tif_files = [name for name in names if name.endswith('.tif') or name.endswith('.tiff')]
+    json_files = [name for name in names if name.endswith('.json')]
+
+    rows = []
+    for json_name in json_files:
+        labels, acquisition_date = extract_info_from_json(os.path.join(patch_dir, json_name))
+        rows.append((patch_name, mtime_ns, json_name, labels, acquisition_date, tif_files))
+    if not rows:
+        rows.append((patch_name, mtime_ns, None, [], None, tif_files))
+    return rows
+
+
+def load_index(index_path: str) -> pd.DataFrame:
+    """
+    :return: Index written by build_index, with python lists in the list columns
+    """
+    index = pd.read_parquet(index_path)
+    for column in ['labels', 'tif_files']:
+        index[column] = [list(values) for values in index[column]]
+    return index
+
+
+def build_index(root: str, index_path: str, num_workers: int = 8, rebuild: bool = False) -> pd.DataFrame:
+    """
+    Updates (or creates) the index of the patch folders below root.
+    :param root: BigEarthNet root folder, with one sub-folder per patch
+    :param index_path: Parquet index, read if it exists and rewritten
+    :param num_workers: Number of processes reading the metadata of new or changed folders
+    :param rebuild: Ignore the existing index and read every folder
+    :return: Index of all patch folders, sorted by patch name
+    """
+    known_mtimes = {}
+    old_index = None
+    if os.path.exists(index_path) and not rebuild:
+        old_index = load_index(index_path)
+        known_mtimes = dict(zip(old_index['patch_name'], old_index['dir_mtime_ns']))
+
+    # scandir reports the entry types without a stat call, only the folder mtimes need one
+    folders, changed = [], []
+    for entry in os.scandir(root):
+        if entry.is_dir():
+            mtime_ns = entry.stat().st_mtime_ns
+            folders.append(entry.name)
+            if known_mtimes.get(entry.name) != mtime_ns:
+                changed.append((entry.path, entry.name, mtime_ns))
+    print(f'{len(folders)} patch folders, {len(changed)} new or changed')
+
+    rows = []
+    with Pool(num_workers) as pool:
+        for i, patch_rows in enumerate(pool.imap_unordered(scan_patch, changed, chunksize=64)):
+            rows.extend(patch_rows)
+            if i % 10000 == 0:
+                print(f'Read {i}/{len(changed)} patch folders')
+    index = pd.DataFrame(rows, columns=INDEX_COLUMNS)
+
+    if old_index is not None:
+        # Unchanged folders keep their rows, removed ones are dropped
+        changed_names = set(name for _, name, _ in changed)
+        keep = old_index['patch_name'].isin(set(folders) - changed_names)
+        index = pd.concat([old_index[keep], index], ignore_index=True)
+    index = index.sort_values(['patch_name', 'json_name'], na_position='last').reset_index(drop=True)
+
+    # Written under a temporary name, an interrupted run keeps the previous index
+    tmp_path = index_path + '.tmp'
+    index.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, index_path)
+    print(f'Wrote index of {len(folders)} patch folders to {index_path}')
+    return index
+
+
+def load_split(split_path: str) -> set:
+    """
+    :param split_path: Split csv of BigEarthNet-S2_19-classes_models, one patch name per line (no header)
+    """
+    return set(pd.read_csv(split_path, header=None).iloc[:, 0].values.tolist())
+
+
+def split_rows(index: pd.DataFrame, split_path: str, max_patches: int = None) -> pd.DataFrame:
+    """
+    :param max_patches: Only keep the first max_patches patch folders of the split
+    :return: Index rows of the patches of the split that have label metadata
+    """
+    index = index[index['patch_name'].isin(load_split(split_path)) & index['json_name'].notna()]
+    if max_patches is not None:
+        index = index[index['patch_name'].isin(index['patch_name'].unique()[:max_patches])]
+    return index
@@ -26,7 +26,7 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler, max_norm: float = 0,
                     mixup_fn: Optional[Mixup] = None, log_writer=None,
-                    args=None):
+                    args=None, batch_aug=None):
     model.train(True)
     metric_logger = misc.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
@@ -34,20 +34,26 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
     print_freq = 20
 
     accum_iter = args.accum_iter
+    # Iterations the sampler skips when resuming within the epoch
+    start_step = getattr(data_loader.sampler, 'start_index', 0) // args.batch_size
+    num_steps = start_step + len(data_loader)
 
     optimizer.zero_grad()
 
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
 
-    for data_iter_step, (samples, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    for data_iter_step, (samples, targets) in \
+            enumerate(metric_logger.log_every(data_loader, print_freq, header), start=start_step):
 
         # we use a per iteration (instead of per epoch) lr scheduler
         if data_iter_step % accum_iter == 0:
-            lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
+            lr_sched.adjust_learning_rate(optimizer, data_iter_step / num_steps + epoch, args)
 
         samples = samples.to(device, non_blocking=True)
         targets = targets.to(device, non_blocking=True)
+        if batch_aug is not None:
+            samples = batch_aug(samples)
 
         # uncomment the 2 lines below for single label cases
         # comment for multilabel
@@ -88,7 +94,7 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
             """ We use epoch_1000x as the x-axis in tensorboard.
             This calibrates different curves when batch size changes.
             """
-            epoch_1000x = int((data_iter_step / len(data_loader) + epoch) * 1000)
+            epoch_1000x = int((data_iter_step / num_steps + epoch) * 1000)
             log_writer.add_scalar('loss', loss_value_reduce, epoch_1000x)
             log_writer.add_scalar('lr', max_lr, epoch_1000x)
 
@@ -99,6 +105,9 @@ def train_one_epoch(model: torch.nn.Module, criterion: torch.nn.Module,
                 except ValueError:
                     pass
 
+        misc.save_step_checkpoint(args, epoch, data_iter_step, num_steps, model, optimizer, loss_scaler,
+                                  data_loader)
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
@@ -117,28 +126,37 @@ def train_one_epoch_temporal(model: torch.nn.Module, criterion: torch.nn.Module,
     print_freq = 20
 
     accum_iter = args.accum_iter
+    # Iterations the sampler skips when resuming within the epoch
+    start_step = getattr(data_loader.sampler, 'start_index', 0) // args.batch_size
+    num_steps = start_step + len(data_loader)
 
     optimizer.zero_grad()
 
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
 
-    for data_iter_step, (samples, timestamps, targets) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header),
+                                           start=start_step):
+        # (frames, timestamps, labels), with a pad mask before the labels for --variable_frames batches
+        samples, timestamps, targets = batch[0], batch[1], batch[-1]
+        pad_mask = batch[2] if len(batch) == 4 else None
 
         # we use a per iteration (instead of per epoch) lr scheduler
         if data_iter_step % accum_iter == 0:
-            lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
+            lr_sched.adjust_learning_rate(optimizer, data_iter_step / num_steps + epoch, args)
 
         samples = samples.to(device, non_blocking=True)
         timestamps = timestamps.to(device, non_blocking=True)
         targets = targets.to(device, non_blocking=True)
+        if pad_mask is not None:
+            pad_mask = pad_mask.to(device, non_blocking=True)
 
         if mixup_fn is not None:
             samples, targets = mixup_fn(samples, targets)
 
         with torch.cuda.amp.autocast():
 
-            outputs = model(samples, timestamps)
+            outputs = model(samples, timestamps, pad_mask=pad_mask)
             loss = criterion(outputs, targets)
 
         loss_value = loss.item()
@@ -173,7 +191,7 @@ def train_one_epoch_temporal(model: torch.nn.Module, criterion: torch.nn.Module,
             """ We use epoch_1000x as the x-axis in tensorboard.
             This calibrates different curves when batch size changes.
             """
-            epoch_1000x = int((data_iter_step / len(data_loader) + epoch) * 1000)
+            epoch_1000x = int((data_iter_step / num_steps + epoch) * 1000)
             log_writer.add_scalar('loss', loss_value_reduce, epoch_1000x)
             log_writer.add_scalar('lr', max_lr, epoch_1000x)
 
@@ -184,6 +202,9 @@ def train_one_epoch_temporal(model: torch.nn.Module, criterion: torch.nn.Module,
                 except ValueError:
                     pass
 
+        misc.save_step_checkpoint(args, epoch, data_iter_step, num_steps, model, optimizer, loss_scaler,
+                                  data_loader)
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
@@ -241,7 +262,7 @@ def mean_average_precision(targets, outputs):
 
 
 @torch.no_grad()
-def evaluate(data_loader, model, device):
+def evaluate(data_loader, model, device, batch_aug=None):
     # needs to be adapted for both single and multilabel
     # single label commented out >> crossentropy
     criterion = torch.nn.CrossEntropyLoss()
@@ -262,6 +283,8 @@ def evaluate(data_loader, model, device):
         target = batch[-1]
         images = images.to(device, non_blocking=True)
         target = target.to(device, non_blocking=True)
+        if batch_aug is not None:
+            images = batch_aug(images)
 
         # print("before pass model")
         # compute output
@@ -292,7 +315,7 @@ def evaluate(data_loader, model, device):
 
 
 @torch.no_grad()
-def evaluate_temporal(data_loader, model, device):
+def evaluate_temporal(data_loader, model, device, batch_aug=None):
     criterion = torch.nn.CrossEntropyLoss()
     # criterion = torch.nn.MultiLabelSoftMarginLoss()
 
@@ -309,6 +332,7 @@ def evaluate_temporal(data_loader, model, device):
         images = batch[0]
         timestamps = batch[1]
         target = batch[-1]
+        pad_mask = batch[2] if len(batch) == 4 else None  # --variable_frames
 
         batch_size = images.shape[0]
         # print(images.shape, timestamps.shape, target.shape)
@@ -321,12 +345,16 @@ def evaluate_temporal(data_loader, model, device):
         images = images.to(device, non_blocking=True)
         timestamps = timestamps.to(device, non_blocking=True)
         target = target.to(device, non_blocking=True)
+        if pad_mask is not None:
+            pad_mask = pad_mask.to(device, non_blocking=True)
+        if batch_aug is not None:
+            images = batch_aug(images)
 
         # print("before pass model")
         # compute output
         with torch.cuda.amp.autocast():
         # with torch.no_grad():
-            output = model(images, timestamps)
+            output = model(images, timestamps, pad_mask=pad_mask)
 
             if tta:
                 # output = output.reshape(batch_size, 9, -1).mean(dim=1, keepdims=False)
@@ -17,7 +17,8 @@ def train_one_epoch(model: torch.nn.Module,
                     data_loader: Iterable, optimizer: torch.optim.Optimizer,
                     device: torch.device, epoch: int, loss_scaler,
                     log_writer=None,
-                    args=None):
+                    args=None,
+                    batch_aug=None):
     model.train(True)
     metric_logger = misc.MetricLogger(delimiter="  ")
     metric_logger.add_meter('lr', misc.SmoothedValue(window_size=1, fmt='{value:.6f}'))
@@ -25,19 +26,25 @@ def train_one_epoch(model: torch.nn.Module,
     print_freq = 20
 
     accum_iter = args.accum_iter
+    # Iterations the sampler skips when resuming within the epoch
+    start_step = getattr(data_loader.sampler, 'start_index', 0) // args.batch_size
+    num_steps = start_step + len(data_loader)
 
     optimizer.zero_grad()
 
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
 
-    for data_iter_step, (samples, _) in enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    for data_iter_step, (samples, _) in \
+            enumerate(metric_logger.log_every(data_loader, print_freq, header), start=start_step):
 
         # we use a per iteration (instead of per epoch) lr scheduler
         if data_iter_step % accum_iter == 0:
-            lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
+            lr_sched.adjust_learning_rate(optimizer, data_iter_step / num_steps + epoch, args)
 
         samples = samples.to(device, non_blocking=True)
+        if batch_aug is not None:
+            samples = batch_aug(samples)
 
         with torch.cuda.amp.autocast():
             loss, _, _ = model(samples, mask_ratio=args.mask_ratio)
@@ -67,7 +74,7 @@ def train_one_epoch(model: torch.nn.Module,
             """ We use epoch_1000x as the x-axis in tensorboard.
             This calibrates different curves when batch size changes.
             """
-            epoch_1000x = int((data_iter_step / len(data_loader) + epoch) * 1000)
+            epoch_1000x = int((data_iter_step / num_steps + epoch) * 1000)
             log_writer.add_scalar('train_loss', loss_value_reduce, epoch_1000x)
             log_writer.add_scalar('lr', lr, epoch_1000x)
 
@@ -79,6 +86,9 @@ def train_one_epoch(model: torch.nn.Module,
                 except ValueError:
                     pass
 
+        misc.save_step_checkpoint(args, epoch, data_iter_step, num_steps, model, optimizer, loss_scaler,
+                                  data_loader)
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
@@ -97,24 +107,32 @@ def train_one_epoch_temporal(model: torch.nn.Module,
     print_freq = 20
 
     accum_iter = args.accum_iter
+    # Iterations the sampler skips when resuming within the epoch
+    start_step = getattr(data_loader.sampler, 'start_index', 0) // args.batch_size
+    num_steps = start_step + len(data_loader)
 
     optimizer.zero_grad()
 
     if log_writer is not None:
         print('log_dir: {}'.format(log_writer.log_dir))
 
-    for data_iter_step, (samples, timestamps, _) in \
-            enumerate(metric_logger.log_every(data_loader, print_freq, header)):
+    for data_iter_step, batch in enumerate(metric_logger.log_every(data_loader, print_freq, header),
+                                           start=start_step):
+        # (frames, timestamps, labels), with a pad mask before the labels for --variable_frames batches
+        samples, timestamps = batch[0], batch[1]
+        pad_mask = batch[2] if len(batch) == 4 else None
 
         # we use a per iteration (instead of per epoch) lr scheduler
         if data_iter_step % accum_iter == 0:
-            lr_sched.adjust_learning_rate(optimizer, data_iter_step / len(data_loader) + epoch, args)
+            lr_sched.adjust_learning_rate(optimizer, data_iter_step / num_steps + epoch, args)
 
         samples = samples.to(device, non_blocking=True)
         timestamps = timestamps.to(device, non_blocking=True)
+        if pad_mask is not None:
+            pad_mask = pad_mask.to(device, non_blocking=True)
 
         with torch.cuda.amp.autocast():
-            loss, _, _ = model(samples, timestamps, mask_ratio=args.mask_ratio)
+            loss, _, _ = model(samples, timestamps, mask_ratio=args.mask_ratio, pad_mask=pad_mask)
 
         loss_value = loss.item()
 
@@ -140,7 +158,7 @@ def train_one_epoch_temporal(model: torch.nn.Module,
             """ We use epoch_1000x as the x-axis in tensorboard.
             This calibrates different curves when batch size changes.
             """
-            epoch_1000x = int((data_iter_step / len(data_loader) + epoch) * 1000)
+            epoch_1000x = int((data_iter_step / num_steps + epoch) * 1000)
             log_writer.add_scalar('train_loss', loss_value_reduce, epoch_1000x)
             log_writer.add_scalar('lr', lr, epoch_1000x)
 
@@ -152,6 +170,9 @@ def train_one_epoch_temporal(model: torch.nn.Module,
                 except ValueError:
                     pass
 
+        misc.save_step_checkpoint(args, epoch, data_iter_step, num_steps, model, optimizer, loss_scaler,
+                                  data_loader)
+
     # gather the stats from all processes
     metric_logger.synchronize_between_processes()
     print("Averaged stats:", metric_logger)
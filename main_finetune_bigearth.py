@@ -25,7 +25,11 @@ from timm.loss import LabelSmoothingCrossEntropy, SoftTargetCrossEntropy
 
 import util.lr_decay as lrd
 import util.misc as misc
-from util.datasets import build_fmow_dataset
+from util.datasets import build_fmow_dataset, pad_frames_collate
+from util.batch_aug import Uint8ToFloat, build_batch_augment, raw_collate
+from util.attention import use_fused_attention
+from util.resolution_benchmark import evaluate_sizes
+from util.sampler import FrameCountGroupedSampler, ResumableDistributedSampler
 from util.pos_embed import interpolate_pos_embed
 from util.misc import NativeScalerWithGradNormCount as NativeScaler
 
@@ -52,6 +56,9 @@ def get_args_parser():
                         help='Use channel model')
     parser.add_argument('--model', default='vit_large_patch16', type=str, metavar='MODEL',
                         help='Name of model to train')
+    parser.add_argument('--fused_attn', action='store_true', default=False,
+                        help='Compute attention with torch scaled_dot_product_attention (torch >= 2.0) instead '
+                             'of the explicit softmax(QK^T)V, checkpoints are compatible either way')
 
     parser.add_argument('--input_size', default=224, type=int,
                         help='images input size')
@@ -128,7 +135,7 @@ def get_args_parser():
     parser.add_argument('--test_path', default='/home/val_62classes.csv', type=str,
                         help='Test .csv path')
     # added bigearthnet in the choices
-    parser.add_argument('--dataset_type', default='rgb', choices=['rgb', 'temporal', 'sentinel', 'euro_sat', 'naip', 'bigearthnet'],
+    parser.add_argument('--dataset_type', default='rgb', choices=['rgb', 'temporal', 'sentinel', 'sentinel_packed', 'sentinel_stream', 'euro_sat', 'naip', 'bigearthnet'],
                         help='Whether to use fmow rgb, sentinel, or other dataset.')
     parser.add_argument('--masked_bands', default=None, nargs='+', type=int,
                         help='Sequence of band indices to mask (with mean val) in sentinel dataset')
@@ -136,6 +143,45 @@ def get_args_parser():
                         help="Which bands (0 indexed) to drop from sentinel data.")
     parser.add_argument('--grouped_bands', type=int, nargs='+', action='append',
                         default=[], help="Bands to group for GroupC vit")
+    parser.add_argument('--index_cache_dir', default=None, type=str,
+                        help='Directory to cache per-csv dataset index tables in, so later runs skip rebuilding them')
+    parser.add_argument('--windowed_reads', action='store_true', default=False,
+                        help='Read only the crop window of each GeoTIFF, at the input size (sentinel, euro_sat)')
+    parser.add_argument('--batch_aug', action='store_true', default=False,
+                        help='Workers only decode raw tiles, normalization and augmentation run batched on the '
+                             'device (sentinel, sentinel_packed, euro_sat)')
+    parser.add_argument('--uint8_transport', action='store_true', default=False,
+                        help='Keep normalized samples uint8 until the batch is on the device '
+                             '(sentinel, sentinel_packed, bigearthnet)')
+    parser.add_argument('--sample_cache_gb', default=0., type=float,
+                        help='Size of the node-wide shared memory cache of decoded images in GB, 0 to disable')
+    parser.add_argument('--sample_cache_dir', default='/dev/shm/satmae_sample_cache', type=str,
+                        help='Directory of the decoded image cache, should be on a tmpfs')
+    parser.add_argument('--shuffle_buffer', default=1000, type=int,
+                        help='Per-worker shuffle buffer size of streaming datasets (sentinel_stream), '
+                             '0 to not shuffle samples')
+    parser.add_argument('--read_threads', default=0, type=int,
+                        help='Threads per data loading worker to read the band files (bigearthnet) or frames '
+                             '(temporal, rgb_temporal_stacked) of a sample in parallel, 0 to read them serially')
+    parser.add_argument('--naip_tile_dir', default=None, type=str,
+                        help='Directory with the NAIP <i>tile.npy files (naip)')
+    parser.add_argument('--naip_labels_path', default=None, type=str,
+                        help='NAIP tile labels, defaults to <naip_tile_dir>/y.npy')
+    parser.add_argument('--naip_splits_path', default=None, type=str,
+                        help='NAIP train/val/test split of every tile, defaults to splits.npy next to naip_tile_dir')
+    parser.add_argument('--band_stats', default=None, type=str,
+                        help='Per-band stats file from `python -m util.band_stats` to normalize with, instead of '
+                             'the per-band constants of the dataset (sentinel, sentinel_packed, sentinel_stream, '
+                             'bigearthnet, euro_sat)')
+    parser.add_argument('--jpeg_draft', action='store_true', default=False,
+                        help='Decode JPEGs at a reduced resolution (1/2 to 1/8, in the DCT domain) whenever it is '
+                             'still large enough for the crop/resize at --input_size (rgb, temporal, '
+                             'rgb_temporal_stacked)')
+    parser.add_argument('--max_frames', default=3, type=int,
+                        help='Frames per sample of the temporal dataset (T_max)')
+    parser.add_argument('--variable_frames', action='store_true', default=False,
+                        help='Sample up to --max_frames distinct frames per location instead of repeating frames, '
+                             'pad each batch to its longest sample and group samples of similar length (temporal)')
 
     parser.add_argument('--nb_classes', default=62, type=int,
                         help='number of the classification types')
@@ -149,6 +195,10 @@ def get_args_parser():
     parser.add_argument('--seed', default=0, type=int)
     parser.add_argument('--resume', default='',
                         help='resume from checkpoint')
+    parser.add_argument('--save_every_steps', type=int, default=0,
+                        help='Also save checkpoint-last.pth every N iterations and at the end of every epoch, '
+                             'resuming from it continues within the epoch (0 to disable). '
+                             'Must be a multiple of --accum_iter')
     parser.add_argument('--save_every', type=int, default=1, help='How frequently (in epochs) to save ckpt')
     parser.add_argument('--wandb', type=str, default=None,
                         help="Wandb project name, eg: sentinel_finetune")
@@ -157,6 +207,9 @@ def get_args_parser():
                         help='start epoch')
     parser.add_argument('--eval', action='store_true',
                         help='Perform evaluation only')
+    parser.add_argument('--eval_sizes', type=int, nargs='+', default=None,
+                        help='With --eval, report accuracy and throughput at each of these input sizes (divisible '
+                             'by the patch size) instead of evaluating at --input_size')
     parser.add_argument('--dist_eval', action='store_true', default=False,
                         help='Enabling distributed evaluation (recommended during training for faster monitor')
     parser.add_argument('--num_workers', default=10, type=int)
@@ -208,9 +261,15 @@ def main(args):
     if True:  # args.distributed:
         num_tasks = misc.get_world_size()
         global_rank = misc.get_rank()
-        sampler_train = torch.utils.data.DistributedSampler(
-            dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True
-        )
+        if args.variable_frames:
+            sampler_train = FrameCountGroupedSampler(
+                dataset_train, dataset_train.frame_counts(), args.batch_size,
+                num_replicas=num_tasks, rank=global_rank, shuffle=True, seed=args.seed
+            )
+        else:
+            sampler_train = ResumableDistributedSampler(
+                dataset_train, num_replicas=num_tasks, rank=global_rank, shuffle=True, seed=args.seed
+            )
         print("Sampler_train = %s" % str(sampler_train))
         if args.dist_eval:
             if len(dataset_val) % num_tasks != 0:
@@ -225,6 +284,17 @@ def main(args):
     else:
         sampler_train = torch.utils.data.RandomSampler(dataset_train)
         sampler_val = torch.utils.data.SequentialSampler(dataset_val)
+    # Streaming datasets split their shards across ranks and workers themselves
+    if isinstance(dataset_train, torch.utils.data.IterableDataset):
+        sampler_train = None
+    if isinstance(dataset_val, torch.utils.data.IterableDataset):
+        sampler_val = None
+    if args.save_every_steps:
+        if sampler_train is None:
+            raise ValueError('--save_every_steps needs a map-style dataset, streaming datasets resume at epoch '
+                             'boundaries')
+        if args.save_every_steps % args.accum_iter != 0:
+            raise ValueError('--save_every_steps must be a multiple of --accum_iter')
 
     if global_rank == 0 and args.log_dir is not None and not args.eval:
         os.makedirs(args.log_dir, exist_ok=True)
@@ -232,12 +302,16 @@ def main(args):
     else:
         log_writer = None
 
+    collate_fn = raw_collate if args.batch_aug else None
+    if args.variable_frames:
+        collate_fn = pad_frames_collate  # batches of samples with different numbers of frames
     data_loader_train = torch.utils.data.DataLoader(
         dataset_train, sampler=sampler_train,
         batch_size=args.batch_size,
         num_workers=args.num_workers,
         pin_memory=args.pin_mem,
         drop_last=True,
+        collate_fn=collate_fn,
     )
 
     data_loader_val = torch.utils.data.DataLoader(
@@ -245,9 +319,17 @@ def main(args):
         batch_size=args.batch_size,
         num_workers=args.num_workers,
         pin_memory=args.pin_mem,
-        drop_last=False
+        drop_last=False,
+        collate_fn=collate_fn,
     )
 
+    batch_aug_train, batch_aug_val = None, None
+    if args.batch_aug:
+        batch_aug_train = build_batch_augment(dataset_train, True, args.input_size)
+        batch_aug_val = build_batch_augment(dataset_val, False, args.input_size)
+    elif args.uint8_transport:
+        batch_aug_train, batch_aug_val = Uint8ToFloat(), Uint8ToFloat()
+
     mixup_fn = None
     mixup_active = args.mixup > 0 or args.cutmix > 0. or args.cutmix_minmax is not None
     if mixup_active:
@@ -338,6 +420,8 @@ def main(args):
         # manually initialize fc layer
         trunc_normal_(model.head.weight, std=2e-5)
 
+    if args.fused_attn:
+        use_fused_attention(model)
     model.to(device)
 
     model_without_ddp = model
@@ -386,7 +470,8 @@ def main(args):
         criterion = torch.nn.MultiLabelSoftMarginLoss()
     print("criterion = %s" % str(criterion))
 
-    misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler)
+    misc.load_model(args=args, model_without_ddp=model_without_ddp, optimizer=optimizer, loss_scaler=loss_scaler,
+                    sampler=sampler_train)
 
     # Set up wandb
     if global_rank == 0 and args.wandb is not None:
@@ -395,10 +480,13 @@ def main(args):
         wandb.watch(model)
 
     if args.eval:
+        if args.eval_sizes:
+            evaluate_sizes(args, model, device)
+            exit(0)
         if args.model_type == 'temporal':
             test_stats = evaluate_temporal(data_loader_val, model, device)
         else:
-            test_stats = evaluate(data_loader_val, model, device)
+            test_stats = evaluate(data_loader_val, model, device, batch_aug=batch_aug_val)
         # print(f"Evaluation on {len(dataset_val)} test images- acc1: {test_stats['acc1']:.2f}%, "
         #       f"acc5: {test_stats['acc5']:.2f}%")
         print(f"Evaluation on {len(dataset_val)} test images- mAP: {test_stats['mAP']:.2f}%")
@@ -408,7 +496,9 @@ def main(args):
     start_time = time.time()
     max_accuracy = 0.0
     for epoch in range(args.start_epoch, args.epochs):
-        if args.distributed:
+        if isinstance(dataset_train, torch.utils.data.IterableDataset):
+            dataset_train.set_epoch(epoch)
+        else:
             data_loader_train.sampler.set_epoch(epoch)
 
         if args.model_type == 'temporal':
@@ -425,18 +515,24 @@ def main(args):
                 optimizer, device, epoch, loss_scaler,
                 args.clip_grad, mixup_fn,
                 log_writer=log_writer,
-                args=args
+                args=args,
+                batch_aug=batch_aug_train
             )
 
         if args.output_dir and (epoch % args.save_every == 0 or epoch + 1 == args.epochs):
             misc.save_model(
                 args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
                 loss_scaler=loss_scaler, epoch=epoch)
+        if args.output_dir and args.save_every_steps:
+            misc.save_model(
+                args=args, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
+                loss_scaler=loss_scaler, epoch=epoch,
+                sampler_state=sampler_train.state_dict(sampler_train.num_samples), tag='last')
 
         if args.model_type == 'temporal':
             test_stats = evaluate_temporal(data_loader_val, model, device)
         else:
-            test_stats = evaluate(data_loader_val, model, device)
+            test_stats = evaluate(data_loader_val, model, device, batch_aug=batch_aug_val)
 
         # section below need to be optimised for single and multilabel
         # print(f"Accuracy of the network on the {len(dataset_val)} test images: {test_stats['acc1']:.1f}%")
@@ -459,6 +555,8 @@ def main(args):
                      **{f'test_{k}': v for k, v in test_stats.items()},
                      'epoch': epoch,
                      'n_parameters': n_parameters}
+        if getattr(dataset_train, 'sample_cache', None) is not None:
+            log_stats.update({f'sample_cache_{k}': v for k, v in dataset_train.sample_cache.stats().items()})
 
         if args.output_dir and misc.is_main_process():
             if log_writer is not None:
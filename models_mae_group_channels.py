@@ -8,9 +8,11 @@ from functools import partial
 import torch
 import torch.nn as nn
 
-from timm.models.vision_transformer import PatchEmbed, Block
+from timm.models.vision_transformer import Block
 
-from util.pos_embed import get_2d_sincos_pos_embed, get_1d_sincos_pos_embed_from_grid
+from util.patch_embed import GroupChannelsPatchEmbed
+from util.pos_embed import (CachedEmbed, get_2d_sincos_pos_embed, get_1d_sincos_pos_embed_from_grid,
+                             get_group_pos_channel_embed, get_group_pos_channel_embed_with_cls)
 
 
 class MaskedAutoencoderGroupChannelViT(nn.Module):
@@ -32,8 +34,7 @@ class MaskedAutoencoderGroupChannelViT(nn.Module):
 
         # --------------------------------------------------------------------------
         # MAE encoder specifics
-        self.patch_embed = nn.ModuleList([PatchEmbed(img_size, patch_size, len(group), embed_dim)
-                                          for group in channel_groups])
+        self.patch_embed = GroupChannelsPatchEmbed(img_size, patch_size, channel_groups, embed_dim)
         # self.patch_embed = PatchEmbed(img_size, patch_size, 1, embed_dim)
         num_patches = self.patch_embed[0].num_patches
 
@@ -41,6 +42,8 @@ class MaskedAutoencoderGroupChannelViT(nn.Module):
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim - channel_embed),
                                       requires_grad=False)  # fixed sin-cos embedding
         self.channel_embed = nn.Parameter(torch.zeros(1, num_groups, channel_embed), requires_grad=False)
+        # Fixed, so the combined embeddings are only rebuilt when the parameters are loaded or moved
+        self.pos_channel_embed = CachedEmbed(get_group_pos_channel_embed)
         # self.enc_mask_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
 
         self.blocks = nn.ModuleList([
@@ -61,6 +64,7 @@ class MaskedAutoencoderGroupChannelViT(nn.Module):
         # Extra channel for decoder to represent special place for cls token
         self.decoder_channel_embed = nn.Parameter(torch.zeros(1, num_groups + 1, decoder_channel_embed),
                                                   requires_grad=False)
+        self.decoder_pos_channel_embed = CachedEmbed(get_group_pos_channel_embed_with_cls)
 
         self.decoder_blocks = nn.ModuleList([
             Block(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=True, qk_scale=None, norm_layer=norm_layer)
@@ -183,24 +187,11 @@ class MaskedAutoencoderGroupChannelViT(nn.Module):
         # x is (N, C, H, W)
         b, c, h, w = x.shape
 
-        x_c_embed = []
-        for i, group in enumerate(self.channel_groups):
-            x_c = x[:, group, :, :]
-            x_c_embed.append(self.patch_embed[i](x_c))  # (N, L, D)
-
-        x = torch.stack(x_c_embed, dim=1)  # (N, G, L, D)
+        x = self.patch_embed(x)  # (N, G, L, D)
         _, G, L, D = x.shape
 
-        # add channel embed
-        channel_embed = self.channel_embed.unsqueeze(2)  # (1, G, 1, cD)
-        pos_embed = self.pos_embed[:, 1:, :].unsqueeze(1)  # (1, 1, L, pD)
-
-        # Channel embed same across (x,y) position, and pos embed same across channel (c)
-        channel_embed = channel_embed.expand(-1, -1, pos_embed.shape[2], -1)  # (1, G, L, cD)
-        pos_embed = pos_embed.expand(-1, channel_embed.shape[1], -1, -1)  # (1, G, L, pD)
-        pos_channel = torch.cat((pos_embed, channel_embed), dim=-1)  # (1, G, L, D)
-
-        # add pos embed w/o cls token
+        # add pos and channel embed w/o cls token
+        pos_channel = self.pos_channel_embed(self.pos_embed, self.channel_embed)  # (1, G, L, D)
         x = x + pos_channel  # (N, G, L, D)
 
         if self.spatial_mask:
@@ -250,19 +241,9 @@ class MaskedAutoencoderGroupChannelViT(nn.Module):
             x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
             x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token  (N, 1 + c*L, D)
 
-        # add pos and channel embed
-        channel_embed = self.decoder_channel_embed[:, :-1, :].unsqueeze(2)  # (1, G, 1, cD)
-        pos_embed = self.decoder_pos_embed[:, 1:, :].unsqueeze(1)  # (1, 1, L, pD)
-
-        channel_embed = channel_embed.expand(-1, -1, pos_embed.shape[2], -1)  # (1, G, L, cD)
-        pos_embed = pos_embed.expand(-1, channel_embed.shape[1], -1, -1)  # (1, G, L, pD)
-        pos_channel = torch.cat((pos_embed, channel_embed), dim=-1)  # (1, G, L, D)
-        pos_channel = pos_channel.view(1, -1, pos_channel.shape[-1])  # (1, G*L, D)
-
-        extra = torch.cat((self.decoder_pos_embed[:, :1, :],
-                           self.decoder_channel_embed[:, -1:, :]), dim=-1)  # (1, 1, D)
-
-        pos_channel = torch.cat((extra, pos_channel), dim=1)  # (1, 1+G*L, D)
+        # add pos and channel embed, the extra decoder channel embed is the one of the cls token
+        pos_channel = self.decoder_pos_channel_embed(self.decoder_pos_embed, self.decoder_channel_embed[:, :-1, :],
+                                                     self.decoder_channel_embed[:, -1:, :])  # (1, 1+G*L, D)
         x = x + pos_channel  # (N, 1+G*L, D)
 
         # apply Transformer blocks
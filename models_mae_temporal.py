@@ -13,7 +13,9 @@ from torchvision.utils import save_image
 
 from timm.models.vision_transformer import PatchEmbed, Block
 
-from util.pos_embed import get_2d_sincos_pos_embed, get_1d_sincos_pos_embed_from_grid_torch
+from util.attention import padded_block
+from util.pos_embed import (get_2d_sincos_pos_embed, get_timestamp_embed_table, get_timestamp_embed,
+                            add_temporal_pos_embed)
 
 
 class MaskedAutoencoderViT(nn.Module):
@@ -32,6 +34,8 @@ class MaskedAutoencoderViT(nn.Module):
 
         self.cls_token = nn.Parameter(torch.zeros(1, 1, embed_dim))
         self.pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, embed_dim - 384), requires_grad=False)  # fixed sin-cos embedding
+        # fixed sin-cos embedding of year, month and hour, 128 dims each
+        self.register_buffer('ts_embed_table', get_timestamp_embed_table(128), persistent=False)
 
         self.blocks = nn.ModuleList([
             Block(embed_dim, num_heads, mlp_ratio, qkv_bias=True, qk_scale=None, norm_layer=norm_layer)
@@ -46,6 +50,7 @@ class MaskedAutoencoderViT(nn.Module):
         self.mask_token = nn.Parameter(torch.zeros(1, 1, decoder_embed_dim))
 
         self.decoder_pos_embed = nn.Parameter(torch.zeros(1, num_patches + 1, decoder_embed_dim - 192), requires_grad=False)  # fixed sin-cos embedding
+        self.register_buffer('decoder_ts_embed_table', get_timestamp_embed_table(64), persistent=False)
 
         self.decoder_blocks = nn.ModuleList([
             Block(decoder_embed_dim, decoder_num_heads, mlp_ratio, qkv_bias=True, qk_scale=None, norm_layer=norm_layer)
@@ -119,39 +124,59 @@ class MaskedAutoencoderViT(nn.Module):
         imgs = x.reshape(shape=(x.shape[0], 3, h * p, h * p))
         return imgs
 
-    def random_masking(self, x, mask_ratio, mask=None):
+    def token_pad_mask(self, pad_mask):
+        """
+        pad_mask: [N, T], True for padded frames, or None
+        returns: [N, T*L], True for the tokens of padded frames, or None
+        """
+        if pad_mask is None:
+            return None
+        return pad_mask.repeat_interleave(self.patch_embed.num_patches, dim=1)
+
+    def random_masking(self, x, mask_ratio, mask=None, pad_mask=None):
         """
         Perform per-sample random masking by per-sample shuffling.
         Per-sample shuffling is done by argsort random noise.
-        x: [N, L, D], sequence
+        x: [N, T*L, D], sequence of T frames
+        pad_mask: [N, T], True for padded frames (trailing ones with same_mask), or None
+        With padding, the tokens of padded frames are always removed and every sample keeps (1 - mask_ratio) of
+        its own tokens. x_masked is as long as the longest sample keeps, keep_pad [N, len_keep] marks the slots
+        of the samples that keep fewer (None without padding).
         """
         N, L, D = x.shape  # batch, length, dim
         len_keep = int(L * (1 - mask_ratio))
-        
+        tok_pad = self.token_pad_mask(pad_mask)
+        num_keep = None  # per sample, when it differs from len_keep
+
         noise = torch.rand(N, L, device=x.device)  # noise in [0, 1]
-        
+
         if self.same_mask:
-            L2 = L // 3
-            assert 3 * L2 == L
+            # the same patches of every frame are kept
+            L2 = self.patch_embed.num_patches
+            T = L // L2
+            assert T * L2 == L
+            len_keep2 = int(L2 * (1 - mask_ratio))
+            len_keep = T * len_keep2
             noise = torch.rand(N, L2, device=x.device)  # noise in [0, 1]
             ids_shuffle = torch.argsort(noise, dim=1)
-            ids_shuffle = [ids_shuffle + i * L2 for i in range(3)]
-            ids_shuffle_keep = [z[: ,:int(L2 * (1 - mask_ratio))] for z in ids_shuffle]
-            ids_shuffle_disc = [z[: ,int(L2 * (1 - mask_ratio)):] for z in ids_shuffle]
-            ids_shuffle = []
-            for z in ids_shuffle_keep:
-                ids_shuffle.append(z)
-            for z in ids_shuffle_disc:
-                ids_shuffle.append(z)
-            ids_shuffle = torch.cat(ids_shuffle, dim=1)
-            # print(ids_shuffle[0])
-            # assert False
+            ids_shuffle = [ids_shuffle + i * L2 for i in range(T)]
+            ids_shuffle_keep = [z[:, :len_keep2] for z in ids_shuffle]
+            ids_shuffle_disc = [z[:, len_keep2:] for z in ids_shuffle]
+            ids_shuffle = torch.cat(ids_shuffle_keep + ids_shuffle_disc, dim=1)
+            if pad_mask is not None:
+                # the kept tokens of the trailing padded frames come last
+                num_keep = (~pad_mask).sum(dim=1) * len_keep2
         else:
             if mask is None:
+                if tok_pad is not None:
+                    noise = noise.masked_fill(tok_pad, 2.)  # padded tokens sort after all others
                 # sort noise for each sample
                 ids_shuffle = torch.argsort(noise, dim=1)  # ascend: small is keep, large is remove
             else:
                 ids_shuffle = mask
+            if tok_pad is not None:
+                # the batch is padded to its longest sample, which keeps len_keep
+                num_keep = ((~tok_pad).sum(dim=1).double() * (1 - mask_ratio)).long()
         ids_restore = torch.argsort(ids_shuffle, dim=1)
 
         # keep the first subset
@@ -159,58 +184,52 @@ class MaskedAutoencoderViT(nn.Module):
         x_masked = torch.gather(x, dim=1, index=ids_keep.unsqueeze(-1).repeat(1, 1, D))
 
         # generate the binary mask: 0 is keep, 1 is remove
-        mask = torch.ones([N, L], device=x.device)
-        mask[:, :len_keep] = 0
+        if num_keep is None:
+            mask = torch.ones([N, L], device=x.device)
+            mask[:, :len_keep] = 0
+            keep_pad = None
+        else:
+            mask = (torch.arange(L, device=x.device) >= num_keep.unsqueeze(1)).float()
+            keep_pad = mask[:, :len_keep].bool()
         # unshuffle to get the binary mask
         mask = torch.gather(mask, dim=1, index=ids_restore)
 
-        return x_masked, mask, ids_restore
+        return x_masked, mask, ids_restore, keep_pad
 
-    def forward_encoder(self, x, timestamps, mask_ratio, mask=None):
-        # embed patches
-        x1 = self.patch_embed(x[:, 0])
-        x2 = self.patch_embed(x[:, 1])
-        x3 = self.patch_embed(x[:, 2])
-        x = torch.cat([x1, x2, x3], dim=1)
-        
+    def forward_encoder(self, x, timestamps, mask_ratio, mask=None, pad_mask=None):
+        # embed the patches of all frames in one batch
+        N, T = x.shape[:2]
+        x = self.patch_embed(x.flatten(0, 1))  # (N*T, L, D)
+        L, D = x.shape[1:]
+        x = x.reshape(N, T * L, D)
 
-        # print(timestamps.shape, x.shape)
-        ts_embed = torch.cat([get_1d_sincos_pos_embed_from_grid_torch(128, timestamps.reshape(-1, 3)[:, 0].float()),
-                   get_1d_sincos_pos_embed_from_grid_torch(128, timestamps.reshape(-1, 3)[:, 1].float()),
-                   get_1d_sincos_pos_embed_from_grid_torch(128, timestamps.reshape(-1, 3)[:, 2].float())], dim=1).float()
-        
-        # print(ts_embed, ts_embed.shape)
-        
-        ts_embed = ts_embed.reshape(-1, 3, ts_embed.shape[-1]).unsqueeze(2)
-        # print(ts_embed.shape)
-        ts_embed = ts_embed.expand(-1, -1, x.shape[1] // 3, -1).reshape(x.shape[0], -1, ts_embed.shape[-1])
-        # print(ts_embed.shape)
-        # ts_embed = torch.zeros_like(ts_embed)
-
-
-        # add pos embed w/o cls token
-        x = x + torch.cat([self.pos_embed[:, 1:, :].repeat(ts_embed.shape[0], 3, 1), ts_embed], dim=-1)
+        # add pos embed w/o cls token and the timestamp embed of each frame
+        ts_embed = get_timestamp_embed(self.ts_embed_table, timestamps)  # (N, T, 384)
+        add_temporal_pos_embed(x.view(N, T, L, D), self.pos_embed[:, 1:, :], ts_embed)
 
         # masking: length -> length * mask_ratio
-        x, mask, ids_restore = self.random_masking(x, mask_ratio, mask=mask)
+        x, mask, ids_restore, keep_pad = self.random_masking(x, mask_ratio, mask=mask, pad_mask=pad_mask)
 
         # append cls token
         cls_token = self.cls_token #+ self.pos_embed[:, :1, :]
         cls_tokens = cls_token.expand(x.shape[0], -1, -1)
         x = torch.cat((cls_tokens, x), dim=1)
-        # print(x.dtype)
+        if keep_pad is not None:
+            keep_pad = torch.cat((keep_pad.new_zeros(N, 1), keep_pad), dim=1)
 
-        # apply Transformer blocks
+        # apply Transformer blocks, no token attends to the unused slots
         for blk in self.blocks:
-            # print(x.dtype)
-            x = blk(x)
+            x = padded_block(blk, x, keep_pad)
         x = self.norm(x)
 
-        return x, mask, ids_restore
+        return x, mask, ids_restore, keep_pad
 
-    def forward_decoder(self, x, timestamps, ids_restore):
+    def forward_decoder(self, x, timestamps, ids_restore, keep_pad=None, pad_mask=None):
         # embed tokens
         x = self.decoder_embed(x)
+        if keep_pad is not None:
+            # unused slots hold removed tokens, which the decoder sees as mask tokens
+            x = torch.where(keep_pad.unsqueeze(-1), self.mask_token, x)
 
         # append mask tokens to sequence
         mask_tokens = self.mask_token.repeat(x.shape[0], ids_restore.shape[1] + 1 - x.shape[1], 1)
@@ -218,26 +237,19 @@ class MaskedAutoencoderViT(nn.Module):
         x_ = torch.gather(x_, dim=1, index=ids_restore.unsqueeze(-1).repeat(1, 1, x.shape[2]))  # unshuffle
         x = torch.cat([x[:, :1, :], x_], dim=1)  # append cls token
 
-
-        ts_embed = torch.cat([get_1d_sincos_pos_embed_from_grid_torch(64, timestamps.reshape(-1, 3)[:, 0].float()),
-                   get_1d_sincos_pos_embed_from_grid_torch(64, timestamps.reshape(-1, 3)[:, 1].float()),
-                   get_1d_sincos_pos_embed_from_grid_torch(64, timestamps.reshape(-1, 3)[:, 2].float())], dim=1).float()
-        
-        ts_embed = ts_embed.reshape(-1, 3, ts_embed.shape[-1]).unsqueeze(2)
-        ts_embed = ts_embed.expand(-1, -1, x.shape[1] // 3, -1).reshape(x.shape[0], -1, ts_embed.shape[-1])
-
-        ts_embed = torch.cat([torch.zeros((ts_embed.shape[0], 1, ts_embed.shape[2]), device=ts_embed.device), ts_embed], dim=1)
-
-        # ts_embed = torch.zeros_like(ts_embed)
-
-        # add pos embed
-        x = x + torch.cat(
-            [torch.cat([self.decoder_pos_embed[:, :1, :], self.decoder_pos_embed[:, 1:, :].repeat(1, 3, 1)], dim=1).expand(ts_embed.shape[0], -1, -1),
-             ts_embed], dim=-1)
-
-        # apply Transformer blocks
+        # add pos embed, the cls token has no timestamp embed
+        N, T = timestamps.shape[:2]
+        pD = self.decoder_pos_embed.shape[-1]
+        ts_embed = get_timestamp_embed(self.decoder_ts_embed_table, timestamps)  # (N, T, 192)
+        x[:, :1, :pD] += self.decoder_pos_embed[:, :1, :]
+        add_temporal_pos_embed(x[:, 1:, :].view(N, T, -1, x.shape[2]), self.decoder_pos_embed[:, 1:, :], ts_embed)
+
+        # apply Transformer blocks, no token attends to padded frames
+        tok_pad = self.token_pad_mask(pad_mask)
+        if tok_pad is not None:
+            tok_pad = torch.cat((tok_pad.new_zeros(N, 1), tok_pad), dim=1)
         for blk in self.decoder_blocks:
-            x = blk(x)
+            x = padded_block(blk, x, tok_pad)
         x = self.decoder_norm(x)
 
         # predictor projection
@@ -248,16 +260,16 @@ class MaskedAutoencoderViT(nn.Module):
 
         return x
 
-    def forward_loss(self, imgs, pred, mask):
+    def forward_loss(self, imgs, pred, mask, pad_mask=None):
         """
-        imgs: [N, 3, H, W]
-        pred: [N, L, p*p*3]
-        mask: [N, L], 0 is keep, 1 is remove, 
+        imgs: [N, T, 3, H, W]
+        pred: [N, T*L, p*p*3]
+        mask: [N, T*L], 0 is keep, 1 is remove, 
+        pad_mask: [N, T], True for padded frames, which are not part of the loss, or None
         """
-        target1 = self.patchify(imgs[:, 0])
-        target2 = self.patchify(imgs[:, 1])
-        target3 = self.patchify(imgs[:, 2])
-        target = torch.cat([target1, target2, target3], dim=1)
+        N, T = imgs.shape[:2]
+        target = self.patchify(imgs.flatten(0, 1))  # (N*T, L, p*p*3)
+        target = target.reshape(N, -1, target.shape[-1])  # frames one after another
         previous_target = target
         if self.norm_pix_loss:
             mean = target.mean(dim=-1, keepdim=True)
@@ -298,13 +310,22 @@ class MaskedAutoencoderViT(nn.Module):
         loss = (pred - target) ** 2
         loss = loss.mean(dim=-1)  # [N, L], mean loss per patch
 
+        if pad_mask is not None:
+            mask = mask.masked_fill(self.token_pad_mask(pad_mask), 0)
         loss = (loss * mask).sum() / mask.sum()  # mean loss on removed patches
         return loss
 
-    def forward(self, imgs, timestamps, mask_ratio=0.75, mask=None):
-        latent, mask, ids_restore = self.forward_encoder(imgs, timestamps, mask_ratio, mask=mask)
-        pred = self.forward_decoder(latent, timestamps, ids_restore)  # [N, L, p*p*3]
-        loss = self.forward_loss(imgs, pred, mask)
+    def forward(self, imgs, timestamps, mask_ratio=0.75, mask=None, pad_mask=None):
+        """
+        imgs: [N, T, 3, H, W], frames padded to a common T
+        timestamps: [N, T, 3]
+        pad_mask: [N, T], True for padded frames, None when nothing is padded
+        """
+        latent, mask, ids_restore, keep_pad = self.forward_encoder(imgs, timestamps, mask_ratio, mask=mask,
+                                                                   pad_mask=pad_mask)
+        pred = self.forward_decoder(latent, timestamps, ids_restore, keep_pad=keep_pad,
+                                    pad_mask=pad_mask)  # [N, T*L, p*p*3]
+        loss = self.forward_loss(imgs, pred, mask, pad_mask=pad_mask)
         return loss, pred, mask
 
 
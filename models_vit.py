@@ -11,7 +11,8 @@ import torch
 import torch.nn as nn
 
 import timm.models.vision_transformer
-from util.pos_embed import get_2d_sincos_pos_embed
+from util.patch_embed import embed_patches, patch_grid_size
+from util.pos_embed import CachedEmbed, get_2d_sincos_pos_embed, resize_pos_embed
 
 
 class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
@@ -24,6 +25,8 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
         pos_embed = get_2d_sincos_pos_embed(self.pos_embed.shape[-1], int(self.patch_embed.num_patches ** .5),
                                             cls_token=True)
         self.pos_embed.data.copy_(torch.from_numpy(pos_embed).float().unsqueeze(0))
+        # pos_embed interpolated to the patch grid of other input sizes, kept per grid size for evaluation
+        self.resized_pos_embed = CachedEmbed(resize_pos_embed)
 
         self.global_pool = global_pool
         if self.global_pool:
@@ -35,11 +38,12 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
 
     def forward_features(self, x):
         B = x.shape[0]
-        x = self.patch_embed(x)
+        grid_size = patch_grid_size(x, self.patch_embed.patch_size)
+        x = embed_patches(self.patch_embed, x)  # any input size divisible by the patch size
 
         cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
         x = torch.cat((cls_tokens, x), dim=1)
-        x = x + self.pos_embed
+        x = x + self.resized_pos_embed(self.pos_embed, grid_size)
         x = self.pos_drop(x)
 
         for blk in self.blocks:
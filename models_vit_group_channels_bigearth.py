@@ -10,8 +10,9 @@ import torch
 import torch.nn as nn
 
 import timm.models.vision_transformer
-from timm.models.vision_transformer import PatchEmbed
-from util.pos_embed import get_2d_sincos_pos_embed, get_1d_sincos_pos_embed_from_grid
+from util.patch_embed import GroupChannelsPatchEmbed
+from util.pos_embed import (CachedEmbed, get_2d_sincos_pos_embed, get_1d_sincos_pos_embed_from_grid,
+                             get_group_pos_channel_embed_with_cls)
 
 
 class GroupChannelsVisionTransformer(timm.models.vision_transformer.VisionTransformer):
@@ -27,8 +28,7 @@ class GroupChannelsVisionTransformer(timm.models.vision_transformer.VisionTransf
 
         self.channel_groups = channel_groups
 
-        self.patch_embed = nn.ModuleList([PatchEmbed(img_size, patch_size, len(group), embed_dim)
-                                          for group in channel_groups])
+        self.patch_embed = GroupChannelsPatchEmbed(img_size, patch_size, channel_groups, embed_dim)
         # self.patch_embed = PatchEmbed(img_size, patch_size, 1, embed_dim)
         num_patches = self.patch_embed[0].num_patches
 
@@ -46,6 +46,9 @@ class GroupChannelsVisionTransformer(timm.models.vision_transformer.VisionTransf
         self.channel_cls_embed = nn.Parameter(torch.zeros(1, 1, channel_embed))
         channel_cls_embed = torch.zeros((1, channel_embed))
         self.channel_cls_embed.data.copy_(channel_cls_embed.float().unsqueeze(0))
+        # Rebuilt on every training step while the embeddings are trained, reused for evaluation (per grid size
+        # of the input, pos_embed is interpolated for other input sizes)
+        self.pos_channel_embed = CachedEmbed(get_group_pos_channel_embed_with_cls)
 
         self.global_pool = global_pool
         if self.global_pool:
@@ -58,31 +61,18 @@ class GroupChannelsVisionTransformer(timm.models.vision_transformer.VisionTransf
     def forward_features(self, x):
         b, c, h, w = x.shape
 
-        x_c_embed = []
-        for i, group in enumerate(self.channel_groups):
-            x_c = x[:, group, :, :]
-            x_c_embed.append(self.patch_embed[i](x_c))  # (N, L, D)
-
-        x = torch.stack(x_c_embed, dim=1)  # (N, G, L, D)
+        x = self.patch_embed(x)  # (N, G, L, D), any input size divisible by the patch size
         _, G, L, D = x.shape
 
-        # add channel embed
-        channel_embed = self.channel_embed.unsqueeze(2)  # (1, c, 1, cD)
-        pos_embed = self.pos_embed[:, 1:, :].unsqueeze(1)  # (1, 1, L, pD)
-
-        # Channel embed same across (x,y) position, and pos embed same across channel (c)
-        channel_embed = channel_embed.expand(-1, -1, pos_embed.shape[2], -1)  # (1, c, L, cD)
-        pos_embed = pos_embed.expand(-1, channel_embed.shape[1], -1, -1)  # (1, c, L, pD)
-        pos_channel = torch.cat((pos_embed, channel_embed), dim=-1)  # (1, c, L, D)
-
-        # add pos embed w/o cls token
-        x = x + pos_channel  # (N, G, L, D)
+        # pos and channel embed, cls token first
+        grid_size = (h // self.patch_embed.patch_size[0], w // self.patch_embed.patch_size[1])
+        pos_channel = self.pos_channel_embed(self.pos_embed, self.channel_embed, self.channel_cls_embed,
+                                             grid_size)  # (1, 1 + G*L, D)
         x = x.view(b, -1, D)  # (N, G*L, D)
 
-        cls_pos_channel = torch.cat((self.pos_embed[:, :1, :], self.channel_cls_embed), dim=-1)  # (1, 1, D)
         # stole cls_tokens impl from Phil Wang, thanks
-        cls_tokens = cls_pos_channel + self.cls_token.expand(b, -1, -1)
-        x = torch.cat((cls_tokens, x), dim=1)  # (N, 1 + c*L, D)
+        cls_tokens = self.cls_token.expand(b, -1, -1)
+        x = torch.cat((cls_tokens, x), dim=1) + pos_channel  # (N, 1 + G*L, D)
         x = self.pos_drop(x)
 
         for blk in self.blocks:
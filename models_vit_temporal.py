@@ -12,7 +12,10 @@ import torch.nn as nn
 
 import timm.models.vision_transformer
 
-from util.pos_embed import get_2d_sincos_pos_embed, get_1d_sincos_pos_embed_from_grid_torch
+from util.attention import padded_block
+from util.patch_embed import embed_patches, patch_grid_size
+from util.pos_embed import (CachedEmbed, get_timestamp_embed_table, get_timestamp_embed, add_temporal_pos_embed,
+                            resize_pos_embed)
 
 
 class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
@@ -22,6 +25,10 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
         super(VisionTransformer, self).__init__(**kwargs)
 
         self.pos_embed = nn.Parameter(torch.zeros(1, self.patch_embed.num_patches + 1, kwargs['embed_dim'] - 384))
+        # fixed sin-cos embedding of year, month and hour, 128 dims each
+        self.register_buffer('ts_embed_table', get_timestamp_embed_table(128), persistent=False)
+        # pos_embed interpolated to the patch grid of other input sizes, kept per grid size for evaluation
+        self.resized_pos_embed = CachedEmbed(resize_pos_embed)
 
         self.global_pool = global_pool
         if self.global_pool:
@@ -31,38 +38,47 @@ class VisionTransformer(timm.models.vision_transformer.VisionTransformer):
 
             del self.norm  # remove the original norm
 
-    def forward(self, x, timestamps):
-        x = self.forward_features(x, timestamps)
+    def forward(self, x, timestamps, pad_mask=None):
+        """
+        x: (B, T, 3, H, W), frames padded to a common T
+        timestamps: (B, T, 3)
+        pad_mask: (B, T), True for padded frames, None when nothing is padded
+        """
+        x = self.forward_features(x, timestamps, pad_mask=pad_mask)
         x = self.head(x)
         return x
 
-    def forward_features(self, x, timestamps):
-        
-        B = x.shape[0]
-        x1 = self.patch_embed(x[:, 0])
-        x2 = self.patch_embed(x[:, 1])
-        x3 = self.patch_embed(x[:, 2])
-        x = torch.cat([x1, x2, x3], dim=1)
-        ts_embed = torch.cat([get_1d_sincos_pos_embed_from_grid_torch(128, timestamps.reshape(-1, 3)[:, 0].float()),
-                            get_1d_sincos_pos_embed_from_grid_torch(128, timestamps.reshape(-1, 3)[:, 1].float()),
-                            get_1d_sincos_pos_embed_from_grid_torch(128, timestamps.reshape(-1, 3)[:, 2].float())], dim=1).float()        
-        ts_embed = ts_embed.reshape(-1, 3, ts_embed.shape[-1]).unsqueeze(2)
-        ts_embed = ts_embed.expand(-1, -1, x.shape[1] // 3, -1).reshape(x.shape[0], -1, ts_embed.shape[-1])
-        ts_embed = torch.cat([torch.zeros((ts_embed.shape[0], 1, ts_embed.shape[2]), device=ts_embed.device), ts_embed], dim=1)
-        
-        cls_tokens = self.cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
-        x = torch.cat((cls_tokens, x), dim=1)
-        x = x + torch.cat(
-            [torch.cat([self.pos_embed[:, :1, :], self.pos_embed[:, 1:, :].repeat(1, 3, 1)], dim=1).expand(ts_embed.shape[0], -1, -1),
-             ts_embed], dim=-1)
-        
+    def forward_features(self, x, timestamps, pad_mask=None):
+        # embed the patches of all frames in one batch
+        B, T = x.shape[:2]
+        pos_embed = self.resized_pos_embed(self.pos_embed, patch_grid_size(x, self.patch_embed.patch_size))
+        x = embed_patches(self.patch_embed, x.flatten(0, 1))  # (B*T, L, D), any size divisible by the patch size
+        L, D = x.shape[1:]
+
+        # the cls token gets the cls slot of pos_embed and no timestamp embed
+        pD = pos_embed.shape[-1]
+        cls_token = torch.cat((self.cls_token[:, :, :pD] + pos_embed[:, :1, :], self.cls_token[:, :, pD:]), dim=-1)
+        cls_tokens = cls_token.expand(B, -1, -1)  # stole cls_tokens impl from Phil Wang, thanks
+        x = torch.cat((cls_tokens, x.reshape(B, T * L, D)), dim=1)
+
+        ts_embed = get_timestamp_embed(self.ts_embed_table, timestamps)  # (B, T, 384)
+        add_temporal_pos_embed(x[:, 1:, :].view(B, T, L, D), pos_embed[:, 1:, :], ts_embed)
+
         x = self.pos_drop(x)
 
+        # no token attends to the tokens of padded frames
+        tok_pad = None
+        if pad_mask is not None:
+            tok_pad = torch.cat((pad_mask.new_zeros(B, 1), pad_mask.repeat_interleave(L, dim=1)), dim=1)
         for blk in self.blocks:
-            x = blk(x)
+            x = padded_block(blk, x, tok_pad)
 
         if self.global_pool:
-            x = x[:, 1:, :].mean(dim=1)  # global pool without cls token
+            if tok_pad is None:
+                x = x[:, 1:, :].mean(dim=1)  # global pool without cls token
+            else:
+                keep = (~tok_pad[:, 1:]).unsqueeze(-1).to(x.dtype)
+                x = (x[:, 1:, :] * keep).sum(dim=1) / keep.sum(dim=1)  # ... and padded frames
             outcome = self.fc_norm(x)
         else:
             x = self.norm(x)
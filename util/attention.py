@@ -0,0 +1,175 @@
+"""
+Fused attention for the timm transformer blocks of all ViT and MAE models.
+
+timm's Attention computes softmax(QK^T)V explicitly and keeps the (B, heads, N, N) score matrix, and a copy per
+operation, in memory. FusedAttention computes the same with torch.nn.functional.scaled_dot_product_attention
+(torch >= 2.0), which picks a flash / memory-efficient kernel and never materializes the full matrix. It is a
+subclass with the same qkv / proj parameters, so checkpoints load unchanged in either direction. On older torch
+versions it falls back to the explicit computation.
+
+    model = use_fused_attention(model)
+
+switches every Attention module of a built model (--fused_attn in the main_*.py scripts).
+
+padded_block runs a transformer block on a batch of sequences padded to a common length (the temporal models
+with --variable_frames): no token attends to the padded ones, with either attention implementation.
+The CPU cost of both paths at the sequence lengths of the models is measured with:
+    python -m util.attention --batch_size 8 --seq_lens 50 109 197 433 589
+"""
+import argparse
+import time
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from timm.models.vision_transformer import Attention, Block
+
+
+HAS_SDPA = hasattr(F, 'scaled_dot_product_attention')
+
+
+class FusedAttention(Attention):
+    def forward(self, x):
+        if not HAS_SDPA:
+            return super().forward(x)
+
+        B, N, C = x.shape
+        head_dim = C // self.num_heads
+        qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, head_dim).permute(2, 0, 3, 1, 4)
+        q, k, v = qkv[0], qkv[1], qkv[2]
+        if self.scale != head_dim ** -0.5:  # qk_scale was set, SDPA scales by head_dim ** -0.5
+            q = q * (self.scale * head_dim ** 0.5)
+
+        x = F.scaled_dot_product_attention(q, k, v, dropout_p=self.attn_drop.p if self.training else 0.)
+        x = x.transpose(1, 2).reshape(B, N, C)
+        x = self.proj(x)
+        x = self.proj_drop(x)
+        return x
+
+
+def padded_attention(attn: Attention, x, pad_mask):
+    """
+    Forward of an Attention or FusedAttention module in which no token attends to the padded tokens.
+    :param x: (B, N, C) tokens
+    :param pad_mask: (B, N) bool, True for padded tokens
+    :return: (B, N, C) output, the rows of padded tokens included
+    """
+    B, N, C = x.shape
+    head_dim = C // attn.num_heads
+    qkv = attn.qkv(x).reshape(B, N, 3, attn.num_heads, head_dim).permute(2, 0, 3, 1, 4)
+    q, k, v = qkv[0], qkv[1], qkv[2]
+    if isinstance(attn, FusedAttention) and HAS_SDPA:
+        if attn.scale != head_dim ** -0.5:
+            q = q * (attn.scale * head_dim ** 0.5)
+        x = F.scaled_dot_product_attention(q, k, v, attn_mask=~pad_mask[:, None, None, :],
+                                           dropout_p=attn.attn_drop.p if attn.training else 0.)
+    else:
+        scores = (q @ k.transpose(-2, -1)) * attn.scale
+        scores = scores.masked_fill(pad_mask[:, None, None, :], float('-inf'))
+        x = attn.attn_drop(scores.softmax(dim=-1)) @ v
+    x = x.transpose(1, 2).reshape(B, N, C)
+    x = attn.proj(x)
+    x = attn.proj_drop(x)
+    return x
+
+
+def padded_block(blk: Block, x, pad_mask=None):
+    """
+    Forward of a timm Block whose attention skips padded tokens, see padded_attention.
+    :param x: (B, N, C) tokens
+    :param pad_mask: (B, N) bool, True for padded tokens, None when nothing is padded (plain blk(x))
+    :return: (B, N, C) output
+    """
+    if pad_mask is None:
+        return blk(x)
+    x = x + blk.drop_path(padded_attention(blk.attn, blk.norm1(x), pad_mask))
+    x = x + blk.drop_path(blk.mlp(blk.norm2(x)))
+    return x
+
+
+def use_fused_attention(model: nn.Module) -> nn.Module:
+    """
+    Switches every timm Attention module of model to FusedAttention in place, keeping its parameters.
+    :return: model
+    """
+    for module in model.modules():
+        if type(module) is Attention:
+            module.__class__ = FusedAttention
+    return model
+
+
+def peak_memory(fn) -> int:
+    """
+    :return: Peak CPU memory allocated by torch while running fn, in bytes
+    """
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda e: e.time_range.start):
+        current += event.self_cpu_memory_usage  # without the allocations of nested ops, counted on their own
+        peak = max(peak, current)
+    return peak
+
+
+def benchmark_block(dim: int, num_heads: int, batch_size: int, seq_len: int, fused: bool, backward: bool,
+                    repeats: int = 5):
+    """
+    :return: Mean latency (ms) and peak memory (MB) of a forward (and backward) pass of one transformer block
+    """
+    torch.manual_seed(0)
+    block = Block(dim, num_heads, mlp_ratio=4., qkv_bias=True)
+    if fused:
+        use_fused_attention(block)
+    x = torch.randn(batch_size, seq_len, dim, requires_grad=backward)
+
+    def step():
+        with torch.set_grad_enabled(backward):
+            out = block(x)
+            if backward:
+                out.sum().backward()
+
+    step()  # warm up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    latency = (time.perf_counter() - start) / repeats * 1000
+    return latency, peak_memory(step) / 2 ** 20
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Explicit vs fused attention CPU benchmark', add_help=False)
+    parser.add_argument('--models', default=['base', 'large'], nargs='+', choices=['base', 'large', 'huge'])
+    parser.add_argument('--batch_size', default=8, type=int)
+    parser.add_argument('--seq_lens', default=[50, 109, 197, 433, 589], type=int, nargs='+',
+                        help='Token counts: MAE encoders at mask ratio 0.75 (50, 109), ViT 224/16 (197), '
+                             'group_c 96/8 with 3 groups (433), temporal 3 frames (589)')
+    parser.add_argument('--backward', action='store_true', default=False,
+                        help='Time forward and backward passes (training) instead of forward only')
+    parser.add_argument('--repeats', default=5, type=int)
+    parser.add_argument('--num_threads', default=None, type=int)
+    return parser
+
+
+def main(args):
+    if not HAS_SDPA:
+        print(f'torch {torch.__version__} has no scaled_dot_product_attention, FusedAttention falls back to '
+              f'the explicit computation')
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    sizes = {'base': (768, 12), 'large': (1024, 16), 'huge': (1280, 16)}
+
+    print(f"{'model':>6} {'tokens':>6} | {'explicit ms':>11} {'fused ms':>9} {'speedup':>7} | "
+          f"{'explicit MB':>11} {'fused MB':>9}")
+    for name in args.models:
+        dim, num_heads = sizes[name]
+        for seq_len in args.seq_lens:
+            explicit = benchmark_block(dim, num_heads, args.batch_size, seq_len, False, args.backward, args.repeats)
+            fused = benchmark_block(dim, num_heads, args.batch_size, seq_len, True, args.backward, args.repeats)
+            print(f'{name:>6} {seq_len:>6} | {explicit[0]:>11.1f} {fused[0]:>9.1f} {explicit[0] / fused[0]:>6.2f}x | '
+                  f'{explicit[1]:>11.1f} {fused[1]:>9.1f}')
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,209 @@
+"""
+Per-band statistics of a multi-spectral dataset.
+
+Streams every image of a dataset csv (or a random subsample) through mergeable accumulators in several
+processes: Welford/Chan updates for mean and std, running min/max, and a histogram of the integer pixel values,
+from which percentiles are exact. Nothing but the accumulators is kept in memory.
+
+    python -m util.band_stats --dataset_type sentinel --csv_path <train.csv>
+
+writes <csv dir>/<csv name>_band_stats.json. Pass it with --band_stats to use its mean/std instead of the
+hard-coded per-band constants of the dataset class.
+"""
+import argparse
+import json
+import os
+import random
+from multiprocessing import Pool
+
+import numpy as np
+
+
+def default_stats_path(csv_path: str) -> str:
+    """
+    Default location of the stats of a csv: <csv dir>/<csv name>_band_stats.json
+    """
+    return os.path.splitext(csv_path)[0] + '_band_stats.json'
+
+
+class BandStats:
+    def __init__(self, num_bands: int):
+        """
+        Mergeable per-band accumulator over all pixels of the images added to it.
+        :param num_bands: Number of bands of the images
+        """
+        self.num_bands = num_bands
+        self.count = 0  # pixels per band
+        self.mean = np.zeros(num_bands, dtype=np.float64)
+        self.m2 = np.zeros(num_bands, dtype=np.float64)  # sum of squared deviations from the mean
+        self.min = np.full(num_bands, np.inf)
+        self.max = np.full(num_bands, -np.inf)
+        self.hist = np.zeros((num_bands, 0), dtype=np.int64)  # hist[b, v]: pixels of band b with value v
+        self.num_images = 0
+
+    def add(self, img: np.ndarray):
+        """
+        :param img: (c, h, w) image with non-negative integer values
+        """
+        if img.shape[0] != self.num_bands:
+            raise ValueError(f'Expected {self.num_bands} bands, got an image of shape {img.shape}')
+        if not np.issubdtype(img.dtype, np.integer):
+            raise ValueError(f'Exact percentiles need integer images, got {img.dtype}')
+        pixels = img.reshape(self.num_bands, -1)
+
+        other = BandStats(self.num_bands)
+        other.count = pixels.shape[1]
+        other.mean = pixels.mean(axis=1, dtype=np.float64)
+        other.m2 = ((pixels - other.mean[:, None]) ** 2).sum(axis=1)
+        other.min = pixels.min(axis=1).astype(np.float64)
+        other.max = pixels.max(axis=1).astype(np.float64)
+        if other.min.min() < 0:
+            raise ValueError('Exact percentiles need non-negative pixel values')
+        size = int(other.max.max()) + 1
+        other.hist = np.stack([np.bincount(band, minlength=size) for band in pixels]).astype(np.int64)
+        other.num_images = 1
+        self.merge(other)
+
+    def merge(self, other: 'BandStats'):
+        """
+        Adds the pixels accumulated by other (Chan et al.'s parallel variance update).
+        """
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        self.min = np.minimum(self.min, other.min)
+        self.max = np.maximum(self.max, other.max)
+
+        size = max(self.hist.shape[1], other.hist.shape[1])
+        hist = np.zeros((self.num_bands, size), dtype=np.int64)
+        hist[:, :self.hist.shape[1]] += self.hist
+        hist[:, :other.hist.shape[1]] += other.hist
+        self.hist = hist
+        self.num_images += other.num_images
+
+    @property
+    def std(self) -> np.ndarray:
+        """
+        :return: (num_bands,) population standard deviation
+        """
+        return np.sqrt(self.m2 / max(self.count, 1))
+
+    def percentile(self, q: float) -> np.ndarray:
+        """
+        Same as np.percentile(pixels, q, axis=1) (linear interpolation) over all accumulated pixels.
+        :return: (num_bands,) q-th percentile of every band
+        """
+        pos = q / 100. * (self.count - 1)
+        lo = int(np.floor(pos))
+        hi = min(lo + 1, self.count - 1)
+        cumsum = self.hist.cumsum(axis=1)
+        # k-th smallest value: first value whose cumulative count exceeds k
+        lo_value = np.array([np.searchsorted(c, lo, side='right') for c in cumsum], dtype=np.float64)
+        hi_value = np.array([np.searchsorted(c, hi, side='right') for c in cumsum], dtype=np.float64)
+        return lo_value + (hi_value - lo_value) * (pos - lo)
+
+    def to_dict(self, percentiles=()) -> dict:
+        return {
+            'num_images': self.num_images,
+            'num_pixels': self.count,
+            'mean': self.mean.tolist(),
+            'std': self.std.tolist(),
+            'min': self.min.tolist(),
+            'max': self.max.tolist(),
+            'percentiles': {str(q): self.percentile(q).tolist() for q in percentiles},
+        }
+
+
+def load_band_stats(path: str, num_bands: int):
+    """
+    :param path: Stats file written by `python -m util.band_stats`
+    :param num_bands: Number of bands the dataset reads
+    :return: Per-band mean and std lists
+    """
+    with open(path) as f:
+        stats = json.load(f)
+    if len(stats['mean']) != num_bands:
+        raise ValueError(f"{path} has stats of {len(stats['mean'])} bands, the dataset has {num_bands}")
+    return stats['mean'], stats['std']
+
+
+def _accumulate(item):
+    read_fn, paths, num_bands = item
+    stats = BandStats(num_bands)
+    for path in paths:
+        img = read_fn(path)
+        if img is not None:  # e.g. BigEarthNet patch paths that are not folders
+            stats.add(img)
+    return stats
+
+
+def compute_band_stats(paths, read_fn, num_bands: int, num_workers=8, chunk_size=64) -> BandStats:
+    """
+    Accumulates the stats of every image in parallel.
+    :param paths: Image paths
+    :param read_fn: Picklable function mapping a path to its (c, h, w) integer array
+    :param num_bands: Number of bands of the images
+    :param num_workers: Number of reader processes
+    :param chunk_size: Images accumulated by a worker before its partial stats are merged
+    """
+    chunks = [(read_fn, paths[i:i + chunk_size], num_bands) for i in range(0, len(paths), chunk_size)]
+    stats = BandStats(num_bands)
+    with Pool(num_workers) as pool:
+        for partial in pool.imap_unordered(_accumulate, chunks):
+            stats.merge(partial)
+            print(f'Read {stats.num_images}/{len(paths)} images')
+    return stats
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Per-band statistics of a multi-spectral dataset', add_help=False)
+    parser.add_argument('--dataset_type', default='sentinel', choices=['sentinel', 'bigearthnet', 'euro_sat'],
+                        help='Which dataset the csv belongs to.')
+    parser.add_argument('--csv_path', required=True, type=str,
+                        help='Dataset .csv path (.txt file list for euro_sat)')
+    parser.add_argument('--out_path', default=None, type=str,
+                        help='Output .json path, defaults to <csv dir>/<csv name>_band_stats.json')
+    parser.add_argument('--max_images', default=None, type=int,
+                        help='Random subsample of images to compute the stats on, all images if not set')
+    parser.add_argument('--percentiles', default=[1, 2, 50, 98, 99], type=float, nargs='+')
+    parser.add_argument('--num_workers', default=8, type=int)
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed of the subsample')
+    return parser
+
+
+def main(args):
+    from util.datasets import BigEarthNetImageDataset, EuroSat, SentinelIndividualImageDataset
+
+    if args.dataset_type == 'sentinel':
+        dataset = SentinelIndividualImageDataset(args.csv_path, None)
+        paths = [dataset.image_paths[i] for i in range(len(dataset))]
+    elif args.dataset_type == 'bigearthnet':
+        dataset = BigEarthNetImageDataset(args.csv_path, None)
+        paths = [dataset.patch_paths[i] for i in range(len(dataset))]
+    elif args.dataset_type == 'euro_sat':
+        dataset = EuroSat(args.csv_path, None)
+        paths = dataset.img_paths
+    else:
+        raise ValueError(f"Invalid dataset type: {args.dataset_type}")
+
+    if args.max_images is not None and args.max_images < len(paths):
+        paths = random.Random(args.seed).sample(paths, args.max_images)
+
+    stats = compute_band_stats(paths, dataset.read_raw, len(dataset.mean), num_workers=args.num_workers)
+    stats = dict(stats.to_dict(args.percentiles), dataset_type=args.dataset_type, csv_path=args.csv_path)
+
+    out_path = args.out_path or default_stats_path(args.csv_path)
+    with open(out_path, 'w') as f:
+        json.dump(stats, f, indent=1)
+    print(f"Wrote stats of {stats['num_images']} images to {out_path}")
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,191 @@
+"""
+Batched augmentation on the training device.
+
+With --batch_aug the GeoTIFF datasets skip their per-sample transform and return the raw (c, h, w)
+integer tile. raw_collate pads the tiles of a batch to a common size and BatchAugment then does the
+normalization, random resized crop / center crop, resize and horizontal flip of build_transform for the
+whole (B, C, H, W) batch at once, after it was moved to the model's device.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+
+from util.datasets import EuroSat, SentinelIndividualImageDataset, SentinelStreamDataset, kept_bands
+
+
+class RawBatch:
+    def __init__(self, images: torch.Tensor, sizes: torch.Tensor):
+        """
+        Batch of raw tiles padded to a common size.
+        :param images: (B, C, H, W) integer tensor, uint16 data is carried as int16 bits
+        :param sizes: (B, 2) height and width of each tile before padding
+        """
+        self.images = images
+        self.sizes = sizes
+
+    def __len__(self):
+        return len(self.images)
+
+    def to(self, device, non_blocking=False):
+        return RawBatch(self.images.to(device, non_blocking=non_blocking), self.sizes)
+
+    def pin_memory(self):
+        return RawBatch(self.images.pin_memory(), self.sizes)
+
+
+def raw_collate(batch):
+    """
+    collate_fn for datasets returning (raw (c, h, w) tile, target).
+    Tiles smaller than the largest one are edge-padded, so resampling near their border matches the unpadded tile.
+    :return: RawBatch, collated targets
+    """
+    images = [sample[0] for sample in batch]
+    height = max(img.shape[1] for img in images)
+    width = max(img.shape[2] for img in images)
+    sizes = torch.tensor([img.shape[1:] for img in images], dtype=torch.int64)
+
+    out = images[0].new_empty((len(images), images[0].shape[0], height, width))
+    for i, img in enumerate(images):
+        if img.shape[1:] != (height, width):
+            pad = ((0, 0), (0, height - img.shape[1]), (0, width - img.shape[2]))
+            img = torch.from_numpy(np.pad(img.numpy(), pad, mode='edge'))
+        out[i] = img
+
+    targets = default_collate([sample[1] for sample in batch])
+    return RawBatch(out, sizes), targets
+
+
+class BatchAugment:
+    def __init__(self, is_train: bool, input_size: int, mean, std, sentinel_norm: bool = True,
+                 masked_bands=None, scale=(0.2, 1.0), ratio=(3. / 4., 4. / 3.)):
+        """
+        Batched version of the train/eval transforms in build_transform.
+        :param is_train: Random resized crop + horizontal flip if True, resize + center crop otherwise
+        :param input_size: Output height and width
+        :param mean: Per-channel mean of the channels in the batch
+        :param std: Per-channel std of the channels in the batch
+        :param sentinel_norm: Use SentinelNormalize (+ ToTensor scaling to [0, 1]) instead of Normalize
+        :param masked_bands: Channel positions (in the batch) to overwrite with their mean
+        :param scale: Range of the crop area relative to the image area (train only)
+        :param ratio: Range of the crop aspect ratio (train only)
+        """
+        self.is_train = is_train
+        self.input_size = input_size
+        self.mean = torch.tensor(mean, dtype=torch.float32)
+        self.std = torch.tensor(std, dtype=torch.float32)
+        self.sentinel_norm = sentinel_norm
+        self.masked_bands = masked_bands
+        self.scale = scale
+        self.ratio = ratio
+
+    def normalize(self, x):
+        mean = self.mean.to(x.device).view(1, -1, 1, 1)
+        std = self.std.to(x.device).view(1, -1, 1, 1)
+        if self.masked_bands:
+            x[:, self.masked_bands] = mean[:, self.masked_bands]
+
+        if self.sentinel_norm:
+            min_value = mean - 2 * std
+            max_value = mean + 2 * std
+            x = (x - min_value) / (max_value - min_value) * 255.0
+            return x.clamp_(0, 255).floor_().div_(255.)  # uint8 cast, then ToTensor scaling
+        return (x - mean) / std
+
+    def random_crops(self, sizes):
+        """
+        RandomResizedCrop.get_params for every tile at once: 10 candidate crops each, the first that fits is
+        used, falling back to a central crop.
+        :param sizes: (B, 2) tile heights and widths
+        :return: (B, 4) float tensor of crop top, left, height, width
+        """
+        n = len(sizes)
+        height, width = sizes[:, :1].double(), sizes[:, 1:].double()
+
+        log_ratio = torch.log(torch.tensor(self.ratio, dtype=torch.float64))
+        target_area = height * width * torch.empty(n, 10, dtype=torch.float64).uniform_(*self.scale)
+        aspect_ratio = torch.exp(torch.empty(n, 10, dtype=torch.float64).uniform_(*log_ratio.tolist()))
+        w = torch.round(torch.sqrt(target_area * aspect_ratio))
+        h = torch.round(torch.sqrt(target_area / aspect_ratio))
+        fits = (w > 0) & (w <= width) & (h > 0) & (h <= height)
+        first = fits.double().argmax(dim=1, keepdim=True)
+        h, w = h.gather(1, first).squeeze(1), w.gather(1, first).squeeze(1)
+        top = torch.floor(torch.rand(n, dtype=torch.float64) * (height.squeeze(1) - h + 1))
+        left = torch.floor(torch.rand(n, dtype=torch.float64) * (width.squeeze(1) - w + 1))
+
+        # Fallback to central crop
+        height, width = height.squeeze(1), width.squeeze(1)
+        fallback = ~fits.any(dim=1)
+        in_ratio = width / height
+        fb_w = torch.where(in_ratio > max(self.ratio), torch.round(height * max(self.ratio)), width)
+        fb_h = torch.where(in_ratio < min(self.ratio), torch.round(width / min(self.ratio)), height)
+        h, w = torch.where(fallback, fb_h, h), torch.where(fallback, fb_w, w)
+        top = torch.where(fallback, torch.floor((height - h) / 2), top)
+        left = torch.where(fallback, torch.floor((width - w) / 2), left)
+        return torch.stack([top, left, h, w], dim=1)
+
+    def center_crops(self, sizes):
+        """
+        Source pixels kept by Resize(input_size / crop_pct) followed by CenterCrop(input_size).
+        :return: (B, 4) float tensor of crop top, left, height, width
+        """
+        crop_pct = 224 / 256 if self.input_size <= 224 else 1.0
+        size = int(self.input_size / crop_pct)
+        height, width = sizes[:, 0].double(), sizes[:, 1].double()
+        side = torch.min(height, width) * self.input_size / size
+        return torch.stack([(height - side) / 2, (width - side) / 2, side, side], dim=1)
+
+    def __call__(self, batch: RawBatch) -> torch.Tensor:
+        """
+        :param batch: RawBatch, already on the target device
+        :return: (B, C, input_size, input_size) float32 tensor
+        """
+        x = batch.images
+        if x.dtype == torch.int16:
+            x = x.int() & 0xFFFF  # uint16 data
+        x = self.normalize(x.float())
+
+        crops = self.random_crops(batch.sizes) if self.is_train else self.center_crops(batch.sizes)
+        top, left, h, w = crops.unbind(dim=1)
+        flip = torch.ones_like(w)
+        if self.is_train:
+            flip[torch.rand(len(flip)) < 0.5] = -1.
+
+        # One affine grid per tile maps the output square onto its crop box (align_corners=False coordinates)
+        canvas_h, canvas_w = x.shape[2], x.shape[3]
+        theta = torch.zeros(len(x), 2, 3, dtype=torch.float64)
+        theta[:, 0, 0] = w / canvas_w * flip
+        theta[:, 0, 2] = (2 * left + w) / canvas_w - 1
+        theta[:, 1, 1] = h / canvas_h
+        theta[:, 1, 2] = (2 * top + h) / canvas_h - 1
+
+        grid = F.affine_grid(theta.float().to(x.device), [len(x), x.shape[1], self.input_size, self.input_size],
+                             align_corners=False)
+        return F.grid_sample(x, grid, mode='bicubic', padding_mode='border', align_corners=False)
+
+
+class Uint8ToFloat:
+    """
+    Batched counterpart of ToTensor for --uint8_transport: uint8 samples are scaled to [0, 1] float32 on the device.
+    """
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        return x.float().div_(255.)
+
+
+def build_batch_augment(dataset, is_train: bool, input_size: int) -> BatchAugment:
+    """
+    BatchAugment matching the transform build_fmow_dataset would have given dataset.
+    :param dataset: Dataset built with transform=None (--batch_aug)
+    """
+    if isinstance(dataset, (SentinelIndividualImageDataset, SentinelStreamDataset)):
+        sentinel_norm = True
+    elif isinstance(dataset, EuroSat):
+        sentinel_norm = False
+    else:
+        raise ValueError(f'Batched augmentation is not supported for {type(dataset).__name__}')
+
+    # Dropped bands are never read, so mean/std/masked bands are re-indexed to the kept channels
+    return BatchAugment(is_train, input_size,
+                        mean=kept_bands(dataset.mean, dataset.dropped_bands),
+                        std=kept_bands(dataset.std, dataset.dropped_bands),
+                        sentinel_norm=sentinel_norm, masked_bands=dataset.masked_idxs)
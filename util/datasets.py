@@ -1,20 +1,29 @@
+import ast
+import itertools
+import math
 import os
 import re
 import pandas as pd
 import numpy as np
 import warnings
 import random
-from glob import glob
+from concurrent.futures import ThreadPoolExecutor
 
 from typing import Any, Optional, List
 
 import torch
-from torch.utils.data.dataset import Dataset
+from torch.utils.data.dataset import Dataset, IterableDataset
 from torchvision import transforms
 from PIL import Image
 import rasterio
 from rasterio import logging
+from rasterio.enums import Resampling
 from rasterio.warp import reproject
+from rasterio.windows import Window
+
+from util.band_stats import load_band_stats
+from util.packed_store import INDEX_NAME, PackedArrayStore, default_packed_dir
+from util.shard_stream import default_shard_dir, get_rank_and_world_size, load_shard_index, read_shard, shuffle_buffer
 
 log = logging.getLogger()
 log.setLevel(logging.ERROR)
@@ -51,21 +60,242 @@ CATEGORIES_big = [
     'Beaches, dunes, sands', 'Inland wetlands', 'Coastal wetlands', 'Inland waters', 'Marine waters'
 ]
 
+def index_cache_path(cache_dir: Optional[str], csv_path: str, tag: str) -> Optional[str]:
+    """
+    Path of the on-disk cache for a table precomputed from a csv file.
+    :param cache_dir: Directory holding the caches, None to disable caching
+    :param csv_path: Path to the csv the table is computed from
+    :param tag: Name of the table, e.g. 'temporal_index'
+    :return: Path to a .npz file, or None if caching is disabled
+    """
+    if cache_dir is None:
+        return None
+    csv_name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(cache_dir, f'{csv_name}.{tag}.npz')
+
+
+def load_index_cache(cache_path: Optional[str], csv_path: str):
+    """
+    Loads arrays saved with save_index_cache, if they were computed from the current version of csv_path.
+    :return: Dict of numpy arrays, or None if there is no valid cache
+    """
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    stat = os.stat(csv_path)
+    with np.load(cache_path) as data:
+        arrays = {k: data[k] for k in data.files}
+    if int(arrays.pop('csv_mtime_ns')) != stat.st_mtime_ns or int(arrays.pop('csv_size')) != stat.st_size:
+        return None
+    return arrays
+
+
+def save_index_cache(cache_path: Optional[str], csv_path: str, **arrays):
+    """
+    Saves numpy arrays computed from csv_path, tagged with the csv's mtime and size so stale caches are rebuilt.
+    The file is written to a temporary name first so concurrent ranks never see a partial cache.
+    """
+    if cache_path is None:
+        return
+    os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+    stat = os.stat(csv_path)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, csv_mtime_ns=np.int64(stat.st_mtime_ns), csv_size=np.int64(stat.st_size), **arrays)
+    os.replace(tmp_path, cache_path)
+
+
+def load_image(img_path, min_size: Optional[int] = None):
+    """
+    Opens and decodes an image file (PIL only decodes on first access otherwise).
+    :param min_size: Shorter side the image is needed at. JPEGs are then decoded at the smallest 1/2, 1/4 or 1/8
+        scale that keeps both sides >= min_size, which the decoder does in the DCT domain at a fraction of the
+        cost of a full decode. None to always decode at full resolution. Other formats are decoded in full.
+    """
+    img = Image.open(img_path)
+    if min_size is not None:
+        img.draft(img.mode, (min_size, min_size))
+    img.load()
+    return img
+
+
+def draft_size(is_train: bool, input_size: int, scale=(0.2, 1.0), ratio=(3. / 4., 4. / 3.)) -> int:
+    """
+    Smallest shorter image side at which SatelliteDataset.build_transform never upsamples: the eval resize size,
+    or for training the side at which the smallest RandomResizedCrop box still spans input_size pixels.
+    """
+    if not is_train:
+        crop_pct = 224 / 256 if input_size <= 224 else 1.0
+        return int(input_size / crop_pct)
+    return int(math.ceil(input_size / math.sqrt(scale[0] / max(ratio))))
+
+
+def sample_temporal_frames(index, frames, num_frames=3, repeat=True):
+    """
+    Picks num_frames - 1 other acquisitions of the same location as index.
+    :param index: Row index of the sample
+    :param frames: Row indices of all acquisitions of the sample's location (including index)
+    :param num_frames: Number of frames to return
+    :param repeat: When the location has fewer acquisitions, repeat the last one to return num_frames frames,
+                   instead of returning all of them
+    :return: Row indices of the frames, index first
+    """
+    others = frames[frames != index]
+    if len(others) >= num_frames - 1:
+        picks = random.sample(range(len(others)), num_frames - 1)
+        return (index,) + tuple(others[k] for k in picks)
+    rows = (index,) + tuple(others)
+    if repeat:
+        rows += (rows[-1],) * (num_frames - len(rows))
+    return rows
+
+
+def pad_frames_collate(batch):
+    """
+    Collates temporal samples with different numbers of frames (--variable_frames), padding the frames and
+    timestamps of each sample at the end to the longest sample of the batch.
+    :param batch: (frames, timestamps, label) samples, (T, C, H, W) frames and (T, 3) timestamps
+    :return: (N, T, C, H, W) frames, (N, T, 3) timestamps, (N, T) pad mask that is True for padded frames
+             (None when no sample is padded) and (N,) labels
+    """
+    num_frames = max(len(frames) for frames, _, _ in batch)
+    imgs = batch[0][0].new_zeros((len(batch), num_frames) + tuple(batch[0][0].shape[1:]))
+    timestamps = torch.zeros((len(batch), num_frames, 3), dtype=torch.long)
+    pad_mask = torch.ones((len(batch), num_frames), dtype=torch.bool)
+    for i, (frames, ts, _) in enumerate(batch):
+        imgs[i, :len(frames)] = frames
+        timestamps[i, :len(frames)] = torch.as_tensor(ts)
+        pad_mask[i, :len(frames)] = False
+    labels = torch.tensor([label for _, _, label in batch])
+    return imgs, timestamps, pad_mask if pad_mask.any() else None, labels
+
+
+def to_raw_tensor(img):
+    """
+    Tensor of a (c, h, w) integer image without float conversion, for the batched augmentation path.
+    torch has no uint16, so uint16 data is carried as int16 bits (util.batch_aug.BatchAugment undoes this).
+    """
+    img = np.array(img)  # own, writable copy (packed images are read-only views)
+    if img.dtype == np.uint16:
+        img = img.view(np.int16)
+    return torch.from_numpy(img)
+
+
+def kept_bands(values, dropped_bands):
+    """
+    :param values: Per-band values (e.g. mean or std), or band indices
+    :param dropped_bands: Indices of the dropped bands, None to keep all
+    :return: Entries of values for the bands that are not dropped
+    """
+    return [v for i, v in enumerate(values) if i not in (dropped_bands or [])]
+
+
+class StringColumn:
+    def __init__(self, values):
+        """
+        Read-only column of strings stored as one utf-8 byte buffer plus offsets.
+        Unlike a DataFrame or list of str, indexing it never touches the refcount of a shared Python object,
+        so the pages stay shared between forked DataLoader workers instead of being copied into each of them.
+        :param values: Iterable of strings
+        """
+        encoded = [str(v).encode() for v in values]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=self.offsets[1:])
+        self.buffer = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.buffer[self.offsets[idx]:self.offsets[idx + 1]].tobytes().decode()
+
+
 class SatelliteDataset(Dataset):
     """
     Abstract class.
     """
     def __init__(self, in_c):
         self.in_c = in_c
+        # Optional util.sample_cache.SharedSampleCache, set by build_fmow_dataset
+        self.sample_cache = None
+        # Threads per DataLoader worker for reading the bands/frames of a sample in parallel, 0 to read serially
+        self.read_threads = 0
+        self._read_pool, self._read_pool_pid = None, None
+
+    def select_bands(self, masked_bands, dropped_bands):
+        """
+        Sets the masked and dropped bands of a multi-spectral dataset with per-band mean/std class attributes.
+        Dropped bands are never read: keep_bands are the band indices to read, and masked_idxs are the positions
+        of the masked bands among them.
+        :param masked_bands: List of indices corresponding to which bands to mask out
+        :param dropped_bands:  List of indices corresponding to which bands to drop from input image tensor
+        """
+        self.masked_bands = masked_bands
+        self.dropped_bands = dropped_bands
+        self.keep_bands = None  # read all bands
+        if self.dropped_bands is not None:
+            self.in_c = self.in_c - len(dropped_bands)
+            self.keep_bands = kept_bands(range(len(self.mean)), dropped_bands)
+
+        keep_bands = self.keep_bands if self.keep_bands is not None else list(range(len(self.mean)))
+        self.masked_idxs = [keep_bands.index(i) for i in (masked_bands or []) if i in keep_bands]
+        self.masked_values = np.array(self.mean)[[keep_bands[i] for i in self.masked_idxs]]
+
+    def mask_bands(self, img):
+        """
+        Overwrites the masked bands of a (h, w, c) float image (with only the kept bands) with their mean.
+        """
+        img[:, :, self.masked_idxs] = self.masked_values
+        return img
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_read_pool'], state['_read_pool_pid'] = None, None
+        return state
+
+    def read_pool(self) -> Optional[ThreadPoolExecutor]:
+        """
+        Thread pool of the current process (created after the DataLoader fork), None if read_threads is 0.
+        GDAL and PIL release the GIL while decoding, so the reads of one sample overlap.
+        """
+        if self.read_threads <= 0:
+            return None
+        if self._read_pool_pid != os.getpid():
+            self._read_pool = ThreadPoolExecutor(self.read_threads)
+            self._read_pool_pid = os.getpid()
+        return self._read_pool
+
+    def map_reads(self, read_fn, items):
+        """
+        :return: [read_fn(item) for item in items], run on the read pool if there is one
+        """
+        pool = self.read_pool()
+        if pool is None:
+            return [read_fn(item) for item in items]
+        return list(pool.map(read_fn, items))
+
+    def cached_read(self, read_fn, img_path, bands=None):
+        """
+        Decoded image of img_path, from the node-wide sample cache if one is set.
+        :param read_fn: Function mapping img_path (and bands, if not None) to the decoded, pre-transform numpy array
+        :param bands: Band indices to read, None for all bands
+        :return: read_fn(img_path[, bands]), read-only if it came from the cache
+        """
+        if bands is None:
+            key, read = f'{read_fn.__qualname__}:{img_path}', lambda: read_fn(img_path)
+        else:
+            key, read = f'{read_fn.__qualname__}{list(bands)}:{img_path}', lambda: read_fn(img_path, bands)
+        if self.sample_cache is None:
+            return read()
+        return self.sample_cache.get(key, read)
 
     @staticmethod
-    def build_transform(is_train, input_size, mean, std):
+    def build_transform(is_train, input_size, mean, std, windowed=False):
         """
         Builds train/eval data transforms for the dataset class.
         :param is_train: Whether to yield train or eval data transform/augmentation.
         :param input_size: Image input size (assumed square image).
         :param mean: Per-channel pixel mean value, shape (c,) for c channels
         :param std: Per-channel pixel std. value, shape (c,)
+        :param windowed: Images are already cropped and resized by a RasterWindowReader, skip crop/resize
         :return: Torch data transform for the input image before passing to model
         """
         # mean = IMAGENET_DEFAULT_MEAN
@@ -75,6 +305,13 @@ class SatelliteDataset(Dataset):
         interpol_mode = transforms.InterpolationMode.BICUBIC
 
         t = []
+        if windowed:
+            t.append(transforms.ToTensor())
+            t.append(transforms.Normalize(mean, std))
+            if is_train:
+                t.append(transforms.RandomHorizontalFlip())
+            return transforms.Compose(t)
+
         if is_train:
             t.append(transforms.ToTensor())
             t.append(transforms.Normalize(mean, std))
@@ -106,15 +343,18 @@ class CustomDatasetFromImages(SatelliteDataset):
     mean = [0.4182007312774658, 0.4214799106121063, 0.3991275727748871]
     std = [0.28774282336235046, 0.27541765570640564, 0.2764017581939697]
 
-    def __init__(self, csv_path, transform):
+    def __init__(self, csv_path, transform, decode_size=None):
         """
         Creates Dataset for regular RGB image classification (usually used for fMoW-RGB dataset).
         :param csv_path: csv_path (string): path to csv file.
         :param transform: pytorch transforms for transforms and tensor conversion.
+        :param decode_size: Decode JPEGs at reduced resolution, down to this shorter side (see load_image and
+            draft_size), None to decode at full resolution
         """
         super().__init__(in_c=3)
         # Transforms
         self.transforms = transform
+        self.decode_size = decode_size
         # Read the csv file
         self.data_info = pd.read_csv(csv_path, header=0)
         # First column contains the image paths
@@ -129,7 +369,7 @@ class CustomDatasetFromImages(SatelliteDataset):
         single_image_name = self.image_arr[index]
         # Open image
        # img_as_img = Image.fromarray(single_image_name)
-        img_as_img = Image.open(single_image_name)
+        img_as_img = load_image(single_image_name, self.decode_size)
        # Transform the image
         img_as_tensor = self.transforms(img_as_img)
         # Get label(class) of the image based on the cropped pandas column
@@ -145,16 +385,21 @@ class FMoWTemporalStacked(SatelliteDataset):
     mean = [0.4182007312774658, 0.4214799106121063, 0.3991275727748871]
     std = [0.28774282336235046, 0.27541765570640564, 0.2764017581939697]
     
-    def __init__(self, csv_path: str, transform: Any):
+    def __init__(self, csv_path: str, transform: Any, index_cache_dir: Optional[str] = None,
+                 decode_size: Optional[int] = None):
         """
         Creates Dataset for temporal RGB image classification. Stacks images along temporal dim.
         Usually used for fMoW-RGB-temporal dataset.
         :param csv_path: path to csv file.
         :param transform: pytorch transforms for transforms and tensor conversion
+        :param index_cache_dir: Directory to save/load the precomputed frame index, None to not cache
+        :param decode_size: Decode JPEGs at reduced resolution, down to this shorter side (see load_image and
+            draft_size), None to decode at full resolution
         """
         super().__init__(in_c=9)
         # Transforms
         self.transforms = transform
+        self.decode_size = decode_size
         # Read the csv file
         self.data_info = pd.read_csv(csv_path, header=0)
         # First column contains the image paths
@@ -166,38 +411,64 @@ class FMoWTemporalStacked(SatelliteDataset):
 
         self.min_year = 2002
 
-    def __getitem__(self, index):
-        # Get image name from the pandas df
-        single_image_name_1 = self.image_arr[index]
-
-        splt = single_image_name_1.rsplit('/', 1)
-        base_path = splt[0]
-        fname = splt[1]
-        suffix = fname[-15:]
-        prefix = fname[:-15].rsplit('_', 1)
-        regexp = '{}/{}_*{}'.format(base_path, prefix[0], suffix)
-        temporal_files = glob(regexp)
-        temporal_files.remove(single_image_name_1)
-        if temporal_files == []:
-            single_image_name_2 = single_image_name_1
-            single_image_name_3 = single_image_name_1
-        elif len(temporal_files) == 1:
-            single_image_name_2 = temporal_files[0]
-            single_image_name_3 = temporal_files[0]
-        else:
-            single_image_name_2 = random.choice(temporal_files)
-            while True:
-                single_image_name_3 = random.choice(temporal_files)
-                if single_image_name_3 != single_image_name_2:
-                    break
+        # Frame grouping index, replaces a glob + list.remove per sample. Plain numpy arrays (no python
+        # objects), so forked DataLoader workers share the pages instead of copying them on refcount updates.
+        cache_path = index_cache_path(index_cache_dir, csv_path, 'frame_index')
+        index = load_index_cache(cache_path, csv_path)
+        if index is None or len(index['frame_rows']) != self.data_len:
+            index = self.build_frame_index(self.image_arr)
+            save_index_cache(cache_path, csv_path, **index)
+        self.frame_keys = index['frame_keys']  # (N,) sorted '<dir>/<prefix>_*<suffix>' keys
+        self.frame_rows = index['frame_rows']  # (N,) row of each sorted key
+        self.row_positions = index['row_positions']  # (N,) position of each row in frame_keys
 
-        img_as_img_1 = Image.open(single_image_name_1)
-        img_as_tensor_1 = self.transforms(img_as_img_1)  # (3, h, w)
+    @staticmethod
+    def build_frame_index(image_arr):
+        """
+        Sorts the csv rows by the glob pattern that used to find the other frames of each image.
+        :param image_arr: (N,) image paths
+        :return: Dict of numpy arrays (see __init__)
+        """
+        keys = []
+        for name in image_arr:
+            base_path, fname = name.rsplit('/', 1)
+            suffix = fname[-15:]
+            prefix = fname[:-15].rsplit('_', 1)[0]
+            keys.append('{}/{}_*{}'.format(base_path, prefix, suffix).encode())
+        keys = np.asarray(keys)
+
+        frame_rows = np.argsort(keys, kind='stable').astype(np.int32)
+        row_positions = np.empty_like(frame_rows)
+        row_positions[frame_rows] = np.arange(len(frame_rows), dtype=np.int32)
+        return {
+            'frame_keys': keys[frame_rows],
+            'frame_rows': frame_rows,
+            'row_positions': row_positions,
+        }
 
-        img_as_img_2 = Image.open(single_image_name_2)
-        img_as_tensor_2 = self.transforms(img_as_img_2)  # (3, h, w)
+    def sample_frames(self, index):
+        """
+        Bisects the sorted keys for the other frames of index.
+        :return: Row indices of the 3 frames, index first
+        """
+        key = self.frame_keys[self.row_positions[index]]
+        start = np.searchsorted(self.frame_keys, key, side='left')
+        end = np.searchsorted(self.frame_keys, key, side='right')
+        return sample_temporal_frames(index, self.frame_rows[start:end])
 
-        img_as_img_3 = Image.open(single_image_name_3)
+    def __getitem__(self, index):
+        # Look up the other frames of the same location in the precomputed index
+        index_1, index_2, index_3 = self.sample_frames(index)
+        single_image_name_1 = self.image_arr[index_1]
+        single_image_name_2 = self.image_arr[index_2]
+        single_image_name_3 = self.image_arr[index_3]
+
+        # Decode the 3 frames (in parallel with --read_threads), random transforms stay in order
+        img_as_img_1, img_as_img_2, img_as_img_3 = self.map_reads(
+            lambda name: load_image(name, self.decode_size),
+            [single_image_name_1, single_image_name_2, single_image_name_3])
+        img_as_tensor_1 = self.transforms(img_as_img_1)  # (3, h, w)
+        img_as_tensor_2 = self.transforms(img_as_img_2)  # (3, h, w)
         img_as_tensor_3 = self.transforms(img_as_img_3)  # (3, h, w)
 
         # Get label(class) of the image based on the cropped pandas column
@@ -211,19 +482,21 @@ class FMoWTemporalStacked(SatelliteDataset):
 
 
 class CustomDatasetFromImagesTemporal(SatelliteDataset):
-    def __init__(self, csv_path: str):
+    def __init__(self, csv_path: str, index_cache_dir: Optional[str] = None, reduced_decode: bool = False,
+                 max_frames: int = 3, variable_frames: bool = False):
         """
         Creates temporal dataset for fMoW RGB
         :param csv_path: Path to csv file containing paths to images
-        :param meta_csv_path: Path to csv metadata file for each image
+        :param index_cache_dir: Directory to save/load the precomputed location index, None to not cache
+        :param reduced_decode: Decode JPEGs at the smallest reduced resolution that is still >= 224 (see load_image)
+        :param max_frames: Number of frames of a sample (T_max)
+        :param variable_frames: Return up to max_frames distinct frames per sample instead of repeating frames
+                                to exactly max_frames, to be batched with pad_frames_collate
         """
         super().__init__(in_c=3)
 
-        # Transforms
-        self.transforms = transforms.Compose([
-            # transforms.Scale(224),
-            transforms.RandomCrop(224),
-        ])
+        # Frames are resized to a shorter side of 224 and randomly cropped to 224x224
+        self.input_size = 224
         # Read the csv file
         self.data_info = pd.read_csv(csv_path, header=0)
         # First column contains the image paths
@@ -236,134 +509,177 @@ class CustomDatasetFromImagesTemporal(SatelliteDataset):
         self.dataset_root_path = os.path.dirname(csv_path)
 
         self.timestamp_arr = np.asarray(self.data_info.iloc[:, 2])
-        self.name2index = dict(zip(
-            [os.path.join(self.dataset_root_path, x) for x in self.image_arr],
-            np.arange(self.data_len)
-        ))
 
         self.min_year = 2002  # hard-coded for fMoW
 
+        # Location -> frames table, replaces a regex + glob per sample
+        cache_path = index_cache_path(index_cache_dir, csv_path, 'temporal_index')
+        index = load_index_cache(cache_path, csv_path)
+        if index is None or len(index['location_ids']) != self.data_len:
+            index = self.build_location_index(self.image_arr, self.timestamp_arr, self.min_year)
+            save_index_cache(cache_path, csv_path, **index)
+        self.location_ids = index['location_ids']  # (N,) location of each row
+        self.location_frames = index['location_frames']  # (N,) rows grouped by location
+        self.location_offsets = index['location_offsets']  # (num_locations + 1,) start of each group in location_frames
+        self.timestamps = index['timestamps']  # (N, 3) parsed (year - min_year, month - 1, hour)
+
         mean = [0.4182007312774658, 0.4214799106121063, 0.3991275727748871]
         std = [0.28774282336235046, 0.27541765570640564, 0.2764017581939697]
         self.normalization = transforms.Normalize(mean, std)
         self.totensor = transforms.ToTensor()
-        self.scale = transforms.Resize(224) # Scale to Resize. Scale's deprecated
+        self.decode_size = 224 if reduced_decode else None
+        self.max_frames = max_frames
+        self.variable_frames = variable_frames
 
     def __getitem__(self, index):
-        # Get image name from the pandas df
-        single_image_name_1 = self.image_arr[index]
-
-        splt = single_image_name_1.rsplit('/', 1)
-        base_path = splt[0]
-        fname = splt[1]
-        match = re.search(r'^(.*?_\d+)_.*_rgb.jpg$', fname)
-        if match:
-            prefix = match.group(1)
-        else:
-            prefix = ""
-        suffix = fname.split('_')
-        suffix = "_" + (suffix[-1])
-        regexp = '{}/{}_*{}'.format(base_path, prefix, suffix)
-
-        # suffix = single_image_name_1[-15:]
-        # prefix = single_image_name_1[:-15].rsplit('_', 1)
-        # regexp = '{}_*{}'.format(prefix[0], suffix)
-        # regexp = os.path.join(self.dataset_root_path, regexp)
-        # single_image_name_1 = os.path.join(self.dataset_root_path, single_image_name_1)
-
-        temporal_files = glob(regexp)
-              
-        # temporal_files = [base_path + "/" + path for path in temporal_files]
-
-        temporal_files.remove(single_image_name_1)
-
-        if temporal_files == []:
-            single_image_name_2 = single_image_name_1
-            single_image_name_3 = single_image_name_1
-        elif len(temporal_files) == 1:
-            single_image_name_2 = temporal_files[0]
-            single_image_name_3 = temporal_files[0]
-        else:
-            single_image_name_2 = random.choice(temporal_files)
-            while True:
-                single_image_name_3 = random.choice(temporal_files)
-                if single_image_name_3 != single_image_name_2:
-                    break
-
-        img_as_img_1 = Image.open(single_image_name_1)
-        img_as_img_2 = Image.open(single_image_name_2)
-        img_as_img_3 = Image.open(single_image_name_3)
-        img_as_tensor_1 = self.totensor(img_as_img_1)
-        img_as_tensor_2 = self.totensor(img_as_img_2)
-        img_as_tensor_3 = self.totensor(img_as_img_3)
-        del img_as_img_1
-        del img_as_img_2
-        del img_as_img_3
-        img_as_tensor_1 = self.scale(img_as_tensor_1)
-        img_as_tensor_2 = self.scale(img_as_tensor_2)
-        img_as_tensor_3 = self.scale(img_as_tensor_3)
-        try:
-            if img_as_tensor_1.shape[2] > 224 and \
-                    img_as_tensor_2.shape[2] > 224 and \
-                    img_as_tensor_3.shape[2] > 224:
-                min_w = min(img_as_tensor_1.shape[2], min(img_as_tensor_2.shape[2], img_as_tensor_3.shape[2]))
-                img_as_tensor = torch.cat([
-                    img_as_tensor_1[..., :min_w],
-                    img_as_tensor_2[..., :min_w],
-                    img_as_tensor_3[..., :min_w]
-                ], dim=-3)
-            elif img_as_tensor_1.shape[1] > 224 and \
-                    img_as_tensor_2.shape[1] > 224 and \
-                    img_as_tensor_3.shape[1] > 224:
-                min_w = min(img_as_tensor_1.shape[1], min(img_as_tensor_2.shape[1], img_as_tensor_3.shape[1]))
-                img_as_tensor = torch.cat([
-                    img_as_tensor_1[..., :min_w, :],
-                    img_as_tensor_2[..., :min_w, :],
-                    img_as_tensor_3[..., :min_w, :]
-                ], dim=-3)
-            else:
-                img_as_img_1 = Image.open(single_image_name_1)
-                img_as_tensor_1 = self.totensor(img_as_img_1)
-                img_as_tensor_1 = self.scale(img_as_tensor_1)
-                img_as_tensor = torch.cat([img_as_tensor_1, img_as_tensor_1, img_as_tensor_1], dim=-3)
-        except:
-            print(img_as_tensor_1.shape, img_as_tensor_2.shape, img_as_tensor_3.shape)
-            assert False
-
-        del img_as_tensor_1
-        del img_as_tensor_2
-        del img_as_tensor_3
-
-        img_as_tensor = self.transforms(img_as_tensor)
-        img_as_tensor_1, img_as_tensor_2, img_as_tensor_3 = torch.chunk(img_as_tensor, 3, dim=-3)
-        del img_as_tensor
-        img_as_tensor_1 = self.normalization(img_as_tensor_1)
-        img_as_tensor_2 = self.normalization(img_as_tensor_2)
-        img_as_tensor_3 = self.normalization(img_as_tensor_3)
-
-        ts1 = self.parse_timestamp(single_image_name_1)
-        ts2 = self.parse_timestamp(single_image_name_2)
-        ts3 = self.parse_timestamp(single_image_name_3)
-
-        ts = np.stack([ts1, ts2, ts3], axis=0)
+        # Look up the other acquisitions of the same location in the precomputed index
+        rows = self.sample_frames(index)
+
+        # Open the frames (in parallel with --read_threads), this only reads their headers
+        frames = self.map_reads(self.open_frame, [self.image_arr[row] for row in rows])
+        sizes = [self.resized_size(frame.size) for frame in frames]
+        used, top, left = self.crop_geometry(sizes)
+        if self.variable_frames:
+            # Frames that do not stack leave the first frame once, rather than copies of it
+            used = sorted(set(used))
+            rows = [rows[k] for k in used]
+
+        # Decode each used frame once, and resize only its crop
+        decoded = sorted(set(used))
+        crops = dict(zip(decoded, self.map_reads(lambda k: self.load_crop(frames[k], sizes[k], top, left), decoded)))
+        for k in set(range(len(frames))) - set(used):
+            frames[k].close()
+        imgs = torch.stack([self.normalization(crops[k]) for k in used], dim=0)
+
+        ts = self.timestamps[list(rows)].astype(np.int64)
 
         # Get label(class) of the image based on the cropped pandas column
         single_image_label = self.label_arr[index]
 
-        imgs = torch.stack([img_as_tensor_1, img_as_tensor_2, img_as_tensor_3], dim=0)
+        return (imgs, ts, single_image_label)
 
-        del img_as_tensor_1
-        del img_as_tensor_2
-        del img_as_tensor_3
+    def open_frame(self, img_path):
+        """
+        Opens an image without decoding it (set up for reduced resolution decoding with reduced_decode).
+        """
+        img = Image.open(img_path)
+        if self.decode_size is not None:
+            img.draft(img.mode, (self.decode_size, self.decode_size))
+        return img
 
-        return (imgs, ts, single_image_label)
+    def resized_size(self, size):
+        """
+        :param size: (w, h) of an image
+        :return: (w, h) of the image after transforms.Resize(input_size)
+        """
+        w, h = size
+        short, long = (w, h) if w <= h else (h, w)
+        new_short, new_long = self.input_size, int(self.input_size * long / short)
+        return (new_short, new_long) if w <= h else (new_long, new_short)
+
+    def crop_geometry(self, sizes):
+        """
+        Frames and crop of resizing the T frames to a shorter side of input_size, stacking them trimmed to their
+        common width (landscape) or height (portrait), and applying RandomCrop(input_size) to the stack.
+        Frames that do not stack are replaced by T copies of the first one. Only needs the frame sizes, and
+        draws the same random numbers as RandomCrop.
+        :param sizes: (w, h) of the T frames after Resize(input_size)
+        :return: Frames to use (0, 1, ..., T - 1 or 0, 0, ..., 0), crop top and left in resized pixels
+        """
+        size = self.input_size
+        widths, heights = [w for w, _ in sizes], [h for _, h in sizes]
+        if min(widths) > size:
+            used, stack_h, stack_w = tuple(range(len(sizes))), size, min(widths)
+        elif min(heights) > size:
+            used, stack_h, stack_w = tuple(range(len(sizes))), min(heights), size
+        else:
+            used, (stack_w, stack_h) = (0,) * len(sizes), sizes[0]
+
+        if (stack_h, stack_w) == (size, size):
+            return used, 0, 0
+        top = torch.randint(0, stack_h - size + 1, size=(1,)).item()
+        left = torch.randint(0, stack_w - size + 1, size=(1,)).item()
+        return used, top, left
+
+    def load_crop(self, img, size, top, left):
+        """
+        Decodes img and resizes only the part of it that ends up in the crop.
+        Bilinear like the transforms.Resize to size followed by cropping input_size pixels at (top, left) it replaces,
+        and close to it (up to uint8 rounding) since PIL's resampling with a box still takes the filter support from
+        outside the box.
+        :param img: Opened PIL image
+        :param size: (w, h) img is resized to
+        :return: (c, input_size, input_size) tensor in [0, 1]
+        """
+        scale_x, scale_y = img.width / size[0], img.height / size[1]
+        box = (left * scale_x, top * scale_y, (left + self.input_size) * scale_x, (top + self.input_size) * scale_y)
+        if tuple(size) == img.size:
+            crop = img.crop(tuple(int(b) for b in box))  # no resize
+        else:
+            crop = img.resize((self.input_size, self.input_size), Image.BILINEAR, box=box)
+        img.close()
+        return self.totensor(crop)
+
+    @staticmethod
+    def build_location_index(image_arr, timestamp_arr, min_year):
+        """
+        Groups the csv rows by location. Two images belong to the same location when they share
+        directory, '<category>_<location>' prefix and suffix, i.e. the files the glob
+        '{base}/{prefix}_*{suffix}' used to find for each sample.
+        :param image_arr: (N,) image paths
+        :param timestamp_arr: (N,) timestamp strings, formatted 'YYYY-MM-DDTHH...'
+        :param min_year: Year mapped to 0 in the parsed timestamps
+        :return: Dict of compact integer arrays (see __init__)
+        """
+        pattern = re.compile(r'^(.*?_\d+)_.*_rgb.jpg$')
+        keys = []
+        for name in image_arr:
+            base_path, fname = name.rsplit('/', 1)
+            match = pattern.search(fname)
+            prefix = match.group(1) if match else ""
+            suffix = "_" + fname.split('_')[-1]
+            keys.append('{}/{}_*{}'.format(base_path, prefix, suffix))
+
+        location_ids, _ = pd.factorize(np.asarray(keys))
+        location_ids = location_ids.astype(np.int32)
+        location_frames = np.argsort(location_ids, kind='stable').astype(np.int32)
+        counts = np.bincount(location_ids)
+        location_offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+        ts = pd.Series(timestamp_arr).astype(str)
+        timestamps = np.stack([
+            ts.str[:4].astype(int).to_numpy() - min_year,
+            ts.str[5:7].astype(int).to_numpy() - 1,
+            ts.str[11:13].astype(int).to_numpy(),
+        ], axis=1).astype(np.int16)
+
+        return {
+            'location_ids': location_ids,
+            'location_frames': location_frames,
+            'location_offsets': location_offsets,
+            'timestamps': timestamps,
+        }
 
-    def parse_timestamp(self, name):
-        timestamp = self.timestamp_arr[self.name2index[name]]
-        year = int(timestamp[:4])
-        month = int(timestamp[5:7])
-        hour = int(timestamp[11:13])
-        return np.array([year - self.min_year, month - 1, hour])
+    def sample_frames(self, index):
+        """
+        Picks max_frames - 1 other acquisitions of the same location as index. When there are fewer, frames are
+        repeated, or with variable_frames all of them are used.
+        :return: Row indices of the frames, index first
+        """
+        location = self.location_ids[index]
+        frames = self.location_frames[self.location_offsets[location]:self.location_offsets[location + 1]]
+        return sample_temporal_frames(index, frames, self.max_frames, repeat=not self.variable_frames)
+
+    def frame_counts(self):
+        """
+        Number of frames __getitem__ returns for each sample, for batching samples of similar length. With
+        variable_frames it is an upper bound, frames that do not stack leave only the first one.
+        :return: (N,) frame counts
+        """
+        if not self.variable_frames:
+            return np.full(self.data_len, self.max_frames, dtype=np.int64)
+        location_sizes = np.diff(self.location_offsets)[self.location_ids]
+        return np.minimum(location_sizes, self.max_frames)
 
     def __len__(self):
 
@@ -392,6 +708,93 @@ class SentinelNormalize:
         return img
 
 
+class ToUint8Tensor:
+    """
+    (h, w, c) uint8 array to (c, h, w) uint8 tensor. Same as ToTensor on SentinelNormalize output, without the
+    float32 conversion and scaling to [0, 1], which util.batch_aug.Uint8ToFloat does per batch on the device.
+    """
+    def __call__(self, x):
+        return torch.from_numpy(np.ascontiguousarray(x.transpose(2, 0, 1)))
+
+
+class RasterWindowReader:
+    def __init__(self, is_train: bool, input_size: int, scale=(0.2, 1.0), ratio=(3. / 4., 4. / 3.),
+                 resampling=Resampling.cubic):
+        """
+        Reads only the part of a GeoTIFF the train/eval transform would keep, directly at the model input size.
+        The window is drawn like RandomResizedCrop (train) or Resize + CenterCrop (eval) in build_transform,
+        so the crop/resize transforms are dropped (build_transform(..., windowed=True)).
+        GDAL reads from overviews where the file has them and the window is downsampled.
+        :param is_train: Random resized crop window if True, center crop window otherwise
+        :param input_size: Output height and width
+        :param scale: Range of the crop area relative to the image area (train only)
+        :param ratio: Range of the crop aspect ratio (train only)
+        :param resampling: rasterio resampling used to read the window at input_size
+        """
+        self.is_train = is_train
+        self.input_size = input_size
+        self.scale = scale
+        self.ratio = ratio
+        self.resampling = resampling
+
+    def random_window(self, height, width):
+        """
+        Same sampling as transforms.RandomResizedCrop.get_params, so the torch seed gives the same crops.
+        :return: rasterio Window in source pixels
+        """
+        area = height * width
+        log_ratio = torch.log(torch.tensor(self.ratio))
+        for _ in range(10):
+            target_area = area * torch.empty(1).uniform_(self.scale[0], self.scale[1]).item()
+            aspect_ratio = torch.exp(torch.empty(1).uniform_(log_ratio[0], log_ratio[1])).item()
+
+            w = int(round(math.sqrt(target_area * aspect_ratio)))
+            h = int(round(math.sqrt(target_area / aspect_ratio)))
+            if 0 < w <= width and 0 < h <= height:
+                i = torch.randint(0, height - h + 1, size=(1,)).item()
+                j = torch.randint(0, width - w + 1, size=(1,)).item()
+                return Window(j, i, w, h)
+
+        # Fallback to central crop
+        in_ratio = float(width) / float(height)
+        if in_ratio < min(self.ratio):
+            w = width
+            h = int(round(w / min(self.ratio)))
+        elif in_ratio > max(self.ratio):
+            h = height
+            w = int(round(h * max(self.ratio)))
+        else:  # whole image
+            w = width
+            h = height
+        return Window((width - w) // 2, (height - h) // 2, w, h)
+
+    def center_window(self, height, width):
+        """
+        Source pixels kept by Resize(input_size / crop_pct) followed by CenterCrop(input_size).
+        :return: rasterio Window in source pixels
+        """
+        crop_pct = 224 / 256 if self.input_size <= 224 else 1.0
+        size = int(self.input_size / crop_pct)
+        side = int(round(min(height, width) * self.input_size / size))
+        h, w = min(side, height), min(side, width)
+        return Window(int(round((width - w) / 2.)), int(round((height - h) / 2.)), w, h)
+
+    def __call__(self, img_path, bands=None):
+        """
+        :param bands: Band indices (0 indexed) to read, None for all bands
+        :return: (c, input_size, input_size) array in the stored dtype
+        """
+        with rasterio.open(img_path) as data:
+            if self.is_train:
+                window = self.random_window(data.height, data.width)
+            else:
+                window = self.center_window(data.height, data.width)
+            indexes = [b + 1 for b in bands] if bands is not None else list(data.indexes)
+            img = data.read(indexes, window=window, out_shape=(len(indexes), self.input_size, self.input_size),
+                            resampling=self.resampling)
+        return img
+
+
 class SentinelIndividualImageDataset(SatelliteDataset):
     label_types = ['value', 'one-hot']
     mean = [1370.19151926, 1184.3824625 , 1120.77120066, 1136.26026392,
@@ -408,34 +811,44 @@ class SentinelIndividualImageDataset(SatelliteDataset):
                  categories: Optional[List[str]] = None,
                  label_type: str = 'value',
                  masked_bands: Optional[List[int]] = None,
-                 dropped_bands: Optional[List[int]] = None):
+                 dropped_bands: Optional[List[int]] = None,
+                 window_reader: Optional[RasterWindowReader] = None,
+                 mean: Optional[List[float]] = None,
+                 std: Optional[List[float]] = None):
         """
         Creates dataset for multi-spectral single image classification.
         Usually used for fMoW-Sentinel dataset.
         :param csv_path: path to csv file.
-        :param transform: pytorch Transform for transforms and tensor conversion
+        :param transform: pytorch Transform for transforms and tensor conversion, None to return raw (c, h, w) tiles for util.batch_aug
         :param years: List of years to take images from, None to not filter
         :param categories: List of categories to take images from, None to not filter
         :param label_type: 'values' for single label, 'one-hot' for one hot labels
         :param masked_bands: List of indices corresponding to which bands to mask out
         :param dropped_bands:  List of indices corresponding to which bands to drop from input image tensor
+        :param window_reader: Reads only the crop window of each image, transform must be built with windowed=True
+        :param mean: Per-band mean overriding the class attribute, e.g. from util.band_stats
+        :param std: Per-band std overriding the class attribute
         """
         super().__init__(in_c=13)
-        self.df = pd.read_csv(csv_path) \
+        df = pd.read_csv(csv_path) \
             .sort_values(['category', 'location_id', 'timestamp'])
 
         # Filter by category
         self.categories = CATEGORIES
         if categories is not None:
             self.categories = categories
-            self.df = self.df.loc[categories]
+            df = df.loc[categories]
 
         # Filter by year
         if years is not None:
-            self.df['year'] = [int(timestamp.split('-')[0]) for timestamp in self.df['timestamp']]
-            self.df = self.df[self.df['year'].isin(years)]
+            df['year'] = [int(timestamp.split('-')[0]) for timestamp in df['timestamp']]
+            df = df[df['year'].isin(years)]
+
+        self.indices = df.index.unique().to_numpy()
 
-        self.indices = self.df.index.unique().to_numpy()
+        # Only flat numpy columns are kept, the DataFrame is dropped after init
+        self.image_paths = StringColumn(df['image_path'])
+        self.labels = self.build_label_array(df['category'], self.categories)  # (N,) int64
 
         self.transform = transform
 
@@ -445,22 +858,57 @@ class SentinelIndividualImageDataset(SatelliteDataset):
                 ', '.join(self.label_types))
         self.label_type = label_type
 
-        self.masked_bands = masked_bands
-        self.dropped_bands = dropped_bands
-        if self.dropped_bands is not None:
-            self.in_c = self.in_c - len(dropped_bands)
+        if mean is not None:
+            self.mean, self.std = mean, std
+        self.select_bands(masked_bands, dropped_bands)
+
+        self.window_reader = window_reader
 
     def __len__(self):
-        return len(self.df)
+        return len(self.image_paths)
 
-    def open_image(self, img_path):
+    @staticmethod
+    def build_label_array(category_column, categories):
+        """
+        Maps category names to their index in categories.
+        :param category_column: (N,) category names
+        :param categories: Category names, in label index order
+        :return: (N,) int64 labels
+        """
+        codes = pd.Categorical(category_column, categories=categories).codes
+        if (codes < 0).any():
+            unknown = sorted(set(category_column[codes < 0]))
+            raise ValueError(f'Categories {unknown} are not in the list of categories')
+        return codes.astype(np.int64)
+
+    @staticmethod
+    def read_raw(img_path, bands=None):
+        """
+        Reads the bands of a GeoTIFF in their stored dtype.
+        :param bands: Band indices (0 indexed) to read, None for all bands
+        :return: (c, h, w) array
+        """
         with rasterio.open(img_path) as data:
             # img = data.read(
             #     out_shape=(data.count, self.resize, self.resize),
             #     resampling=Resampling.bilinear
             # )
-            img = data.read()  # (c, h, w)
+            if bands is None:
+                img = data.read()  # (c, h, w)
+            else:
+                img = data.read([b + 1 for b in bands])  # only the kept bands are decoded
+        return img
+
+    def open_raw(self, img_path):
+        """
+        :return: (c, h, w) image of the kept bands in its stored dtype
+        """
+        if self.window_reader is not None:
+            return self.window_reader(img_path, self.keep_bands)  # (c, input_size, input_size)
+        return self.cached_read(self.read_raw, img_path, self.keep_bands)
 
+    def open_image(self, img_path):
+        img = self.open_raw(img_path)  # (c, h, w)
         return img.transpose(1, 2, 0).astype(np.float32)  # (h, w, c)
 
     def __getitem__(self, idx):
@@ -469,37 +917,48 @@ class SentinelIndividualImageDataset(SatelliteDataset):
         :param idx: Index of (image, label) pair in dataset dataframe. (c, h, w)
         :return: Torch Tensor image, and integer label as a tuple.
         """
-        selection = self.df.iloc[idx]
-
         # images = [torch.FloatTensor(rasterio.open(img_path).read()) for img_path in image_paths]
-        images = self.open_image(selection['image_path'])  # (h, w, c)
-        if self.masked_bands is not None:
-            images[:, :, self.masked_bands] = np.array(self.mean)[self.masked_bands]
+        img = self.open_raw(self.image_paths[idx])  # (c, h, w)
+        return self.make_sample(img, int(self.labels[idx]))
+
+    def make_sample(self, img, labels):
+        """
+        Band masking and transform of a decoded image.
+        :param img: (c, h, w) image of the kept bands in its stored dtype
+        :param labels: Label of the image
+        :return: Torch Tensor image, and label as a tuple.
+        """
+        if self.transform is None:
+            # Raw tile, normalization and augmentation happen batched on the device (util.batch_aug)
+            return to_raw_tensor(img), labels
 
-        labels = self.categories.index(selection['category'])
+        # SentinelNormalize computes in float64, so integer images give the same result as float32 ones
+        images = img.transpose(1, 2, 0)  # (h, w, c)
+        if self.masked_bands is not None:
+            images = self.mask_bands(images.astype(np.float32))
 
         img_as_tensor = self.transform(images)  # (c, h, w)
-        if self.dropped_bands is not None:
-            keep_idxs = [i for i in range(img_as_tensor.shape[0]) if i not in self.dropped_bands]
-            img_as_tensor = img_as_tensor[keep_idxs, :, :]
-
-        sample = {
-            'images': images,
-            'labels': labels,
-            'image_ids': selection['image_id'],
-            'timestamps': selection['timestamp']
-        }
         return img_as_tensor, labels
 
     @staticmethod
-    def build_transform(is_train, input_size, mean, std):
+    def build_transform(is_train, input_size, mean, std, windowed=False, uint8=False):
         # train transform
         interpol_mode = transforms.InterpolationMode.BICUBIC
+        # uint8 keeps SentinelNormalize's output as uint8 tensors until the batch reaches the device
+        to_tensor = ToUint8Tensor() if uint8 else transforms.ToTensor()
 
         t = []
+        if windowed:
+            # RasterWindowReader already cropped and resized the image
+            t.append(SentinelNormalize(mean, std))
+            t.append(to_tensor)
+            if is_train:
+                t.append(transforms.RandomHorizontalFlip())
+            return transforms.Compose(t)
+
         if is_train:
             t.append(SentinelNormalize(mean, std))  # use specific Sentinel normalization to avoid NaN
-            t.append(transforms.ToTensor())
+            t.append(to_tensor)
             t.append(
                 transforms.RandomResizedCrop(input_size, scale=(0.2, 1.0), interpolation=interpol_mode),  # 3 is bicubic
             )
@@ -514,7 +973,7 @@ class SentinelIndividualImageDataset(SatelliteDataset):
         size = int(input_size / crop_pct)
 
         t.append(SentinelNormalize(mean, std))
-        t.append(transforms.ToTensor())
+        t.append(to_tensor)
         t.append(
             transforms.Resize(size, interpolation=interpol_mode),  # to maintain same ratio w.r.t. 224 images
         )
@@ -522,6 +981,143 @@ class SentinelIndividualImageDataset(SatelliteDataset):
 
         return transforms.Compose(t)
 
+class SentinelPackedImageDataset(SentinelIndividualImageDataset):
+    def __init__(self, csv_path: str, transform: Any, packed_dir: Optional[str] = None, **kwargs):
+        """
+        Same as SentinelIndividualImageDataset, but reads images from a packed store built with
+        `python -m util.packed_store --dataset_type sentinel --csv_path <csv_path>`.
+        :param csv_path: path to csv file.
+        :param transform: pytorch Transform for transforms and tensor conversion, None to return raw (c, h, w) tiles for util.batch_aug
+        :param packed_dir: Directory of the packed store, defaults to <csv dir>/<csv name>_packed
+        :param kwargs: Remaining SentinelIndividualImageDataset arguments
+        """
+        super().__init__(csv_path, transform, **kwargs)
+        self.store = PackedArrayStore(packed_dir or default_packed_dir(csv_path))
+
+    def open_raw(self, img_path):
+        img = self.store.get(img_path)  # (c, h, w), zero-copy uint16 view into the memory-mapped shard
+        if self.keep_bands is not None:
+            img = img[self.keep_bands]  # only the pages of the kept bands are touched
+        return img
+
+    def open_image(self, img_path):
+        return self.open_raw(img_path).transpose(1, 2, 0)  # (h, w, c)
+
+
+class SentinelStreamDataset(IterableDataset, SatelliteDataset):
+    mean = SentinelIndividualImageDataset.mean
+    std = SentinelIndividualImageDataset.std
+    build_transform = staticmethod(SentinelIndividualImageDataset.build_transform)
+    make_sample = SentinelIndividualImageDataset.make_sample
+
+    def __init__(self,
+                 shard_dir: str,
+                 transform: Any,
+                 is_train: bool = True,
+                 shuffle_buffer_size: int = 1000,
+                 masked_bands: Optional[List[int]] = None,
+                 dropped_bands: Optional[List[int]] = None,
+                 seed: int = 0,
+                 mean: Optional[List[float]] = None,
+                 std: Optional[List[float]] = None):
+        """
+        Streams fMoW-Sentinel samples from tar shards written by
+        `python -m util.shard_stream --dataset_type sentinel --csv_path <csv_path>`, reading each shard sequentially.
+        Shards are split across ranks and DataLoader workers. For training, every rank yields exactly len(self)
+        samples per epoch (wrapping around its shards if needed) so that DDP ranks stay in step.
+        :param shard_dir: Directory with the shards and shards.json
+        :param transform: pytorch Transform for transforms and tensor conversion, None for raw tiles (util.batch_aug)
+        :param is_train: Reshuffle shards and samples every epoch; otherwise read every sample once, in order
+        :param shuffle_buffer_size: Number of samples each worker shuffles over, 0 to keep the shard order
+        :param masked_bands: List of indices corresponding to which bands to mask out
+        :param dropped_bands:  List of indices corresponding to which bands to drop from input image tensor
+        :param seed: Seed of the shard and sample shuffling, combined with the epoch
+        :param mean: Per-band mean overriding the class attribute, e.g. from util.band_stats
+        :param std: Per-band std overriding the class attribute
+        """
+        super().__init__(in_c=13)
+        self.shards = load_shard_index(shard_dir)
+        self.transform = transform
+        self.is_train = is_train
+        self.shuffle_buffer_size = shuffle_buffer_size
+        self.seed = seed
+        self.epoch = 0
+
+        if mean is not None:
+            self.mean, self.std = mean, std
+        self.select_bands(masked_bands, dropped_bands)
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        """
+        :return: Number of samples of one rank per epoch
+        """
+        rank, world_size = get_rank_and_world_size()
+        total = sum(n for _, n in self.shards)
+        if self.is_train:
+            return total // world_size
+        return len(range(rank, total, world_size))  # approximate unless there are more shards than readers
+
+    def worker_samples(self, slot, num_slots, rng):
+        """
+        Samples read by one DataLoader worker of one rank.
+        With at least one shard per reader whole shards are split; otherwise every reader streams all shards
+        and keeps every num_slots-th sample.
+        :param slot: Index of this worker among the workers of all ranks
+        :param num_slots: Number of workers of all ranks
+        """
+        shards = [path for path, _ in self.shards]
+        if self.is_train:
+            rng.shuffle(shards)
+        if len(shards) >= num_slots:
+            for path in shards[slot::num_slots]:
+                yield from read_shard(path)
+        else:
+            i = 0
+            for path in shards:
+                for sample in read_shard(path):
+                    if i % num_slots == slot:
+                        yield sample
+                    i += 1
+
+    def __iter__(self):
+        rank, world_size = get_rank_and_world_size()
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        slot, num_slots = rank * num_workers + worker_id, world_size * num_workers
+
+        # Shard order is the same on every reader, so the shard split is consistent across ranks
+        shard_rng = random.Random(self.seed + self.epoch)
+        if not self.is_train:
+            samples = self.worker_samples(slot, num_slots, shard_rng)
+        else:
+            # Fixed number of samples per worker, cycling through its shards again if they run out
+            rank_len = len(self)
+            quota = rank_len // num_workers + (worker_id < rank_len % num_workers)
+            samples = itertools.islice(self.cycle(slot, num_slots, shard_rng), quota)
+            sample_rng = random.Random((self.seed + self.epoch) * num_slots + slot)
+            samples = shuffle_buffer(samples, self.shuffle_buffer_size, sample_rng)
+
+        for img, label in samples:
+            if self.keep_bands is not None:
+                img = img[self.keep_bands]  # shards hold all bands
+            yield self.make_sample(img, label.item() if label.ndim == 0 else torch.from_numpy(label))
+
+    def cycle(self, slot, num_slots, rng):
+        """
+        Repeats worker_samples (with a new shard order each pass), stops if the worker has no samples at all.
+        """
+        while True:
+            empty = True
+            for sample in self.worker_samples(slot, num_slots, rng):
+                empty = False
+                yield sample
+            if empty:
+                return
+
+
 # add dataloader for bigeartnet
 # method of stacking should be revisited
 class BigEarthNetImageDataset(SatelliteDataset):
@@ -542,7 +1138,11 @@ class BigEarthNetImageDataset(SatelliteDataset):
                  categories: Optional[List[str]] = None,
                  label_type: str = 'one-hot',
                  masked_bands: Optional[List[int]] = None,
-                 dropped_bands: Optional[List[int]] = None):
+                 dropped_bands: Optional[List[int]] = None,
+                 packed_dir: Optional[str] = None,
+                 index_cache_dir: Optional[str] = None,
+                 mean: Optional[List[float]] = None,
+                 std: Optional[List[float]] = None):
         """
         Creates dataset for multi-spectral single image classification.
         Usually used for fMoW-Sentinel dataset.
@@ -553,9 +1153,14 @@ class BigEarthNetImageDataset(SatelliteDataset):
         :param label_type: 'values' for single label, 'one-hot' for one hot labels
         :param masked_bands: List of indices corresponding to which bands to mask out
         :param dropped_bands:  List of indices corresponding to which bands to drop from input image tensor
+        :param packed_dir: Patch cache built with `python -m util.packed_store --dataset_type bigearthnet`,
+            defaults to <csv dir>/<csv name>_packed. Patches missing from the cache are read from their folder.
+        :param index_cache_dir: Directory to save/load the parsed label matrix, None to not cache
+        :param mean: Per-band mean overriding the class attribute, e.g. from util.band_stats
+        :param std: Per-band std overriding the class attribute
         """
         super().__init__(in_c=13)
-        self.df = pd.read_csv(csv_path) \
+        df = pd.read_csv(csv_path) \
             .sort_values(['category', 'location_id', 'timestamp'])
 
         # Filter by category
@@ -563,10 +1168,22 @@ class BigEarthNetImageDataset(SatelliteDataset):
 
         # Filter by year
         if years is not None:
-            self.df['year'] = [int(timestamp.split('-')[0]) for timestamp in self.df['timestamp']]
-            self.df = self.df[self.df['year'].isin(years)]
+            df['year'] = [int(timestamp.split('-')[0]) for timestamp in df['timestamp']]
+            df = df[df['year'].isin(years)]
+
+        self.indices = df.index.unique().to_numpy()
 
-        self.indices = self.df.index.unique().to_numpy()
+        # Only flat numpy columns are kept, the DataFrame is dropped after init
+        self.patch_paths = StringColumn(df['patch_path'])
+
+        # Multi-hot labels of every csv row, parsed once instead of eval() + list.index per sample
+        cache_path = index_cache_path(index_cache_dir, csv_path, 'label_matrix')
+        index = load_index_cache(cache_path, csv_path)
+        if index is None:
+            index = {'label_matrix': self.build_label_matrix(pd.read_csv(csv_path)['category'], self.categories)}
+            save_index_cache(cache_path, csv_path, **index)
+        # df keeps the csv row numbers as its index through the sort and year filter
+        self.label_matrix = index['label_matrix'][df.index.to_numpy()]  # (N, num_categories) uint8
 
         self.transform = transform
 
@@ -576,16 +1193,41 @@ class BigEarthNetImageDataset(SatelliteDataset):
                 ', '.join(self.label_types))
         self.label_type = label_type
 
-        self.masked_bands = masked_bands
-        self.dropped_bands = dropped_bands
-        if self.dropped_bands is not None:
-            self.in_c = self.in_c - len(dropped_bands)
+        if mean is not None:
+            self.mean, self.std = mean, std
+        self.select_bands(masked_bands, dropped_bands)
+
+        packed_dir = packed_dir or default_packed_dir(csv_path)
+        self.store = PackedArrayStore(packed_dir) if os.path.exists(os.path.join(packed_dir, INDEX_NAME)) else None
 
     def __len__(self):
-        return len(self.df)
+        return len(self.patch_paths)
 
-    def open_image(self, img_path):
+    @staticmethod
+    def build_label_matrix(category_column, categories):
+        """
+        Parses the category column (string lists such as "['Pastures', 'Inland waters']") into multi-hot rows.
+        Each distinct string is only parsed once.
+        :param category_column: (N,) category strings
+        :param categories: Category names, in label index order
+        :return: (N, len(categories)) uint8 multi-hot matrix
+        """
+        category_idx = {c: i for i, c in enumerate(categories)}
+        codes, uniques = pd.factorize(category_column)
+        unique_matrix = np.zeros((len(uniques), len(categories)), dtype=np.uint8)
+        for row, labels in enumerate(uniques):
+            for label in ast.literal_eval(labels):
+                unique_matrix[row, category_idx[label]] = 1
+        return unique_matrix[codes]
 
+    @staticmethod
+    def read_raw(img_path, bands: Optional[List[int]] = None, pool: Optional[ThreadPoolExecutor] = None):
+        """
+        Reads the single-band TIFFs of a patch folder and resamples them to a common 20m grid.
+        :param bands: Band indices to read, None for all bands. Files of the other bands are not opened.
+        :param pool: Thread pool to read the band files in parallel, None to read them one after another
+        :return: (c, 60, 60) array in the stored dtype, None if img_path is not a folder
+        """
         if os.path.isdir(img_path):
 
             # Handle directory case
@@ -602,14 +1244,9 @@ class BigEarthNetImageDataset(SatelliteDataset):
             # Create empty list to store sorted files
             sorted_files = []
 
-            # Read first file to get initial dimensions and data type
+            # Read first file's header to get the data type
             with rasterio.open(os.path.join(img_path, tif_files[0])) as data:
-                bands = len(tif_files)
-                height, width = data.height, data.width
-                dtype = data.read(1).dtype
-
-            # Create empty array to store stacked bands
-            stacked_img = np.empty((bands, 60, 60), dtype=dtype)
+                dtype = data.dtypes[0]
 
             # Sort files based on desired band order
             for file_name in tif_files:
@@ -617,8 +1254,13 @@ class BigEarthNetImageDataset(SatelliteDataset):
                     if target_string in file_name:
                         sorted_files.append(file_name)
                         break
+            if bands is not None:
+                sorted_files = [sorted_files[i] for i in bands]
+
+            # Create empty array to store stacked bands
+            stacked_img = np.empty((len(sorted_files), 60, 60), dtype=dtype)
             # Read and resample each TIFF file to 20x20 size
-            for i, file_name in enumerate(sorted_files):
+            def read_band(file_name):
                 with rasterio.open(os.path.join(img_path, file_name)) as data:
                     resampled_data = reproject(
                         data.read(1), 
@@ -629,11 +1271,34 @@ class BigEarthNetImageDataset(SatelliteDataset):
                         dst_resolution=(20, 20), 
                         resampling=rasterio.enums.Resampling.nearest
                     )
-                    stacked_img[i, :, :] = resampled_data[0]
+                return resampled_data[0]
+
+            band_imgs = pool.map(read_band, sorted_files) if pool is not None else map(read_band, sorted_files)
+            for i, band in enumerate(band_imgs):
+                stacked_img[i, :, :] = band
 
 
-            # Return transposed and casted image
-            return stacked_img.transpose(1, 2, 0).astype(np.float32)
+            return stacked_img
+
+    def read_bands(self, img_path, bands=None):
+        return self.read_raw(img_path, bands, pool=self.read_pool())
+
+    def open_image(self, img_path):
+        """
+        :return: (h, w, c) float32 image of the kept bands, None if img_path is not a folder
+        """
+        if self.store is not None and img_path in self.store:
+            # Ready (c, h, w) patch from the packed cache, zero-copy view of the memory-mapped shard
+            stacked_img = self.store.get(img_path)
+            if self.keep_bands is not None:
+                stacked_img = stacked_img[self.keep_bands]
+        else:
+            stacked_img = self.cached_read(self.read_bands, img_path, self.keep_bands)
+            if stacked_img is None:
+                return None
+
+        # Return transposed and casted image
+        return stacked_img.transpose(1, 2, 0).astype(np.float32)
 
     def __getitem__(self, idx):
         """
@@ -641,42 +1306,27 @@ class BigEarthNetImageDataset(SatelliteDataset):
         :param idx: Index of (image, label) pair in dataset dataframe. (c, h, w)
         :return: Torch Tensor image, and integer label as a tuple.
         """
-        selection = self.df.iloc[idx]
-
         # images = [torch.FloatTensor(rasterio.open(img_path).read()) for img_path in image_paths]
-        images = self.open_image(selection['patch_path'])  # (h, w, c)
+        images = self.open_image(self.patch_paths[idx])  # (h, w, c)
         if self.masked_bands is not None:
-            images[:, :, self.masked_bands] = np.array(self.mean)[self.masked_bands]
+            self.mask_bands(images)
 
-        labels = eval(selection['category'])  # List of category strings
-        label_tensor = torch.zeros(len(self.categories))
+        label_tensor = torch.from_numpy(self.label_matrix[idx].astype(np.float32))  # multi-hot (num_categories,)
 
-        # One-hot encode each label in the list
-        for label in labels:
-            label_idx = self.categories.index(label)
-            label_tensor[label_idx] = 1
-        
         img_as_tensor = self.transform(images)  # (c, h, w)
-        if self.dropped_bands is not None:
-            keep_idxs = [i for i in range(img_as_tensor.shape[0]) if i not in self.dropped_bands]
-            img_as_tensor = img_as_tensor[keep_idxs, :, :]
-
-        sample = {
-            'images': images,
-            'labels': label_tensor,
-            'timestamps': selection['timestamp']
-        }
         return img_as_tensor, label_tensor
 
     @staticmethod
-    def build_transform(is_train, input_size, mean, std):
+    def build_transform(is_train, input_size, mean, std, uint8=False):
         # train transform
         interpol_mode = transforms.InterpolationMode.BICUBIC
+        # uint8 keeps SentinelNormalize's output as uint8 tensors until the batch reaches the device
+        to_tensor = ToUint8Tensor() if uint8 else transforms.ToTensor()
 
         t = []
         if is_train:
             t.append(SentinelNormalize(mean, std))  # use specific Sentinel normalization to avoid NaN
-            t.append(transforms.ToTensor())
+            t.append(to_tensor)
             t.append(
                 transforms.RandomResizedCrop(input_size, scale=(0.2, 1.0), interpolation=interpol_mode),  # 3 is bicubic
             )
@@ -691,7 +1341,7 @@ class BigEarthNetImageDataset(SatelliteDataset):
         size = int(input_size / crop_pct)
 
         t.append(SentinelNormalize(mean, std))
-        t.append(transforms.ToTensor())
+        t.append(to_tensor)
         t.append(
             transforms.Resize(size, interpolation=interpol_mode),  # to maintain same ratio w.r.t. 224 images
         )
@@ -709,13 +1359,17 @@ class EuroSat(SatelliteDataset):
            948.9819932, 1108.06650639, 1258.36394548, 1233.1492281,
            1364.38688993, 472.37967789, 14.3114637, 1310.36996126, 1087.6020813]
 
-    def __init__(self, file_path, transform, masked_bands=None, dropped_bands=None):
+    def __init__(self, file_path, transform, masked_bands=None, dropped_bands=None, window_reader=None,
+                 mean=None, std=None):
         """
         Creates dataset for multi-spectral single image classification for EuroSAT.
         :param file_path: path to txt file containing paths to image data for EuroSAT.
-        :param transform: pytorch Transform for transforms and tensor conversion
+        :param transform: pytorch Transform for transforms and tensor conversion, None to return raw (c, h, w) tiles for util.batch_aug
         :param masked_bands: List of indices corresponding to which bands to mask out
         :param dropped_bands:  List of indices corresponding to which bands to drop from input image tensor
+        :param window_reader: Reads only the crop window of each image, transform must be built with windowed=True
+        :param mean: Per-band mean overriding the class attribute, e.g. from util.band_stats
+        :param std: Per-band std overriding the class attribute
         """
         super().__init__(13)
         with open(file_path, 'r') as f:
@@ -725,34 +1379,57 @@ class EuroSat(SatelliteDataset):
 
         self.transform = transform
 
-        self.masked_bands = masked_bands
-        self.dropped_bands = dropped_bands
-        if self.dropped_bands is not None:
-            self.in_c = self.in_c - len(dropped_bands)
+        if mean is not None:
+            self.mean, self.std = mean, std
+        self.select_bands(masked_bands, dropped_bands)
+
+        self.window_reader = window_reader
 
     def __len__(self):
         return len(self.img_paths)
 
-    def open_image(self, img_path):
+    def open_raw(self, img_path):
+        """
+        :return: (c, h, w) image of the kept bands in its stored dtype
+        """
+        if self.window_reader is not None:
+            return self.window_reader(img_path, self.keep_bands)  # (c, input_size, input_size)
+        return self.cached_read(self.read_raw, img_path, self.keep_bands)
+
+    @staticmethod
+    def read_raw(img_path, bands=None):
         with rasterio.open(img_path) as data:
-            img = data.read()  # (c, h, w)
+            if bands is None:
+                return data.read()  # (c, h, w)
+            return data.read([b + 1 for b in bands])
 
+    def open_image(self, img_path):
+        img = self.open_raw(img_path)  # (c, h, w)
         return img.transpose(1, 2, 0).astype(np.float32)  # (h, w, c)
 
     def __getitem__(self, idx):
         img_path, label = self.img_paths[idx], self.labels[idx]
+        if self.transform is None:
+            # Raw tile, normalization and augmentation happen batched on the device (util.batch_aug)
+            return to_raw_tensor(self.open_raw(img_path)), label
+
         img = self.open_image(img_path)  # (h, w, c)
         if self.masked_bands is not None:
-            img[:, :, self.masked_bands] = np.array(self.mean)[self.masked_bands]
+            self.mask_bands(img)
 
         img_as_tensor = self.transform(img)  # (c, h, w)
-        if self.dropped_bands is not None:
-            keep_idxs = [i for i in range(img_as_tensor.shape[0]) if i not in self.dropped_bands]
-            img_as_tensor = img_as_tensor[keep_idxs, :, :]
-
         return img_as_tensor, label
 
 
+def band_mean_std(dataset_cls, args):
+    """
+    :return: Per-band mean and std of all bands, from the --band_stats file if given, else the class attributes
+    """
+    if args.band_stats is None:
+        return dataset_cls.mean, dataset_cls.std
+    return load_band_stats(args.band_stats, len(dataset_cls.mean))
+
+
 def build_fmow_dataset(is_train: bool, args) -> SatelliteDataset:
     """
     Initializes a SatelliteDataset object given provided args.
@@ -761,42 +1438,107 @@ def build_fmow_dataset(is_train: bool, args) -> SatelliteDataset:
     :return: SatelliteDataset object.
     """
     csv_path = os.path.join(args.train_path if is_train else args.test_path)
+    if args.windowed_reads and args.dataset_type not in ('sentinel', 'euro_sat'):
+        raise ValueError(f"--windowed_reads is not supported for dataset type {args.dataset_type}")
+    window_reader = RasterWindowReader(is_train, args.input_size) if args.windowed_reads else None
+    if args.batch_aug:
+        if args.dataset_type not in ('sentinel', 'sentinel_packed', 'sentinel_stream', 'euro_sat'):
+            raise ValueError(f"--batch_aug is not supported for dataset type {args.dataset_type}")
+        if window_reader is not None:
+            raise ValueError("--batch_aug crops and resizes on the device, it cannot be combined with --windowed_reads")
+        if args.uint8_transport:
+            raise ValueError("--batch_aug already transfers raw tiles, it cannot be combined with --uint8_transport")
+    if args.uint8_transport and args.dataset_type not in ('sentinel', 'sentinel_packed', 'sentinel_stream',
+                                                          'bigearthnet'):
+        raise ValueError(f"--uint8_transport is not supported for dataset type {args.dataset_type}")
+    if args.jpeg_draft and args.dataset_type not in ('rgb', 'temporal', 'rgb_temporal_stacked'):
+        raise ValueError(f"--jpeg_draft is not supported for dataset type {args.dataset_type}")
+    if args.variable_frames and args.dataset_type != 'temporal':
+        raise ValueError(f"--variable_frames is not supported for dataset type {args.dataset_type}")
+    # Shorter side the JPEGs of the RGB datasets need to be decoded at
+    decode_size = draft_size(is_train, args.input_size) if args.jpeg_draft else None
+    if args.band_stats is not None and args.dataset_type not in ('sentinel', 'sentinel_packed', 'sentinel_stream',
+                                                                 'bigearthnet', 'euro_sat'):
+        raise ValueError(f"--band_stats is not supported for dataset type {args.dataset_type}")
 
     if args.dataset_type == 'rgb':
         mean = CustomDatasetFromImages.mean
         std = CustomDatasetFromImages.std
         transform = CustomDatasetFromImages.build_transform(is_train, args.input_size, mean, std)
-        dataset = CustomDatasetFromImages(csv_path, transform)
+        dataset = CustomDatasetFromImages(csv_path, transform, decode_size=decode_size)
     elif args.dataset_type == 'temporal':
-        dataset = CustomDatasetFromImagesTemporal(csv_path)
+        dataset = CustomDatasetFromImagesTemporal(csv_path, index_cache_dir=args.index_cache_dir,
+                                                  reduced_decode=args.jpeg_draft, max_frames=args.max_frames,
+                                                  variable_frames=args.variable_frames)
     elif args.dataset_type == 'sentinel':
-        mean = SentinelIndividualImageDataset.mean
-        std = SentinelIndividualImageDataset.std
-        transform = SentinelIndividualImageDataset.build_transform(is_train, args.input_size, mean, std)
+        mean, std = band_mean_std(SentinelIndividualImageDataset, args)
+        # transforms only see the kept bands
+        transform = SentinelIndividualImageDataset.build_transform(is_train, args.input_size,
+                                                                   kept_bands(mean, args.dropped_bands),
+                                                                   kept_bands(std, args.dropped_bands),
+                                                                   windowed=window_reader is not None,
+                                                                   uint8=args.uint8_transport)
+        if args.batch_aug:
+            transform = None  # workers return raw tiles, see util.batch_aug
         dataset = SentinelIndividualImageDataset(csv_path, transform, masked_bands=args.masked_bands,
-                                                 dropped_bands=args.dropped_bands)
+                                                 dropped_bands=args.dropped_bands, window_reader=window_reader,
+                                                 mean=mean, std=std)
+    elif args.dataset_type == 'sentinel_stream':
+        mean, std = band_mean_std(SentinelStreamDataset, args)
+        transform = SentinelStreamDataset.build_transform(is_train, args.input_size,
+                                                          kept_bands(mean, args.dropped_bands),
+                                                          kept_bands(std, args.dropped_bands),
+                                                          uint8=args.uint8_transport)
+        if args.batch_aug:
+            transform = None  # workers return raw tiles, see util.batch_aug
+        dataset = SentinelStreamDataset(default_shard_dir(csv_path), transform, is_train=is_train,
+                                        shuffle_buffer_size=args.shuffle_buffer, masked_bands=args.masked_bands,
+                                        dropped_bands=args.dropped_bands, seed=args.seed, mean=mean, std=std)
+    elif args.dataset_type == 'sentinel_packed':
+        mean, std = band_mean_std(SentinelPackedImageDataset, args)
+        transform = SentinelPackedImageDataset.build_transform(is_train, args.input_size,
+                                                               kept_bands(mean, args.dropped_bands),
+                                                               kept_bands(std, args.dropped_bands),
+                                                               uint8=args.uint8_transport)
+        if args.batch_aug:
+            transform = None  # workers return raw tiles, see util.batch_aug
+        dataset = SentinelPackedImageDataset(csv_path, transform, masked_bands=args.masked_bands,
+                                             dropped_bands=args.dropped_bands, mean=mean, std=std)
     # add bigearthnet
     elif args.dataset_type == 'bigearthnet':
-        mean = BigEarthNetImageDataset.mean
-        std = BigEarthNetImageDataset.std
-        transform = BigEarthNetImageDataset.build_transform(is_train, args.input_size, mean, std)
+        mean, std = band_mean_std(BigEarthNetImageDataset, args)
+        transform = BigEarthNetImageDataset.build_transform(is_train, args.input_size,
+                                                            kept_bands(mean, args.dropped_bands),
+                                                            kept_bands(std, args.dropped_bands),
+                                                            uint8=args.uint8_transport)
         dataset = BigEarthNetImageDataset(csv_path, transform, masked_bands=args.masked_bands,
-                                                 dropped_bands=args.dropped_bands)
+                                          dropped_bands=args.dropped_bands, index_cache_dir=args.index_cache_dir,
+                                          mean=mean, std=std)
     elif args.dataset_type == 'rgb_temporal_stacked':
         mean = FMoWTemporalStacked.mean
         std = FMoWTemporalStacked.std
         transform = FMoWTemporalStacked.build_transform(is_train, args.input_size, mean, std)
-        dataset = FMoWTemporalStacked(csv_path, transform)
+        dataset = FMoWTemporalStacked(csv_path, transform, index_cache_dir=args.index_cache_dir,
+                                      decode_size=decode_size)
     elif args.dataset_type == 'euro_sat':
-        mean, std = EuroSat.mean, EuroSat.std
-        transform = EuroSat.build_transform(is_train, args.input_size, mean, std)
-        dataset = EuroSat(csv_path, transform, masked_bands=args.masked_bands, dropped_bands=args.dropped_bands)
+        mean, std = band_mean_std(EuroSat, args)
+        transform = EuroSat.build_transform(is_train, args.input_size, kept_bands(mean, args.dropped_bands),
+                                            kept_bands(std, args.dropped_bands), windowed=window_reader is not None)
+        if args.batch_aug:
+            transform = None  # workers return raw tiles, see util.batch_aug
+        dataset = EuroSat(csv_path, transform, masked_bands=args.masked_bands, dropped_bands=args.dropped_bands,
+                          window_reader=window_reader, mean=mean, std=std)
     elif args.dataset_type == 'naip':
-        from util.naip_loader import NAIP_train_dataset, NAIP_test_dataset, NAIP_CLASS_NUM
-        dataset = NAIP_train_dataset if is_train else NAIP_test_dataset
-        args.nb_classes = NAIP_CLASS_NUM
+        from util.naip_loader import build_naip_dataset
+        dataset, args.nb_classes = build_naip_dataset(is_train, args)
     else:
         raise ValueError(f"Invalid dataset type: {args.dataset_type}")
+
+    if isinstance(dataset, SatelliteDataset):
+        dataset.read_threads = args.read_threads
+    if args.sample_cache_gb > 0:
+        from util.sample_cache import SharedSampleCache
+        dataset.sample_cache = SharedSampleCache(args.sample_cache_dir, int(args.sample_cache_gb * 1024**3))
     print(dataset)
 
     return dataset
\ No newline at end of file
@@ -346,9 +346,13 @@ def get_grad_norm_(parameters, norm_type: float = 2.0) -> torch.Tensor:
     return total_norm
 
 
-def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler):
+def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler, sampler_state=None, tag=None):
+    """
+    :param sampler_state: ResumableDistributedSampler.state_dict() of the position to resume from
+    :param tag: Checkpoint name suffix, defaults to the epoch
+    """
     output_dir = Path(args.output_dir)
-    epoch_name = str(epoch)
+    epoch_name = str(epoch) if tag is None else tag
     if loss_scaler is not None:
         checkpoint_paths = [output_dir / ('checkpoint-%s.pth' % epoch_name)]
         for checkpoint_path in checkpoint_paths:
@@ -359,14 +363,43 @@ def save_model(args, epoch, model, model_without_ddp, optimizer, loss_scaler):
                 'scaler': loss_scaler.state_dict(),
                 'args': args,
             }
-
-            save_on_master(to_save, checkpoint_path)
+            if sampler_state is not None:
+                to_save['sampler'] = sampler_state
+
+            # Written under a temporary name, a job killed while saving keeps the previous checkpoint
+            tmp_path = checkpoint_path.with_name(checkpoint_path.name + '.tmp')
+            save_on_master(to_save, tmp_path)
+            if is_main_process():
+                os.replace(tmp_path, checkpoint_path)
     else:
         client_state = {'epoch': epoch}
+        if sampler_state is not None:
+            client_state['sampler'] = sampler_state
         model.save_checkpoint(save_dir=args.output_dir, tag="checkpoint-%s" % epoch_name, client_state=client_state)
 
 
-def load_model(args, model_without_ddp, optimizer, loss_scaler):
+def save_step_checkpoint(args, epoch, step, num_steps, model, optimizer, loss_scaler, data_loader):
+    """
+    Overwrites checkpoint-last.pth every args.save_every_steps iterations of an epoch, with the sampler position
+    after the current iteration. Called by the training engines after every iteration; the last iteration of an
+    epoch is left to the end-of-epoch checkpoint of the main loop.
+    :param step: Iteration within the epoch, counting the iterations skipped on resume
+    :param num_steps: Iterations of the full epoch
+    """
+    if not args.output_dir or not getattr(args, 'save_every_steps', 0):
+        return
+    if (step + 1) % args.save_every_steps != 0 or step + 1 == num_steps:
+        return
+    model_without_ddp = model.module if hasattr(model, 'module') else model
+    sampler_state = data_loader.sampler.state_dict((step + 1) * args.batch_size)
+    save_model(args=args, epoch=epoch, model=model, model_without_ddp=model_without_ddp, optimizer=optimizer,
+               loss_scaler=loss_scaler, sampler_state=sampler_state, tag='last')
+
+
+def load_model(args, model_without_ddp, optimizer, loss_scaler, sampler=None):
+    """
+    :param sampler: ResumableDistributedSampler, fast-forwarded to the position saved in the checkpoint
+    """
     if args.resume:
         if args.resume.startswith('https'):
             # check hash changed to False >> issues w/ some ckpts
@@ -387,6 +420,11 @@ def load_model(args, model_without_ddp, optimizer, loss_scaler):
             if 'scaler' in checkpoint:
                 loss_scaler.load_state_dict(checkpoint['scaler'])
             print("With optim & sched!")
+            if 'sampler' in checkpoint and sampler is not None:
+                # Step checkpoints resume within their epoch
+                sampler.load_state_dict(checkpoint['sampler'])
+                args.start_epoch = sampler.epoch
+                print(f"Resuming epoch {sampler.epoch} after {sampler.start_index} samples per process")
 
 
 def all_reduce_mean(x):
@@ -1,19 +1,27 @@
-from torch.utils.data import Dataset, DataLoader
-from torchvision import transforms
-import torch
-import glob
+"""
+NAIP tiles dataset.
+
+The tile directory holds one (H, W, C) array per tile, named <i>tile.npy for i = 1..N, plus y.npy with the
+label of every tile. splits.npy assigns every tile to train (0), val (1) or test (2).
+
+Nothing is read at import time: build_naip_dataset loads labels and splits from the paths given on the command
+line. Reading thousands of small .npy files is slow, so the tiles can be consolidated once into a single
+memory-mapped (N, H, W, C) array with:
+    python -m util.naip_loader --tile_dir <tile dir>
+A sample is then a zero-copy slice of that array, and only the bands used by the model are copied out of it.
+"""
+import argparse
 import os
+from multiprocessing import Pool
+
 import numpy as np
-import pandas as pd
-from sklearn.preprocessing import LabelEncoder
+import torch
+from torch.utils.data import Dataset
+from torchvision import transforms
+
+
+CONSOLIDATED_NAME = 'tiles_consolidated.npy'
 
-print('==> Prepping data...')
-# tile_dir = '/home/supervised_50_100/'  # change it with your path to the tiles
-# y_fn = '/home/y_50_100.npy'  # change it with your path to the labels
-# splits_fn = '/home/splits.npy'  # change it with your path to the splits
-tile_dir = "/home/ada/satmae/other_data/naip/tiles"
-y_fn = "/home/ada/satmae/other_data/naip/tiles/y.npy"
-splits_fn = "/home/ada/satmae/other_data/naip/splits.npy"
 
 def clip_and_scale_image(img, img_type='naip', clip_min=0, clip_max=10000):
     """
@@ -64,75 +72,178 @@ mean = [0.47996818, 0.47633689, 0.42402868]
 std = [0.17774512, 0.13703743, 0.11909943]
 
 
-transform_tr = transforms.Compose([
-    ClipAndScaleSinglePatch('naip'),
-    RandomFlipAndRotateSinglePatch(),
-    
-    ToFloatTensorSinglePatch(),
-    transforms.Normalize(mean, std),
-    #transforms.Scale(224),
-    transforms.Resize(224),
-])
-transform_val = transforms.Compose([
-    ClipAndScaleSinglePatch('naip'),
-    
-    ToFloatTensorSinglePatch(),
-    transforms.Normalize(mean, std),
-    #transforms.Scale(224),
-    transforms.Resize(224),
-])
-transform_te = transforms.Compose([
-    ClipAndScaleSinglePatch('naip'),
-    
-    ToFloatTensorSinglePatch(),
-    transforms.Normalize(mean, std),
-    #transforms.Scale(224),
-    transforms.Resize(224),
-])
-
-
-# Encode labels
-y = np.load(y_fn)
-le = LabelEncoder()
-le.fit(y)
-n_classes = len(le.classes_)
-labels = le.transform(y)
-NAIP_LABELS = labels
-NAIP_CLASS_NUM = n_classes
-
-# Getting train/val/test idxs
-splits = np.load(splits_fn)
-idxs_tr = np.where(splits == 0)[0]
-idxs_val = np.where(splits == 1)[0]
-idxs_te = np.where(splits == 2)[0]
-idxs_te = np.concatenate((idxs_val, idxs_te))
+def build_transform(is_train: bool, input_size: int = 224):
+    """
+    :param is_train: Adds random flips and rotations if True
+    :param input_size: Size the tiles are resized to
+    """
+    t = [ClipAndScaleSinglePatch('naip')]
+    if is_train:
+        t.append(RandomFlipAndRotateSinglePatch())
+    t.extend([
+        ToFloatTensorSinglePatch(),
+        transforms.Normalize(mean, std),
+        transforms.Resize(input_size),
+    ])
+    return transforms.Compose(t)
+
+
+transform_tr = build_transform(is_train=True)
+transform_val = build_transform(is_train=False)
+transform_te = build_transform(is_train=False)
+
+
+def default_labels_path(tile_dir: str) -> str:
+    return os.path.join(tile_dir, 'y.npy')
+
+
+def default_splits_path(tile_dir: str) -> str:
+    return os.path.join(os.path.dirname(os.path.normpath(tile_dir)), 'splits.npy')
+
+
+def load_labels(y_path: str):
+    """
+    Encodes the labels as 0..n_classes-1, in sorted order of the raw labels (as sklearn's LabelEncoder does).
+    :return: (N,) int64 labels, number of classes
+    """
+    classes, labels = np.unique(np.load(y_path), return_inverse=True)
+    return labels.astype(np.int64), len(classes)
+
+
+def load_split_idxs(splits_path: str, is_train: bool) -> np.ndarray:
+    """
+    :return: Tile indices of the train split, or of the val and test splits together
+    """
+    splits = np.load(splits_path)
+    if is_train:
+        return np.where(splits == 0)[0]
+    return np.concatenate((np.where(splits == 1)[0], np.where(splits == 2)[0]))
+
+
+def tile_path(tile_dir: str, p_idx: int) -> str:
+    # Tile files are numbered from 1
+    return os.path.join(tile_dir, '{}tile.npy'.format(p_idx + 1))
 
 
 class NAIP(Dataset):
     def __init__(self, tile_dir, tile_idxs, labels=None,
-        transform=None):
-        self.in_c = 3
+        transform=None, bands=3):
+        """
+        :param tile_dir: Directory with the <i>tile.npy files (and optionally their consolidated array)
+        :param tile_idxs: Tile indices of this split
+        :param labels: (N,) labels of all tiles
+        :param transform: Transform applied to the (bands, H, W) tile
+        :param bands: Number of leading bands (R, G, B, ...) to use
+        """
+        self.in_c = bands
         self.tile_dir = tile_dir
         self.tile_idxs = tile_idxs
         self.labels = labels
         self.transform = transform
 
+        consolidated_path = os.path.join(tile_dir, CONSOLIDATED_NAME)
+        self.consolidated_path = consolidated_path if os.path.exists(consolidated_path) else None
+        # Mapped lazily, so every DataLoader worker maps it after the fork
+        self._tiles = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_tiles'] = None  # a pickled memmap would be a full in-memory copy
+        return state
+
     def __len__(self):
         return len(self.tile_idxs)
 
+    def tiles(self) -> np.ndarray:
+        """
+        :return: Read-only memory-mapped (N, H, W, C) array of all tiles
+        """
+        if self._tiles is None:
+            self._tiles = np.load(self.consolidated_path, mmap_mode='r')
+        return self._tiles
+
+    def open_tile(self, p_idx) -> np.ndarray:
+        """
+        :return: (bands, H, W) read-only view of the tile
+        """
+        if self.consolidated_path is not None:
+            p = self.tiles()[p_idx, :, :, :self.in_c]
+        else:
+            p = np.load(tile_path(self.tile_dir, p_idx), mmap_mode='r')[:, :, :self.in_c]
+        return np.moveaxis(p, -1, 0)
+
     def __getitem__(self, idx):
         p_idx = self.tile_idxs[idx]
-        #p = np.load(os.path.join(self.tile_dir, '{}tile.npy'.format(p_idx)))
-        p = np.load(os.path.join(self.tile_dir, '{}tile.npy'.format(p_idx + 1)))
-        p = p[:, :, :3]
-        p = np.moveaxis(p, -1, 0)
+        p = self.open_tile(p_idx)
         y = self.labels[p_idx]
         if self.transform:
             p = self.transform(p)
         return (p, y)
 
-# Setting up Datasets
-NAIP_train_dataset = NAIP(tile_dir, idxs_tr, labels=labels, transform=transform_tr)
-NAIP_test_dataset = NAIP(tile_dir, idxs_te, labels=labels, transform=transform_te)
-    
-    
+
+def build_naip_dataset(is_train: bool, args):
+    """
+    :param args: Needs naip_tile_dir, and optionally naip_labels_path, naip_splits_path and input_size
+    :return: NAIP dataset of the split, number of classes
+    """
+    if args.naip_tile_dir is None:
+        raise ValueError('--naip_tile_dir is required for the naip dataset')
+    labels, n_classes = load_labels(args.naip_labels_path or default_labels_path(args.naip_tile_dir))
+    tile_idxs = load_split_idxs(args.naip_splits_path or default_splits_path(args.naip_tile_dir), is_train)
+
+    transform = build_transform(is_train, args.input_size)
+    dataset = NAIP(args.naip_tile_dir, tile_idxs, labels=labels, transform=transform)
+    return dataset, n_classes
+
+
+def consolidate_tiles(tile_dir: str, num_tiles: int, out_path: str = None, num_workers: int = 8):
+    """
+    Copies tiles 1..num_tiles into a single (num_tiles, H, W, C) .npy array, which NAIP memory-maps when present.
+    All tiles must share shape and dtype.
+    :param tile_dir: Directory with the <i>tile.npy files
+    :param num_tiles: Number of tiles (length of y.npy)
+    :param out_path: Output path, defaults to <tile_dir>/tiles_consolidated.npy
+    :param num_workers: Number of reader processes
+    """
+    out_path = out_path or os.path.join(tile_dir, CONSOLIDATED_NAME)
+    first = np.load(tile_path(tile_dir, 0), mmap_mode='r')
+
+    # Written under a temporary name, so an interrupted run is never mistaken for a complete array
+    tmp_path = out_path + '.tmp.npy'
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=first.dtype, shape=(num_tiles,) + first.shape)
+    paths = [tile_path(tile_dir, i) for i in range(num_tiles)]
+    with Pool(num_workers) as pool:
+        for i, tile in enumerate(pool.imap(np.load, paths, chunksize=64)):
+            if tile.shape != first.shape or tile.dtype != first.dtype:
+                raise ValueError(f'{paths[i]} is {tile.dtype} {tile.shape}, expected {first.dtype} {first.shape}')
+            out[i] = tile
+
+            if i % 10000 == 0:
+                print(f'Consolidated {i}/{num_tiles} tiles')
+    out.flush()
+    del out
+    os.replace(tmp_path, out_path)
+    print(f'Consolidated {num_tiles} tiles into {out_path}')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Consolidate NAIP tiles into one memory-mapped array', add_help=False)
+    parser.add_argument('--tile_dir', required=True, type=str,
+                        help='Directory with the <i>tile.npy files')
+    parser.add_argument('--labels_path', default=None, type=str,
+                        help='Tile labels, defaults to <tile_dir>/y.npy')
+    parser.add_argument('--out_path', default=None, type=str,
+                        help='Output .npy path, defaults to <tile_dir>/tiles_consolidated.npy')
+    parser.add_argument('--num_workers', default=8, type=int)
+    return parser
+
+
+def main(args):
+    num_tiles = len(np.load(args.labels_path or default_labels_path(args.tile_dir), mmap_mode='r'))
+    consolidate_tiles(args.tile_dir, num_tiles, out_path=args.out_path, num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,176 @@
+"""
+Packed, memory-mapped image store.
+
+Images are written back to back as raw arrays into a few large shard files, plus an
+index.npz mapping each key (usually the image path from the csv) to its shard, byte
+offset and shape. Reading an image is then a zero-copy slice of a memory-mapped shard
+instead of a GDAL open, a header parse and a full read.
+
+Build a store from a dataset csv with:
+    python -m util.packed_store --dataset_type sentinel --csv_path <train.csv>
+or, for BigEarthNet patch folders:
+    python -m util.packed_store --dataset_type bigearthnet --csv_path <train_multi_band.csv>
+"""
+import argparse
+import os
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+
+
+INDEX_NAME = 'index.npz'
+
+
+def default_packed_dir(csv_path: str) -> str:
+    """
+    Default location of the packed store for a csv: <csv dir>/<csv name>_packed
+    """
+    return os.path.splitext(csv_path)[0] + '_packed'
+
+
+class PackedArrayStore:
+    def __init__(self, root: str):
+        """
+        Read side of a packed store.
+        :param root: Directory containing index.npz and the shard files
+        """
+        self.root = root
+        with np.load(os.path.join(root, INDEX_NAME)) as index:
+            self.keys = index['keys']  # (N,) sorted utf-8 encoded keys
+            self.shards = index['shards']  # (N,) shard file of each key
+            self.offsets = index['offsets']  # (N,) byte offset in the shard
+            self.shapes = index['shapes']  # (N, ndim) array shape
+            self.shard_names = [str(name) for name in index['shard_names']]
+            self.dtype = np.dtype(str(index['dtype']))
+
+        # Shards are mapped lazily, so every DataLoader worker maps them after the fork
+        self._maps = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def find(self, key: str) -> int:
+        """
+        :return: Position of key in the index, -1 if missing
+        """
+        key = key.encode()
+        i = np.searchsorted(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return int(i)
+        return -1
+
+    def __contains__(self, key: str):
+        return self.find(key) >= 0
+
+    def get(self, key: str) -> np.ndarray:
+        """
+        :param key: Key the array was stored under
+        :return: Read-only view of the stored array, backed by the memory-mapped shard
+        """
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(f'{key} is not in packed store {self.root}')
+
+        shard = self.shards[i]
+        if shard not in self._maps:
+            self._maps[shard] = np.memmap(os.path.join(self.root, self.shard_names[shard]),
+                                          dtype=self.dtype, mode='r')
+        start = self.offsets[i] // self.dtype.itemsize
+        shape = tuple(self.shapes[i])
+        return self._maps[shard][start:start + int(np.prod(shape))].reshape(shape)
+
+
+def write_packed_store(root: str, keys, read_fn, dtype=np.uint16, shard_size=4 * 1024**3, num_workers=8):
+    """
+    Reads every key with read_fn (in parallel) and packs the results into shard files under root.
+    :param root: Output directory
+    :param keys: Keys to store, e.g. image paths
+    :param read_fn: Picklable function mapping a key to a numpy array
+    :param dtype: dtype of the stored arrays, values must fit without loss
+    :param shard_size: Approximate size of each shard file in bytes
+    :param num_workers: Number of reader processes
+    """
+    os.makedirs(root, exist_ok=True)
+    keys = sorted(set(keys))
+    dtype = np.dtype(dtype)
+
+    shards = np.zeros(len(keys), dtype=np.int32)
+    offsets = np.zeros(len(keys), dtype=np.int64)
+    shapes = None
+    shard_names = []
+    f, shard_bytes = None, 0
+
+    with Pool(num_workers) as pool:
+        for i, img in enumerate(pool.imap(read_fn, keys, chunksize=16)):
+            if img is None:
+                raise ValueError(f'{keys[i]} could not be read')
+            if img.dtype != dtype:
+                info = np.iinfo(dtype)
+                if img.min() < info.min or img.max() > info.max:
+                    raise ValueError(f'{keys[i]} has values outside the range of {dtype}')
+                img = img.astype(dtype)
+            if shapes is None:
+                shapes = np.zeros((len(keys), img.ndim), dtype=np.int32)
+
+            if f is None or shard_bytes >= shard_size:
+                if f is not None:
+                    f.close()
+                shard_names.append('shard-{:05d}.bin'.format(len(shard_names)))
+                f = open(os.path.join(root, shard_names[-1]), 'wb')
+                shard_bytes = 0
+
+            shards[i] = len(shard_names) - 1
+            offsets[i] = shard_bytes
+            shapes[i] = img.shape
+            f.write(np.ascontiguousarray(img).tobytes())
+            shard_bytes += img.nbytes
+
+            if i % 10000 == 0:
+                print(f'Packed {i}/{len(keys)} images')
+    if f is not None:
+        f.close()
+
+    # Index is written last, so an interrupted build is never mistaken for a complete store
+    tmp_path = os.path.join(root, INDEX_NAME + '.tmp.npz')
+    np.savez(tmp_path, keys=np.asarray([k.encode() for k in keys]), shards=shards, offsets=offsets,
+             shapes=shapes, shard_names=np.asarray(shard_names), dtype=np.asarray(dtype.str))
+    os.replace(tmp_path, os.path.join(root, INDEX_NAME))
+    print(f'Packed {len(keys)} images into {len(shard_names)} shards in {root}')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Pack dataset images into memory-mapped shards', add_help=False)
+    parser.add_argument('--dataset_type', default='sentinel', choices=['sentinel', 'bigearthnet'],
+                        help='Which dataset the csv belongs to.')
+    parser.add_argument('--csv_path', required=True, type=str,
+                        help='Dataset .csv path')
+    parser.add_argument('--out_dir', default=None, type=str,
+                        help='Output directory, defaults to <csv dir>/<csv name>_packed')
+    parser.add_argument('--shard_size_gb', default=4., type=float,
+                        help='Approximate size of each shard file in GB')
+    parser.add_argument('--num_workers', default=8, type=int)
+    return parser
+
+
+def main(args):
+    from util.datasets import SentinelIndividualImageDataset, BigEarthNetImageDataset
+
+    df = pd.read_csv(args.csv_path)
+    if args.dataset_type == 'sentinel':
+        keys, read_fn = df['image_path'], SentinelIndividualImageDataset.read_raw
+    elif args.dataset_type == 'bigearthnet':
+        # Every patch stored as a ready (12, 60, 60) stack, resampled to the common 20m grid
+        keys, read_fn = df['patch_path'], BigEarthNetImageDataset.read_raw
+    else:
+        raise ValueError(f"Invalid dataset type: {args.dataset_type}")
+
+    out_dir = args.out_dir or default_packed_dir(args.csv_path)
+    write_packed_store(out_dir, keys, read_fn, shard_size=int(args.shard_size_gb * 1024**3),
+                       num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,93 @@
+"""
+Patch embedding of channel groups in a single batched matrix multiplication.
+
+The group-channel models embed every channel group with its own PatchEmbed. GroupChannelsPatchEmbed keeps those
+PatchEmbed modules (so the patch_embed.{i}.proj weights of existing checkpoints load unchanged), but its forward
+gathers the input channels once into group order, cuts them into patches with one copy and projects all groups
+with one batched matmul (a patch conv with stride = kernel size is a linear layer on the flattened patches),
+instead of G channel gathers, G convolutions and a stack.
+
+A batch of matmuls needs the same number of input channels per group, so shorter groups are padded with a copy of
+one of their channels whose weights are zero. (A grouped conv computes the same, but is several times slower than
+the separate convs on CPU.)
+
+Both GroupChannelsPatchEmbed and embed_patches (for timm's PatchEmbed) take inputs of any size divisible by the
+patch size, not only the img_size the model was built with.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from timm.models.vision_transformer import PatchEmbed
+
+
+def patch_grid_size(x, patch_size):
+    """
+    :param x: (..., H, W) input
+    :param patch_size: (p, p) patch size
+    :return: (H // p, W // p) grid of patches of x
+    """
+    H, W = x.shape[-2:]
+    assert H % patch_size[0] == 0 and W % patch_size[1] == 0, \
+        f"Input image size ({H}*{W}) is not divisible by the patch size ({patch_size[0]}*{patch_size[1]})."
+    return H // patch_size[0], W // patch_size[1]
+
+
+def embed_patches(patch_embed: PatchEmbed, x):
+    """
+    timm's PatchEmbed.forward without its check that x has the img_size of the model.
+    :param x: (N, C, H, W) input, H and W divisible by the patch size
+    :return: (N, L, D) patch embeddings, L = (H // p) * (W // p)
+    """
+    patch_grid_size(x, patch_embed.patch_size)
+    return patch_embed.proj(x).flatten(2).transpose(1, 2)
+
+
+class GroupChannelsPatchEmbed(nn.ModuleList):
+    def __init__(self, img_size, patch_size, channel_groups, embed_dim):
+        """
+        :param img_size: Input size
+        :param patch_size: Patch size
+        :param channel_groups: Input channel indices of every group
+        :param embed_dim: Embedding dimension
+        """
+        super().__init__([PatchEmbed(img_size, patch_size, len(group), embed_dim) for group in channel_groups])
+        self.num_groups = len(channel_groups)
+        self.group_size = max(len(group) for group in channel_groups)
+
+        index = [c for group in channel_groups for c in list(group) + [group[0]] * (self.group_size - len(group))]
+        self.register_buffer('channel_index', torch.tensor(index, dtype=torch.long), persistent=False)
+
+    @property
+    def num_patches(self):
+        return self[0].num_patches
+
+    @property
+    def patch_size(self):
+        return self[0].patch_size
+
+    def fused_weight(self):
+        """
+        :return: (G, group_size*p*p, D) weight and (G, 1, D) bias of all groups, zero for padded channels
+        """
+        weights = []
+        for patch_embed in self:
+            weight = patch_embed.proj.weight  # (D, len(group), p, p)
+            weights.append(F.pad(weight, (0, 0, 0, 0, 0, self.group_size - weight.shape[1])).flatten(1).t())
+        bias = torch.stack([patch_embed.proj.bias for patch_embed in self]).unsqueeze(1)
+        return torch.stack(weights), bias
+
+    def forward(self, x):
+        """
+        :param x: (N, C, H, W) input
+        :return: (N, G, L, D) patch embeddings of every channel group
+        """
+        weight, bias = self.fused_weight()
+        p = self.patch_size[0]
+        N = x.shape[0]
+        h, w = patch_grid_size(x, self.patch_size)
+
+        x = torch.index_select(x, 1, self.channel_index)  # (N, G*group_size, h*p, w*p)
+        x = x.view(N, self.num_groups, self.group_size, h, p, w, p).permute(1, 0, 3, 5, 2, 4, 6)
+        x = x.reshape(self.num_groups, N * h * w, -1)  # (G, N*L, group_size*p*p), in conv weight order
+        x = torch.baddbmm(bias, x, weight)  # (G, N*L, D)
+        return x.view(self.num_groups, N, h * w, -1).transpose(0, 1).contiguous()  # (N, G, L, D)
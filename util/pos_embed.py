@@ -6,6 +6,7 @@
 import numpy as np
 
 import torch
+import torch.nn.functional as F
 
 # --------------------------------------------------------
 # 2D sine-cosine position embedding
@@ -49,7 +50,7 @@ def get_1d_sincos_pos_embed_from_grid(embed_dim, pos):
     out: (M, D)
     """
     assert embed_dim % 2 == 0
-    omega = np.arange(embed_dim // 2, dtype=np.float)
+    omega = np.arange(embed_dim // 2, dtype=np.float64)
     omega /= embed_dim / 2.
     omega = 1. / 10000**omega  # (D/2,)
 
@@ -70,7 +71,7 @@ def get_1d_sincos_pos_embed_from_grid_torch(embed_dim, pos):
     out: (M, D)
     """
     assert embed_dim % 2 == 0
-    omega = torch.arange(embed_dim // 2, dtype=np.float, device=pos.device)
+    omega = torch.arange(embed_dim // 2, dtype=torch.float64, device=pos.device)
     omega /= embed_dim / 2.
     omega = 1. / 10000**omega  # (D/2,)
 
@@ -83,15 +84,134 @@ def get_1d_sincos_pos_embed_from_grid_torch(embed_dim, pos):
     emb = torch.cat([emb_sin, emb_cos], dim=1)  # (M, D)
     return emb.double()
 
+# --------------------------------------------------------
+# Timestamp embeddings of the temporal models
+# --------------------------------------------------------
+# Year (offset from the dataset's min_year), month - 1 and hour are small non-negative integers
+NUM_TIMESTAMP_POSITIONS = 256
+
+
+def get_timestamp_embed_table(embed_dim, num_positions=NUM_TIMESTAMP_POSITIONS):
+    """
+    embed_dim: output dimension for each of year, month and hour
+    out: (num_positions, D) float32 table of the 1d sin-cos embedding of the positions 0..num_positions-1
+    """
+    pos = np.arange(num_positions, dtype=np.float32)
+    return torch.from_numpy(get_1d_sincos_pos_embed_from_grid(embed_dim, pos)).float()
+
+
+def get_timestamp_embed(table, timestamps):
+    """
+    table: (P, D) get_timestamp_embed_table
+    timestamps: (N, T, 3) integer (year, month, hour) of every frame, each in [0, P)
+    out: (N, T, 3*D), the year, month and hour embeddings of every frame next to each other
+    """
+    return F.embedding(timestamps.long(), table).flatten(-2)
+
+
+def add_temporal_pos_embed(x, pos_embed, ts_embed):
+    """
+    Adds the position embedding of every patch and the timestamp embedding of every frame to the frame tokens,
+    broadcast over frames and patches instead of repeated to the token count.
+    x: (N, T, L, pD+tD) frame tokens, modified in place
+    pos_embed: (1, L, pD) position embedding w/o cls slot
+    ts_embed: (N, T, tD) timestamp embedding of every frame
+    out: x
+    """
+    pD = pos_embed.shape[-1]
+    x[..., :pD] += pos_embed.unsqueeze(1)
+    x[..., pD:] += ts_embed.unsqueeze(2)
+    return x
+
+# --------------------------------------------------------
+# Position + channel group embeddings of the group-channel models
+# --------------------------------------------------------
+def get_group_pos_channel_embed(pos_embed, channel_embed):
+    """
+    pos_embed: (1, 1+L, pD) position embedding, cls slot first
+    channel_embed: (1, G, cD) channel group embedding
+    out: (1, G, L, pD+cD), the position embedding of every patch next to the embedding of its group
+    """
+    G, L = channel_embed.shape[1], pos_embed.shape[1] - 1
+    # Channel embed same across (x,y) position, and pos embed same across channel (c)
+    channel_embed = channel_embed.unsqueeze(2).expand(-1, -1, L, -1)  # (1, G, L, cD)
+    pos_embed = pos_embed[:, 1:, :].unsqueeze(1).expand(-1, G, -1, -1)  # (1, G, L, pD)
+    return torch.cat((pos_embed, channel_embed), dim=-1)  # (1, G, L, D)
+
+
+def get_group_pos_channel_embed_with_cls(pos_embed, channel_embed, cls_channel_embed, grid_size=None):
+    """
+    cls_channel_embed: (1, 1, cD) channel embedding of the cls token
+    grid_size: (h, w) patch grid of the input to resize pos_embed to (see resize_pos_embed), None to keep it
+    out: (1, 1+G*L, D), the cls token embedding followed by get_group_pos_channel_embed
+    """
+    if grid_size is not None:
+        pos_embed = resize_pos_embed(pos_embed, grid_size)
+    pos_channel = get_group_pos_channel_embed(pos_embed, channel_embed)
+    pos_channel = pos_channel.view(1, -1, pos_channel.shape[-1])  # (1, G*L, D)
+    cls_pos_channel = torch.cat((pos_embed[:, :1, :], cls_channel_embed), dim=-1)  # (1, 1, D)
+    return torch.cat((cls_pos_channel, pos_channel), dim=1)
+
+
+class CachedEmbed:
+    """
+    Memoizes fn(*args) for embeddings that are computed from parameters on every forward. The result is reused
+    until one of the parameters is modified in place (optimizer step, load_state_dict), replaced or moved.
+    While the parameters are trained (grad enabled and requires_grad) it is recomputed on every call, as part of
+    the graph.
+    Arguments that are not tensors (e.g. a grid size) select one of several cached results, which are all
+    dropped when a parameter changes.
+    The results are plain attributes rather than buffers, so they are neither saved in checkpoints nor broadcast
+    by DistributedDataParallel.
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.key = None
+        self.values = {}
+
+    def __call__(self, *args):
+        params = [a for a in args if isinstance(a, torch.Tensor)]
+        if torch.is_grad_enabled() and any(p.requires_grad for p in params):
+            return self.fn(*args)
+        key = tuple((p.data_ptr(), p._version, p.shape, p.device, p.dtype) for p in params)
+        if key != self.key:
+            self.key, self.values = key, {}
+        options = tuple(a for a in args if not isinstance(a, torch.Tensor))
+        if options not in self.values:
+            with torch.no_grad():
+                self.values[options] = self.fn(*args)
+        return self.values[options]
+
+
 # --------------------------------------------------------
 # Interpolate position embeddings for high-resolution
 # References:
 # DeiT: https://github.com/facebookresearch/deit
 # --------------------------------------------------------
+def resize_pos_embed(pos_embed, grid_size, num_extra_tokens=1):
+    """
+    pos_embed: (1, E+L, D) position embedding of a square grid of L patches after E extra (cls) tokens
+    grid_size: (h, w) patch grid to interpolate the position tokens to
+    out: (1, E+h*w, D), pos_embed itself when the grid is unchanged
+    """
+    embedding_size = pos_embed.shape[-1]
+    orig_size = int((pos_embed.shape[-2] - num_extra_tokens) ** 0.5)
+    if tuple(grid_size) == (orig_size, orig_size):
+        return pos_embed
+    # class_token and dist_token are kept unchanged
+    extra_tokens = pos_embed[:, :num_extra_tokens]
+    # only the position tokens are interpolated
+    pos_tokens = pos_embed[:, num_extra_tokens:]
+    pos_tokens = pos_tokens.reshape(-1, orig_size, orig_size, embedding_size).permute(0, 3, 1, 2)
+    pos_tokens = torch.nn.functional.interpolate(
+        pos_tokens, size=tuple(grid_size), mode='bicubic', align_corners=False)
+    pos_tokens = pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
+    return torch.cat((extra_tokens, pos_tokens), dim=1)
+
+
 def interpolate_pos_embed(model, checkpoint_model):
     if 'pos_embed' in checkpoint_model:
         pos_embed_checkpoint = checkpoint_model['pos_embed']
-        embedding_size = pos_embed_checkpoint.shape[-1]
         try:
             num_patches = model.patch_embed.num_patches
         except AttributeError as err:
@@ -101,15 +221,7 @@ def interpolate_pos_embed(model, checkpoint_model):
         orig_size = int((pos_embed_checkpoint.shape[-2] - num_extra_tokens) ** 0.5)
         # height (== width) for the new position embedding
         new_size = int(num_patches ** 0.5)
-        # class_token and dist_token are kept unchanged
         if orig_size != new_size:
             print("Position interpolate from %dx%d to %dx%d" % (orig_size, orig_size, new_size, new_size))
-            extra_tokens = pos_embed_checkpoint[:, :num_extra_tokens]
-            # only the position tokens are interpolated
-            pos_tokens = pos_embed_checkpoint[:, num_extra_tokens:]
-            pos_tokens = pos_tokens.reshape(-1, orig_size, orig_size, embedding_size).permute(0, 3, 1, 2)
-            pos_tokens = torch.nn.functional.interpolate(
-                pos_tokens, size=(new_size, new_size), mode='bicubic', align_corners=False)
-            pos_tokens = pos_tokens.permute(0, 2, 3, 1).flatten(1, 2)
-            new_pos_embed = torch.cat((extra_tokens, pos_tokens), dim=1)
-            checkpoint_model['pos_embed'] = new_pos_embed
+            checkpoint_model['pos_embed'] = resize_pos_embed(pos_embed_checkpoint, (new_size, new_size),
+                                                             num_extra_tokens)
@@ -0,0 +1,178 @@
+"""
+Resized mirror of an fMoW image tree.
+
+The fMoW RGB transforms never use more than about 256px of an image, but the original JPEGs are often thousands of
+pixels on a side. This tool writes a copy of every image of a csv with its shorter side reduced to --short_side,
+under the same relative path (and file name, which the temporal datasets parse) below --out_root, plus a copy of
+the csv pointing at the mirror:
+
+    python -m util.resize_mirror --csv_path <root>/train_62classes.csv --out_root <mirror root>
+
+Train with --train_path <mirror root>/train_62classes.csv; CustomDatasetFromImages, FMoWTemporalStacked and
+CustomDatasetFromImagesTemporal read the mirror like the original tree.
+
+Reruns are incremental: an image is only (re)written if its mirror file is missing or the source changed since
+(the mirror file carries the source mtime). Images are written to a temporary file first, and the csv only once
+all its images are in place, so an interrupted run can simply be restarted.
+"""
+import argparse
+import json
+import os
+import shutil
+from multiprocessing import Pool
+
+import pandas as pd
+from PIL import Image
+
+
+MANIFEST_NAME = 'mirror.json'
+
+
+def mirror_path(img_path: str, src_root: str, out_root: str) -> str:
+    rel_path = os.path.relpath(img_path, src_root)
+    if rel_path.startswith(os.pardir + os.sep):
+        raise ValueError(f'{img_path} is not below {src_root}, set --src_root to a common parent of the images')
+    return os.path.join(out_root, rel_path)
+
+
+def is_up_to_date(src_path: str, dst_path: str) -> bool:
+    try:
+        return os.stat(dst_path).st_mtime_ns == os.stat(src_path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def resize_image(item):
+    """
+    Writes the resized copy of one image, unless it is up to date.
+    :param item: (source path, mirror path, shorter side, PIL format or None for the source format, quality)
+    :return: 'skipped', 'copied' or 'resized', or the error message
+    """
+    src_path, dst_path, short_side, fmt, quality = item
+    if is_up_to_date(src_path, dst_path):
+        return 'skipped'
+
+    os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+    tmp_path = f'{dst_path}.{os.getpid()}.tmp'
+    try:
+        img = Image.open(src_path)
+        src_format = img.format
+        if min(img.size) <= short_side and fmt in (None, src_format):
+            status = 'copied'  # already small enough, keep the original bytes
+            shutil.copyfile(src_path, tmp_path)
+        else:
+            status = 'resized'
+            img.draft(img.mode, (short_side, short_side))  # JPEGs are decoded at reduced resolution where possible
+            w, h = img.size
+            scale = short_side / min(w, h)
+            if scale < 1:
+                img = img.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.BICUBIC)
+            save_format = fmt or src_format
+            kwargs = {'quality': quality} if save_format in ('JPEG', 'WEBP') else {}
+            img.save(tmp_path, format=save_format, **kwargs)
+        src_stat = os.stat(src_path)
+        os.utime(tmp_path, ns=(src_stat.st_atime_ns, src_stat.st_mtime_ns))
+        os.replace(tmp_path, dst_path)
+    except Exception as e:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return f'{src_path}: {e}'
+    return status
+
+
+def check_manifest(out_root: str, params: dict):
+    """
+    Records the resize parameters of out_root, refuses to mix images written with different ones.
+    """
+    path = os.path.join(out_root, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            existing = json.load(f)
+        if existing != params:
+            raise ValueError(f'{out_root} was written with {existing}, not {params}. '
+                             f'Use another --out_root or remove the mirror.')
+        return
+    os.makedirs(out_root, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(params, f, indent=1)
+
+
+def build_mirror(csv_path: str, out_root: str, src_root: str = None, short_side: int = 256, fmt: str = None,
+                 quality: int = 90, image_column: str = 'image_path', out_csv: str = None, num_workers: int = 8):
+    """
+    :param csv_path: Dataset csv
+    :param out_root: Root of the mirror
+    :param src_root: Directory the image paths are mirrored relative to, defaults to the csv directory
+    :param short_side: Shorter side of the mirrored images, smaller images are copied as they are
+    :param fmt: PIL format to write (e.g. 'JPEG', 'WEBP'), None to keep the format of each image.
+        File names are kept either way, PIL detects the format from the content.
+    :param quality: Quality of JPEG/WebP images
+    :param image_column: Csv column with the image paths
+    :param out_csv: Rewritten csv, defaults to <out_root>/<csv file name>
+    :param num_workers: Number of processes
+    """
+    # The rewritten csv is read from any working directory, so it gets absolute paths
+    out_root = os.path.abspath(out_root)
+    src_root = os.path.abspath(src_root or os.path.dirname(os.path.abspath(csv_path)))
+    check_manifest(out_root, {'short_side': short_side, 'format': fmt, 'quality': quality})
+
+    df = pd.read_csv(csv_path)
+    src_paths = df[image_column].astype(str)
+    dst_paths = [mirror_path(p, src_root, out_root) for p in src_paths]
+    items = sorted({(src, dst, short_side, fmt, quality) for src, dst in zip(src_paths, dst_paths)})
+
+    counts = {'skipped': 0, 'copied': 0, 'resized': 0}
+    errors = []
+    with Pool(num_workers) as pool:
+        for i, status in enumerate(pool.imap_unordered(resize_image, items, chunksize=16)):
+            if status in counts:
+                counts[status] += 1
+            else:
+                errors.append(status)
+            if i % 10000 == 0:
+                print(f'Processed {i}/{len(items)} images')
+    print(f'{len(items)} images: ' + ', '.join(f'{n} {status}' for status, n in counts.items()))
+    if errors:
+        print('\n'.join(errors[:20]))
+        raise RuntimeError(f'{len(errors)} images failed, {csv_path} was not rewritten. Fix them and rerun.')
+
+    out_csv = out_csv or os.path.join(out_root, os.path.basename(csv_path))
+    df[image_column] = dst_paths
+    tmp_csv = f'{out_csv}.tmp'
+    df.to_csv(tmp_csv, index=False)
+    os.replace(tmp_csv, out_csv)
+    print(f'Wrote {out_csv}')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Write a resized mirror of the images of a dataset csv', add_help=False)
+    parser.add_argument('--csv_path', required=True, type=str,
+                        help='Dataset .csv path')
+    parser.add_argument('--out_root', required=True, type=str,
+                        help='Root directory of the mirror')
+    parser.add_argument('--src_root', default=None, type=str,
+                        help='Directory the image paths are mirrored relative to, defaults to the csv directory')
+    parser.add_argument('--short_side', default=256, type=int,
+                        help='Shorter side of the mirrored images. Random resized crops at scale 0.2 of a 224 '
+                             'input use up to 579px, smaller mirrors upsample those crops')
+    parser.add_argument('--format', default=None, choices=['JPEG', 'PNG', 'WEBP'],
+                        help='Format of the mirrored images, defaults to the format of each source image')
+    parser.add_argument('--quality', default=90, type=int,
+                        help='JPEG/WebP quality')
+    parser.add_argument('--image_column', default='image_path', type=str)
+    parser.add_argument('--out_csv', default=None, type=str,
+                        help='Rewritten csv, defaults to <out_root>/<csv file name>')
+    parser.add_argument('--num_workers', default=8, type=int)
+    return parser
+
+
+def main(args):
+    build_mirror(args.csv_path, args.out_root, src_root=args.src_root, short_side=args.short_side, fmt=args.format,
+                 quality=args.quality, image_column=args.image_column, out_csv=args.out_csv,
+                 num_workers=args.num_workers)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)
@@ -0,0 +1,136 @@
+"""
+Accuracy and throughput of one finetuned checkpoint at several input sizes.
+
+The models_vit* models take any input size divisible by their patch size: the position embedding is interpolated
+to the patch grid of the input (util.pos_embed.resize_pos_embed) and kept per grid size during evaluation. A
+checkpoint finetuned at one size can so serve requests at e.g. 96, 128 and 224px, trading accuracy for latency.
+
+    python main_finetune.py --eval --resume <CHECKPOINT> ... --eval_sizes 96 128 224
+
+evaluates the validation set at each size (the dataset is built for that --input_size, datasets with a fixed frame
+size such as temporal are resized on the device) and times forward passes of one batch of it.
+"""
+import copy
+import time
+
+import torch
+import torch.nn.functional as F
+
+from engine_finetune import evaluate, evaluate_temporal
+from util.batch_aug import Uint8ToFloat, build_batch_augment, raw_collate
+from util.datasets import build_fmow_dataset, pad_frames_collate
+from util.patch_embed import GroupChannelsPatchEmbed
+
+
+class ResizeBatch:
+    """
+    Resizes a (N, C, H, W) or (N, T, C, H, W) batch on the device to size x size (antialiased bilinear), after
+    an optional batch augmentation.
+    """
+    def __init__(self, size: int, batch_aug=None):
+        self.size = size
+        self.batch_aug = batch_aug
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.batch_aug is not None:
+            x = self.batch_aug(x)
+        if x.shape[-2:] == (self.size, self.size):
+            return x
+        frames = x.flatten(0, -4)
+        frames = F.interpolate(frames, size=(self.size, self.size), mode='bilinear', align_corners=False,
+                               antialias=True)
+        return frames.view(x.shape[:-2] + (self.size, self.size))
+
+
+def build_val_loader(args, input_size: int):
+    """
+    :return: Validation data loader of args.test_path and its batch augmentation, at input_size
+    """
+    size_args = copy.copy(args)
+    size_args.input_size = input_size
+    dataset = build_fmow_dataset(is_train=False, args=size_args)
+    if args.distributed:
+        sampler = torch.utils.data.DistributedSampler(dataset, shuffle=False)
+    else:
+        sampler = torch.utils.data.SequentialSampler(dataset)
+
+    collate_fn = raw_collate if args.batch_aug else None
+    if args.variable_frames:
+        collate_fn = pad_frames_collate
+    data_loader = torch.utils.data.DataLoader(
+        dataset, sampler=sampler,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=args.pin_mem,
+        drop_last=False,
+        collate_fn=collate_fn,
+    )
+
+    batch_aug = None
+    if args.batch_aug:
+        batch_aug = build_batch_augment(dataset, False, input_size)
+    elif args.uint8_transport:
+        batch_aug = Uint8ToFloat()
+    return data_loader, ResizeBatch(input_size, batch_aug)
+
+
+@torch.no_grad()
+def measure_throughput(model, batch, batch_aug, device, temporal: bool, repeats: int = 10):
+    """
+    :param batch: Batch of the validation data loader
+    :return: Images (samples) per second and milliseconds per batch of forward passes on batch
+    """
+    model.eval()
+    images = batch_aug(batch[0].to(device, non_blocking=True))
+    inputs = (images,)
+    if temporal:
+        pad_mask = batch[2] if len(batch) == 4 else None
+        if pad_mask is not None:
+            pad_mask = pad_mask.to(device)
+        inputs = (images, batch[1].to(device), pad_mask)
+
+    def step():
+        with torch.cuda.amp.autocast():
+            model(*inputs)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    step()  # warm up, fills the position embedding cache of this size
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    latency = (time.perf_counter() - start) / repeats
+    return images.shape[0] / latency, latency * 1000
+
+
+def evaluate_sizes(args, model, device):
+    """
+    Evaluates model on the validation set and measures its throughput at each of args.eval_sizes.
+    :return: List of (size, number of tokens, eval stats, images/s, ms/batch)
+    """
+    model_without_ddp = getattr(model, 'module', model)
+    temporal = args.model_type == 'temporal'
+    patch_embed = getattr(model_without_ddp, 'patch_embed', None)
+
+    results = []
+    for size in args.eval_sizes:
+        print(f'Input size {size}')
+        data_loader, batch_aug = build_val_loader(args, size)
+        if temporal:
+            test_stats = evaluate_temporal(data_loader, model, device, batch_aug=batch_aug)
+        else:
+            test_stats = evaluate(data_loader, model, device, batch_aug=batch_aug)
+        throughput, latency = measure_throughput(model, next(iter(data_loader)), batch_aug, device, temporal)
+
+        num_tokens = None  # per frame for temporal models
+        if patch_embed is not None:
+            num_groups = len(patch_embed) if isinstance(patch_embed, GroupChannelsPatchEmbed) else 1
+            num_tokens = (size // patch_embed.patch_size[0]) ** 2 * num_groups
+        results.append((size, num_tokens, test_stats, throughput, latency))
+
+    print(f"{'size':>5} {'tokens':>7} | {'acc1':>6} {'acc5':>6} | {'images/s':>9} {'ms/batch':>9}")
+    for size, num_tokens, test_stats, throughput, latency in results:
+        tokens = '-' if num_tokens is None else num_tokens
+        print(f"{size:>5} {tokens:>7} | {test_stats['acc1']:>6.2f} {test_stats['acc5']:>6.2f} | "
+              f"{throughput:>9.1f} {latency:>9.1f}")
+    return results
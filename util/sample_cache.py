@@ -0,0 +1,176 @@
+"""
+Node-wide cache of decoded images in shared memory.
+
+Decoded, pre-transform arrays are stored as .npy files under a tmpfs directory (/dev/shm by default), so
+every DataLoader worker and every local rank on the node shares them, and a hit is a memory-mapped read of
+pages already in RAM instead of a GDAL open and decode. The cache has a byte budget for the whole node; the
+least recently used arrays (by file mtime, refreshed on every hit) are evicted when an insert exceeds it.
+Arrays still in use by a reader stay valid after eviction, since unlinked files live until they are closed.
+
+The cache outlives the run (until reboot or `rm -rf <cache dir>`); keys are image paths, so remove it if
+images are rewritten in place.
+"""
+import fcntl
+import hashlib
+import os
+import time
+
+import numpy as np
+
+
+STAT_NAMES = ['hits', 'misses', 'evictions']
+
+
+class SharedSampleCache:
+    def __init__(self, root: str = '/dev/shm/satmae_sample_cache', budget_bytes: int = 32 * 1024**3):
+        """
+        :param root: Cache directory, should be on a tmpfs shared by all processes of the node
+        :param budget_bytes: Maximum total size of the cached arrays on the node
+        """
+        self.root = root
+        self.budget_bytes = budget_bytes
+        os.makedirs(os.path.join(root, 'stats'), exist_ok=True)
+
+        # Counters of this process and its DataLoader workers are files named <session>.<pid> in root/stats
+        self.session = f'{os.getpid()}-{time.time_ns()}'
+        self._counters, self._counters_pid = None, None
+        self.remove_stale_stats()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_counters'], state['_counters_pid'] = None, None
+        return state
+
+    def path(self, key: str) -> str:
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest[2:] + '.npy')
+
+    def counters(self) -> np.ndarray:
+        """
+        :return: Memory-mapped hit/miss/eviction counters of the current process
+        """
+        pid = os.getpid()
+        if self._counters_pid != pid:
+            path = os.path.join(self.root, 'stats', f'{self.session}.{pid}')
+            self._counters = np.memmap(path, dtype=np.int64, mode='w+', shape=(len(STAT_NAMES),))
+            self._counters_pid = pid
+        return self._counters
+
+    def get(self, key: str, load_fn):
+        """
+        :param key: Cache key, e.g. reader name and image path
+        :param load_fn: Called without arguments on a miss, returns the decoded numpy array (or None, not cached)
+        :return: Cached array (read-only) or the result of load_fn
+        """
+        path = self.path(key)
+        try:
+            arr = np.load(path, mmap_mode='r')
+        except FileNotFoundError:
+            arr = None
+
+        if arr is not None:
+            try:
+                os.utime(path)  # mtime is the last access time for LRU eviction
+            except FileNotFoundError:
+                pass  # evicted in the meantime, the mapped array stays valid
+            self.counters()[0] += 1
+            return arr
+
+        self.counters()[1] += 1
+        arr = load_fn()
+        if arr is not None and arr.nbytes <= self.budget_bytes:
+            self.put(path, arr)
+        return arr
+
+    def put(self, path: str, arr: np.ndarray):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.ascontiguousarray(arr))
+        size = os.path.getsize(tmp_path)
+
+        with open(os.path.join(self.root, 'lock'), 'a+b') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if os.path.exists(path):  # another process cached it first
+                    os.remove(tmp_path)
+                    return
+                os.replace(tmp_path, path)
+                usage = self.usage() + size
+                if usage > self.budget_bytes:
+                    # Evict down to 90% of the budget, so the directory scan is not repeated on every insert
+                    usage = self.evict(int(0.9 * self.budget_bytes))
+                self.set_usage(usage)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def usage(self) -> int:
+        """
+        :return: Bytes cached on the node
+        """
+        try:
+            return int(np.fromfile(os.path.join(self.root, 'usage'), dtype=np.int64, count=1)[0])
+        except (FileNotFoundError, IndexError):
+            return 0
+
+    def set_usage(self, usage: int):
+        np.array([usage], dtype=np.int64).tofile(os.path.join(self.root, 'usage'))
+
+    def evict(self, target_bytes: int) -> int:
+        """
+        Removes the least recently used arrays until at most target_bytes are cached. Caller holds the lock.
+        :return: Bytes cached after eviction
+        """
+        entries = []
+        for subdir in os.scandir(self.root):
+            if not subdir.is_dir() or subdir.name == 'stats':
+                continue
+            for entry in os.scandir(subdir.path):
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        entries.sort()
+
+        usage = sum(size for _, size, _ in entries)
+        evictions = 0
+        for _, size, path in entries:
+            if usage <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            usage -= size
+            evictions += 1
+        self.counters()[2] += evictions
+        return usage
+
+    def stats(self) -> dict:
+        """
+        :return: Counters summed over this process and its DataLoader workers, and the bytes cached on the node
+        """
+        total = np.zeros(len(STAT_NAMES), dtype=np.int64)
+        stats_dir = os.path.join(self.root, 'stats')
+        for name in os.listdir(stats_dir):
+            if name.startswith(self.session + '.'):
+                total += np.fromfile(os.path.join(stats_dir, name), dtype=np.int64, count=len(STAT_NAMES))
+        stats = dict(zip(STAT_NAMES, total.tolist()))
+        stats['bytes'] = self.usage()
+        return stats
+
+    def remove_stale_stats(self):
+        """
+        Removes the counter files of sessions whose creating process has exited.
+        """
+        stats_dir = os.path.join(self.root, 'stats')
+        for name in os.listdir(stats_dir):
+            pid = int(name.split('-')[0])
+            try:
+                os.kill(pid, 0)
+            except ProcessLookupError:
+                try:
+                    os.remove(os.path.join(stats_dir, name))
+                except FileNotFoundError:
+                    pass
+            except PermissionError:
+                pass  # alive, owned by another user
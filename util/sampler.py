@@ -0,0 +1,115 @@
+"""
+Training sampler that can resume in the middle of an epoch.
+
+ResumableDistributedSampler draws the same per-epoch permutation as torch's DistributedSampler (seeded with
+seed + epoch), but its position within the epoch is explicit state: state_dict(consumed) records the epoch, the
+seed and how many samples this rank has already trained on, and after load_state_dict the next epoch iteration
+starts right after them. The skipped indices are dropped from the index list, so none of their samples is read.
+
+Together with --save_every_steps (checkpoint-last.pth written by the training engines) a restarted job continues
+with the next batch it would have seen.
+
+FrameCountGroupedSampler orders each epoch so that every batch holds samples with similar frame counts, for the
+temporal models with --variable_frames, which pad a batch to its longest sample. The order is still a function of
+seed and epoch only, so it resumes the same way.
+"""
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import DistributedSampler
+
+
+class ResumableDistributedSampler(DistributedSampler):
+    def __init__(self, dataset, num_replicas=None, rank=None, shuffle=True, seed=0, drop_last=False):
+        """
+        :param dataset: Map-style dataset
+        :param num_replicas: Number of processes, defaults to the world size
+        :param rank: Rank of this process, defaults to the global rank
+        :param shuffle: Shuffle the indices of every epoch
+        :param seed: Seed of the permutations, must be the same on all ranks
+        :param drop_last: Drop the tail of the dataset instead of padding it to a multiple of num_replicas
+        """
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=shuffle, seed=seed,
+                         drop_last=drop_last)
+        self.start_index = 0  # samples of self.epoch this rank skips
+
+    def __iter__(self):
+        indices = self.epoch_indices()
+        return iter(indices[self.start_index:])
+
+    def epoch_indices(self) -> list:
+        """
+        :return: All indices of this rank in self.epoch, including the ones skipped when resuming
+        """
+        return list(super().__iter__())
+
+    def __len__(self):
+        return self.num_samples - self.start_index
+
+    def set_epoch(self, epoch: int):
+        # The epoch restored by load_state_dict keeps its offset, any other one starts from its first sample
+        if epoch != self.epoch:
+            self.start_index = 0
+        super().set_epoch(epoch)
+
+    def state_dict(self, consumed: int) -> dict:
+        """
+        :param consumed: Samples of the current epoch this rank has trained on, counting the skipped ones
+        :return: Position to resume from, the start of the next epoch once the current one is complete
+        """
+        epoch = self.epoch
+        if consumed >= self.num_samples:
+            epoch, consumed = epoch + 1, 0
+        return {'epoch': epoch, 'seed': self.seed, 'consumed': consumed, 'num_replicas': self.num_replicas}
+
+    def load_state_dict(self, state: dict):
+        if state['seed'] != self.seed:
+            raise ValueError(f"The checkpoint was trained with sampler seed {state['seed']}, not {self.seed}. "
+                             f"Resume with the same --seed.")
+        if state['num_replicas'] != self.num_replicas:
+            print(f"Warning: the checkpoint was written by {state['num_replicas']} processes, resuming with "
+                  f"{self.num_replicas}. The rest of epoch {state['epoch']} is not the exact remainder of its "
+                  f"permutation.")
+        self.epoch = state['epoch']
+        self.start_index = min(state['consumed'], self.num_samples)
+
+
+class FrameCountGroupedSampler(ResumableDistributedSampler):
+    def __init__(self, dataset, frame_counts, batch_size: int, bucket_batches: int = 50, **kwargs):
+        """
+        Cuts the indices of each epoch into windows of bucket_batches batches, sorts every window by frame count
+        and shuffles the order of its full batches. Batches of the DataLoader (with batch_size) then hold samples
+        of similar length, and the mix of lengths across the epoch stays random.
+        :param dataset: Map-style dataset
+        :param frame_counts: (len(dataset),) number of frames of every sample
+        :param batch_size: Batch size of the DataLoader
+        :param bucket_batches: Number of batches sorted together, larger windows pad less but order the epoch more
+        :param kwargs: ResumableDistributedSampler arguments
+        """
+        super().__init__(dataset, **kwargs)
+        self.frame_counts = np.asarray(frame_counts)
+        self.batch_size = batch_size
+        self.bucket_batches = bucket_batches
+
+    def epoch_indices(self) -> list:
+        indices = super().epoch_indices()
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        window = self.batch_size * self.bucket_batches
+        grouped = []
+        for start in range(0, len(indices), window):
+            bucket = indices[start:start + window]
+            bucket = [bucket[k] for k in np.argsort(self.frame_counts[bucket], kind='stable')]
+            batches = [bucket[k:k + self.batch_size] for k in range(0, len(bucket), self.batch_size)]
+            # only the last window can end with a partial batch, which stays last
+            tail = [batches.pop()] if len(batches[-1]) < self.batch_size else []
+            order = torch.randperm(len(batches), generator=g).tolist() if self.shuffle else range(len(batches))
+            for k in order:
+                grouped.extend(batches[k])
+            for batch in tail:
+                grouped.extend(batch)
+        return grouped
@@ -0,0 +1,179 @@
+"""
+Tar shards for streaming datasets.
+
+A shard is a plain tar file of consecutive samples, each stored as two .npy members:
+<sample key>.img.npy (decoded (c, h, w) image) and <sample key>.label.npy. Reading a shard is one large
+sequential read, which suits network and object storage much better than opening one small file per sample.
+shards.json next to the shards lists them with their sample counts.
+
+Write shards from a dataset csv with:
+    python -m util.shard_stream --dataset_type sentinel --csv_path <train.csv>
+Samples are shuffled globally once while writing, so a bounded shuffle buffer is enough while reading.
+"""
+import argparse
+import io
+import json
+import os
+import random
+import tarfile
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import torch.distributed as dist
+
+
+SHARD_INDEX_NAME = 'shards.json'
+
+
+def default_shard_dir(csv_path: str) -> str:
+    """
+    Default location of the shards for a csv: <csv dir>/<csv name>_shards
+    """
+    return os.path.splitext(csv_path)[0] + '_shards'
+
+
+def load_shard_index(shard_dir: str):
+    """
+    :return: List of (shard path, number of samples)
+    """
+    with open(os.path.join(shard_dir, SHARD_INDEX_NAME)) as f:
+        index = json.load(f)
+    return [(os.path.join(shard_dir, s['name']), s['num_samples']) for s in index['shards']]
+
+
+def get_rank_and_world_size():
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def read_shard(path: str):
+    """
+    Streams the samples of one shard in order.
+    :return: Generator of (image, label) numpy arrays
+    """
+    sample = {}
+    with open(path, 'rb', buffering=8 * 1024**2) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+        for member in tar:
+            field = member.name.split('.')[1]  # <key>.<field>.npy
+            sample[field] = np.load(io.BytesIO(tar.extractfile(member).read()))
+            if 'img' in sample and 'label' in sample:
+                yield sample['img'], sample['label']
+                sample = {}
+
+
+def shuffle_buffer(samples, buffer_size: int, rng: random.Random):
+    """
+    Approximate shuffle of a stream: keeps buffer_size samples and yields a random one for every new sample.
+    A buffer_size below 1 passes the stream through unshuffled.
+    """
+    if buffer_size <= 0:
+        yield from samples
+        return
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        i = rng.randrange(buffer_size)
+        yield buffer[i]
+        buffer[i] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def _add_npy(tar, name, arr):
+    data = io.BytesIO()
+    np.save(data, arr)
+    info = tarfile.TarInfo(name)
+    info.size = data.tell()
+    data.seek(0)
+    tar.addfile(info, data)
+
+
+def _read_sample(item):
+    read_fn, path, label = item
+    return read_fn(path), label
+
+
+def write_shards(out_dir: str, paths, labels, read_fn, samples_per_shard=2000, num_workers=8, seed=0):
+    """
+    Reads every sample with read_fn (in parallel) and writes them in a random order into tar shards.
+    :param out_dir: Output directory
+    :param paths: (N,) image paths
+    :param labels: (N, ...) labels, one row per path
+    :param read_fn: Picklable function mapping a path to its decoded (c, h, w) numpy array
+    :param samples_per_shard: Number of samples per shard
+    :param num_workers: Number of reader processes
+    :param seed: Seed of the global shuffle
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    order = list(range(len(paths)))
+    random.Random(seed).shuffle(order)
+    items = [(read_fn, paths[i], labels[i]) for i in order]
+
+    shards = []
+    tar = None
+    with Pool(num_workers) as pool:
+        for i, (img, label) in enumerate(pool.imap(_read_sample, items, chunksize=16)):
+            if i % samples_per_shard == 0:
+                if tar is not None:
+                    tar.close()
+                shards.append({'name': 'shard-{:06d}.tar'.format(len(shards)), 'num_samples': 0})
+                tar = tarfile.open(os.path.join(out_dir, shards[-1]['name'] + '.tmp'), 'w')
+            _add_npy(tar, f'{order[i]:09d}.img.npy', img)
+            _add_npy(tar, f'{order[i]:09d}.label.npy', np.asarray(label))
+            shards[-1]['num_samples'] += 1
+
+            if i % 10000 == 0:
+                print(f'Wrote {i}/{len(items)} samples')
+    if tar is not None:
+        tar.close()
+
+    for shard in shards:
+        tmp_path = os.path.join(out_dir, shard['name'] + '.tmp')
+        if os.path.exists(tmp_path):
+            os.replace(tmp_path, os.path.join(out_dir, shard['name']))
+
+    # Index is written last, so an interrupted conversion is never mistaken for a complete one
+    with open(os.path.join(out_dir, SHARD_INDEX_NAME), 'w') as f:
+        json.dump({'shards': shards}, f, indent=1)
+    print(f'Wrote {len(items)} samples into {len(shards)} shards in {out_dir}')
+
+
+def get_args_parser():
+    parser = argparse.ArgumentParser('Write dataset samples into tar shards for streaming', add_help=False)
+    parser.add_argument('--dataset_type', default='sentinel', choices=['sentinel'],
+                        help='Which dataset the csv belongs to.')
+    parser.add_argument('--csv_path', required=True, type=str,
+                        help='Dataset .csv path')
+    parser.add_argument('--out_dir', default=None, type=str,
+                        help='Output directory, defaults to <csv dir>/<csv name>_shards')
+    parser.add_argument('--samples_per_shard', default=2000, type=int)
+    parser.add_argument('--num_workers', default=8, type=int)
+    parser.add_argument('--seed', default=0, type=int,
+                        help='Seed of the global shuffle of the samples')
+    return parser
+
+
+def main(args):
+    from util.datasets import CATEGORIES, SentinelIndividualImageDataset
+
+    df = pd.read_csv(args.csv_path)
+    if args.dataset_type == 'sentinel':
+        paths = df['image_path'].tolist()
+        labels = SentinelIndividualImageDataset.build_label_array(df['category'], CATEGORIES)
+        read_fn = SentinelIndividualImageDataset.read_raw
+    else:
+        raise ValueError(f"Invalid dataset type: {args.dataset_type}")
+
+    out_dir = args.out_dir or default_shard_dir(args.csv_path)
+    write_shards(out_dir, paths, labels, read_fn, samples_per_shard=args.samples_per_shard,
+                 num_workers=args.num_workers, seed=args.seed)
+
+
+if __name__ == '__main__':
+    args = get_args_parser()
+    args = args.parse_args()
+    main(args)